@@ -3,76 +3,151 @@
 import os
 import sys
 import pathlib
-import librosa
+import resource
+import concurrent.futures
+
 import pandas
 
+import numpy as np
+
+from utils.wav_info import wav_info_cache, wav_durations
+
 from argparse import ArgumentParser, RawTextHelpFormatter
 
 DESCRIPTION = """
-
+Dadansoddi set ddata CommonVoice: cyfrifon fesul siaradwr, brawddeg, oed a rhyw, a hyd y recordiadau.
+Analyses a CommonVoice dataset: counts per speaker, sentence, age and gender
+(and speakers by age and gender) from its tsv files, and the hours of audio
+in each of its DeepSpeech csv files.
+
+The tsv files are read in chunks, several at a time, so that peak memory
+(reported at the end) grows with the number of distinct speakers and
+sentences, not recordings: about 200MB per process for a validated.tsv of 2
+million recordings.
 """
 
-def panda_group(df, column, destination_file_path):
+# rows of a tsv read at a time, and how many chunks' counts are gathered
+# before they are summed. Memory then grows with the number of distinct
+# values counted, not with the size of the tsv.
+CHUNK_SIZE = 100000
+MERGE_CHUNKS = 4
+
+COUNTED_COLUMNS = ['client_id', 'sentence', 'age', 'gender']
+
+# age and gender have a handful of values, so are read as categories. Most
+# client_ids and sentences are distinct within a chunk, for which pandas'
+# categorical parsing is slower than plain strings.
+COLUMN_DTYPES = {'client_id':str, 'sentence':str, 'age':'category', 'gender':'category'}
+
 
-    df_grp_client = df.groupby(column).size().to_frame('count').reset_index()
-    df_grp_client = df_grp_client.sort_values("count", ascending=False)
-    df_grp_client.to_csv(destination_file_path, index=False)
+def sum_counts(counts):
+    return pandas.concat(counts).groupby(level=0, sort=False, observed=True).sum()
+
+
+def write_counts(counts, column, destination_file_path):
+
+    df_counts = counts.rename_axis(column).to_frame('count').reset_index()
+    df_counts = df_counts.sort_values("count", ascending=False)
+    df_counts.to_csv(destination_file_path, index=False)
     
 
 
-def analyze_tsvs(cv_root_dir):
-    #client_id	path	sentence	up_votes	down_votes	age	gender	accent	locale	segment
-    tsv_files = pathlib.Path(cv_root_dir).glob("*.tsv")
-    for tsv_file_path in tsv_files:
-        
-        print ("Analyzing %s " % tsv_file_path)
+def analyze_tsv(tsv_file_path, chunk_size=CHUNK_SIZE):
+    """
+    Counts recordings per client_id, sentence, age and gender, and clients
+    per age and gender, in one pass over the tsv in chunks. Each chunk is
+    counted with value_counts, and the counts of several chunks summed
+    together in one groupby. A client whose age or gender changes between
+    recordings is counted once, with the last given.
+    """
+    counts = {column:[] for column in COUNTED_COLUMNS}
+    clients = dict()
+    rows = 0
+
+    for chunk in pandas.read_csv(tsv_file_path, encoding='utf-8', sep='\t', header=0, usecols=COUNTED_COLUMNS, dtype=COLUMN_DTYPES, chunksize=chunk_size):
+        rows += len(chunk)
+        for column in COUNTED_COLUMNS:
+            counts[column].append(chunk[column].value_counts(sort=False))
+            if len(counts[column]) >= MERGE_CHUNKS:
+                counts[column] = [sum_counts(counts[column])]
+        last = chunk.drop_duplicates('client_id', keep='last')
+        clients.update(zip(last['client_id'], zip(last['age'], last['gender'])))
 
+    for column in COUNTED_COLUMNS:
+        column_counts = sum_counts(counts[column]) if len(counts[column]) > 0 else pandas.Series([], dtype=int)
+        write_counts(column_counts[column_counts > 0], column, str(tsv_file_path).replace(".tsv", ".counts.%s.txt" % column))
+
+    # clients by age and gender
+    df_clients = pandas.DataFrame([(client_id, age, gender) for client_id, (age, gender) in clients.items()], columns=['client_id', 'age', 'gender'])
+    pandas.crosstab(df_clients['age'], df_clients['gender']).to_csv(str(tsv_file_path).replace(".tsv", ".counts.age_gender.txt"))
+
+    return rows, len(clients)
+
+
+
+def analyze_tsvs(cv_root_dir, workers=4):
+    #client_id	path	sentence	up_votes	down_votes	age	gender	accent	locale	segment
+    tsv_files = []
+    for tsv_file_path in sorted(pathlib.Path(cv_root_dir).glob("*.tsv")):
         if 'reported.tsv' in str(tsv_file_path):
             continue
-        
-        df = pandas.read_csv(tsv_file_path, encoding='utf-8', sep='\t', header=0, dtype={'gender':str})
+        # newer releases also have tsvs of sentences, durations etc.
+        columns = pandas.read_csv(tsv_file_path, encoding='utf-8', sep='\t', header=0, nrows=0).columns
+        if not set(COUNTED_COLUMNS).issubset(columns):
+            continue
+        tsv_files.append(tsv_file_path)
 
-        panda_group(df, 'client_id', str(tsv_file_path).replace(".tsv",".counts.client_id.txt"))
-        panda_group(df, 'sentence', str(tsv_file_path).replace(".tsv",".counts.sentence.txt"))
-        
-        panda_group(df, 'age', str(tsv_file_path).replace(".tsv",".counts.age.txt"))
-        panda_group(df, 'gender', str(tsv_file_path).replace(".tsv",".counts.gender.txt"))
+    # the largest first, so that they don't hold up the end
+    tsv_files.sort(key=lambda f: f.stat().st_size, reverse=True)
+
+    processes = max(1, min(workers, len(tsv_files)))
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        analyses = {pool.submit(analyze_tsv, tsv_file_path):tsv_file_path for tsv_file_path in tsv_files}
+        for analysis in concurrent.futures.as_completed(analyses):
+            rows, clients = analysis.result()
+            print ("Analyzed %s\t%s recordings\t%s clients" % (analyses[analysis], rows, clients))
 
-        # analyze clients by age and gender.... 
+    # ru_maxrss is in KB on Linux, and for children that of the largest
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print ("Peak memory analyzing tsvs: %.0f MB per process, %s processes" % (peak_rss, processes))
 
 
-def analyze_csvs(cv_root_dir):
+def analyze_csvs(cv_root_dir, workers=16):
 
     clips_dir = os.path.join(cv_root_dir, "clips")
     csv_files = pathlib.Path(clips_dir).glob("*.csv")
 
-    # client_id	path	sentence	up_votes	down_votes	age	gender	accent	locale	segment
-    for csv_file_path in csv_files:
-        
-        df = pandas.read_csv(csv_file_path, encoding='utf-8')        
-        #
-        df_grouped = df.groupby("transcript").size().to_frame('count').reset_index()
-        df_grouped = df_grouped.sort_values("count", ascending=False)
+    # headers are only read when clips don't all share one layout, and are
+    # then kept, as with the feasibility filter, next to the clips
+    with wav_info_cache(os.path.join(clips_dir, ".wav_info.sqlite"), workers) as cache:
+
+        # client_id	path	sentence	up_votes	down_votes	age	gender	accent	locale	segment
+        for csv_file_path in csv_files:
+
+            df = pandas.read_csv(csv_file_path, encoding='utf-8')
+            #
+            df_grouped = df.groupby("transcript").size().to_frame('count').reset_index()
+            df_grouped = df_grouped.sort_values("count", ascending=False)
 
-        df_grouped.to_csv(str(csv_file_path).replace(".csv",".dups.txt"), index=False)
+            df_grouped.to_csv(str(csv_file_path).replace(".csv",".dups.txt"), index=False)
 
-        #        
-        total_duration = 0.0
-        count = 0
-        for index, row in df.iterrows():
-            count += 1
-            wav_file_path = os.path.join(cv_root_dir, "clips", row["wav_filename"])
-            total_duration = total_duration + librosa.get_duration(filename=wav_file_path)
+            #
+            paths = df["wav_filename"].astype(str).map(lambda f: os.path.join(clips_dir, f))
+            durations, _ = wav_durations(paths, df["wav_filesize"] if "wav_filesize" in df.columns else None, cache)
+            total_duration = float(np.nansum(durations))
+            count = len(df)
 
-        print ("%s\t%s recordings\t\t%.2f hours\t(%.2f seconds)" % (csv_file_path, count, total_duration/60.0/60.0, total_duration))
-        print (df_grouped.nlargest(n=5, columns='count'))
-        print ('\n')
+            print ("%s\t%s recordings\t\t%.2f hours\t(%.2f seconds)" % (csv_file_path, count, total_duration/60.0/60.0, total_duration))
+            if np.isnan(durations).any():
+                print ("%s clips missing or unreadable" % np.isnan(durations).sum())
+            print (df_grouped.nlargest(n=5, columns='count'))
+            print ('\n')
 
         
-def main(cv_root_dir, **args):
+def main(cv_root_dir, workers, **args):
 
-    analyze_tsvs(cv_root_dir)
-    analyze_csvs(cv_root_dir)
+    analyze_tsvs(cv_root_dir, min(workers, os.cpu_count()))
+    analyze_csvs(cv_root_dir, workers)
 
     
 
@@ -82,6 +157,7 @@ if __name__ == "__main__":
     parser = ArgumentParser(description=DESCRIPTION, formatter_class=RawTextHelpFormatter) 
 
     parser.add_argument("--cv_dir", dest="cv_root_dir", required=True, help="path to commonvoice files")    
+    parser.add_argument("--workers", dest="workers", type=int, default=16, help="processes analysing tsvs (at most one per core), and threads reading wav headers, if they need reading")
    
     parser.set_defaults(func=main)
     args = parser.parse_args()
@@ -13,9 +13,10 @@ help()
 	echo
 	echo "Options:"
 	echo
-	echo " -t, --text_file        Path to text file containing all corpus text "
+	echo " -t, --text_file        Path to text file containing all corpus text, or to a .list of such files "
 	echo " -d, --domain           Name for language model domain (e.g. 'macsen' or 'transcribe' "
   echo " -o, --output_dir       (optional) Default: /export/${DEEPSPEECH_RELEASE}_${TECHIAITH_RELEASE}"
+  echo " -m, --max_arpa_memory  (optional) memory lmplz may use, e.g. '40G'. Default: estimated from the corpus"
 	echo
 	exit 0
 }
@@ -23,9 +24,10 @@ help()
 lm_domain=''
 source_text_file=''
 output_dir=/export/${DEEPSPEECH_RELEASE}_${TECHIAITH_RELEASE}
+max_arpa_memory=''
 
-SHORT=ht:d:o:
-LONG=text_file:,domain:,output_dir:
+SHORT=ht:d:o:m:
+LONG=text_file:,domain:,output_dir:,max_arpa_memory:
 
 # read options
 OPTS=$(getopt --options $SHORT --long $LONG --name "$0" -- "$@")
@@ -52,6 +54,10 @@ while true ; do
       output_dir="$2"
       shift 2
       ;;       
+    -m | --max_arpa_memory )
+      max_arpa_memory="$2"
+      shift 2
+      ;;
     -h | --help )
       help
       shift
@@ -78,30 +84,88 @@ if [ -z "${lm_domain}" ]; then
 fi
 
 mkdir -p ${output_dir}
-cd ${output_dir}
 
 VOCAB_SIZE=50000
+ARPA_ORDER=6
 alphabet_file_path=/DeepSpeech/bin/bangor_welsh/alphabet.txt
 
 
+set +x
+echo "####################################################################################"
+echo "#### Counting words and n-grams of the corpus                                   ####"
+echo "####################################################################################"
+set -x
+# writes vocab-${VOCAB_SIZE}.txt, and estimates of the model's size and of
+# the memory lmplz needs to lm_counts.json. The counts of each corpus file
+# are kept next to it, so that files shared by many scorers are counted once.
+python3 /DeepSpeech/bin/bangor_welsh/count_lm_corpus.py \
+  --text_file "${source_text_file}" \
+  --output_dir "${output_dir}" \
+  --top_k ${VOCAB_SIZE} \
+  --arpa_order ${ARPA_ORDER}
+
+lm_count() {
+  python3 -c "import json, sys; print(json.load(open(sys.argv[1]))[sys.argv[2]])" "${output_dir}/lm_counts.json" "$1"
+}
+
+if [ -z "${max_arpa_memory}" ]; then
+  max_arpa_memory=$(lm_count lmplz_memory)
+fi
+corpus_lowercase=$(lm_count lowercase)
+
+# A .list text file names the corpus files (one per line) that together make
+# up the corpus, e.g. a base corpus and one k-fold's transcripts. They are
+# streamed in turn through a fifo, rather than joined into another copy.
+if [[ "${source_text_file}" == *.list ]]; then
+    corpus_list_file=$(readlink -f "${source_text_file}")
+    source_text_file=$(mktemp -u --tmpdir="$(readlink -f ${output_dir})" corpus.XXXXXX.fifo)
+    mkfifo "${source_text_file}"
+    xargs -d '\n' cat < "${corpus_list_file}" > "${source_text_file}" &
+    corpus_stream_pid=$!
+    trap 'kill ${corpus_stream_pid} 2>/dev/null || true; rm -f "${source_text_file}"' EXIT
+fi
+
+cd ${output_dir}
+
 
 set +x
 echo "####################################################################################"
 echo "#### Generating binary language model                                           ####"
 echo "####################################################################################"
 set -x
-python /DeepSpeech/data/lm/generate_lm.py \
-  --input_txt "${source_text_file}" \
-  --output_dir . \
-  --top_k ${VOCAB_SIZE} \
-  --kenlm_bins '/DeepSpeech/native_client/kenlm/build/bin/' \
-  --arpa_order 6 \
-  --max_arpa_memory '85%' \
-  --arpa_prune "0|0|1" \
-  --binary_a_bits 255 \
-  --binary_q_bits 8 \
-  --binary_type 'trie' \
-  --discount_fallback
+if [ "${corpus_lowercase}" == "True" ]; then
+  # Cleaned corpora are lowercase already, so KenLM reads the corpus as it
+  # is, with the vocabulary counted above, rather than generate_lm.py
+  # counting it again into a lowercased copy. The same steps and options
+  # as generate_lm.py.
+  kenlm_bins=/DeepSpeech/native_client/kenlm/build/bin
+
+  ${kenlm_bins}/lmplz \
+    --order ${ARPA_ORDER} \
+    --temp_prefix . \
+    --memory "${max_arpa_memory}" \
+    --text "${source_text_file}" \
+    --arpa lm.arpa \
+    --prune 0 0 1 \
+    --discount_fallback
+
+  ${kenlm_bins}/filter single model:lm.arpa lm_filtered.arpa < vocab-${VOCAB_SIZE}.txt
+
+  ${kenlm_bins}/build_binary -a 255 -q 8 -v trie lm_filtered.arpa lm.binary
+else
+  python /DeepSpeech/data/lm/generate_lm.py \
+    --input_txt "${source_text_file}" \
+    --output_dir . \
+    --top_k ${VOCAB_SIZE} \
+    --kenlm_bins '/DeepSpeech/native_client/kenlm/build/bin/' \
+    --arpa_order ${ARPA_ORDER} \
+    --max_arpa_memory "${max_arpa_memory}" \
+    --arpa_prune "0|0|1" \
+    --binary_a_bits 255 \
+    --binary_q_bits 8 \
+    --binary_type 'trie' \
+    --discount_fallback
+fi
 
 #
 set +x
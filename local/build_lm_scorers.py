@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import subprocess
+
+from pathlib import Path
+
+from utils.corpus import read_corpus_list
+from utils.manifest import import_manifest
+from utils.lm_counts import ARPA_ORDER, MIN_LMPLZ_MEMORY, cached_counts, count_text_files, estimate_lm
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+DESCRIPTION = """
+Adeiladu sawl model iaith KenLM ochr yn ochr (e.e. un ar gyfer pob k-fold).
+Builds several KenLM scorers at once (e.g. one per k-fold), each with
+build_lm_scorer.sh, as many at a time as memory and cores allow.
+
+The memory each lmplz needs is estimated from the n-gram counts of its corpus
+(see count_lm_corpus.py), and builds are started, largest first, while the
+estimates of those running fit within the available memory. The counts are
+kept next to each corpus file, so build_lm_scorer.sh doesn't count them
+again, and a corpus shared by every build is only counted once. Scorers whose
+corpus files, alphabet and build script are unchanged since they were last
+built are skipped. --dry_run doesn't count: it uses the counts already kept
+and otherwise estimates from the size of the corpus.
+
+e.g. (from /DeepSpeech/bin/bangor_welsh)
+
+    python3 build_lm_scorers.py --domain transcribe --output_dir /export/kfolds \\
+        --text_files /data/finetuning/kfolds/lm-data/*.union.list
+
+"""
+
+BUILD_LM_SCORER = "/DeepSpeech/bin/bangor_welsh/build_lm_scorer.sh"
+ALPHABET_FILE_PATH = "/DeepSpeech/bin/bangor_welsh/alphabet.txt"
+
+GB = 1024 * 1024 * 1024
+
+# count_lm_corpus.py's counts, filter, build_binary etc.
+JOB_MEMORY_OVERHEAD = 2 * GB
+MIN_ARPA_MEMORY = MIN_LMPLZ_MEMORY
+
+# lmplz --memory per byte of corpus and per order, for --dry_run when a
+# corpus hasn't been counted
+LMPLZ_MEMORY_PER_BYTE_ORDER = 0.4
+
+
+def available_memory():
+    try:
+        with open("/proc/meminfo", 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def estimate_arpa_memory(corpus_files, order=ARPA_ORDER, workers=1, count=True):
+    """
+    (lmplz memory, whether it was estimated from counts). Without count,
+    only counts already cached are used, or else the size of the corpus.
+    """
+    if count:
+        counts = count_text_files(corpus_files, order, workers=workers)
+    else:
+        counts = cached_counts(corpus_files, order)
+        if counts is None:
+            corpus_bytes = sum(os.path.getsize(f) for f in corpus_files)
+            return max(MIN_ARPA_MEMORY, int(corpus_bytes * order * LMPLZ_MEMORY_PER_BYTE_ORDER)), False
+    # lmplz still works (but slower) with less, spilling to disk
+    return max(MIN_ARPA_MEMORY, estimate_lm(counts)['lmplz_memory_bytes']), True
+
+
+class scorer_build(object):
+
+    def __init__(self, text_file, domain, output_dir):
+        self.text_file = text_file
+        self.domain = domain
+        self.output_dir = output_dir
+        self.scorer_file = os.path.join(output_dir, "kenlm.%s.scorer" % domain)
+
+        if text_file.endswith(".list"):
+            self.corpus_files = read_corpus_list(text_file)
+        else:
+            self.corpus_files = [text_file]
+
+        self.corpus_bytes = sum(os.path.getsize(f) for f in self.corpus_files)
+        self.arpa_memory = None
+        self.memory = None
+        self.counted = False
+
+        self.process = None
+        self.log_file = None
+        self.started = None
+
+
+    def estimate_memory(self, workers, count=True):
+        self.arpa_memory, self.counted = estimate_arpa_memory(self.corpus_files, workers=workers, count=count)
+        self.memory = self.arpa_memory + JOB_MEMORY_OVERHEAD
+
+
+    def stage(self):
+        return "scorer %s %s" % (os.path.abspath(self.output_dir), self.domain)
+
+
+    def start(self, build_script, arpa_memory):
+        Path(self.output_dir).mkdir(parents=True, exist_ok=True)
+        self.log_file = open(os.path.join(self.output_dir, "build_lm_scorer.%s.log" % self.domain), 'w', encoding='utf-8')
+        self.started = time.time()
+        self.process = subprocess.Popen([build_script,
+                                         "--text_file", self.text_file,
+                                         "--domain", self.domain,
+                                         "--output_dir", self.output_dir,
+                                         "--max_arpa_memory", "%dM" % (arpa_memory // (1024 * 1024))],
+                                        stdout=self.log_file, stderr=subprocess.STDOUT)
+
+
+    def poll(self):
+        returncode = self.process.poll()
+        if returncode is not None:
+            self.log_file.close()
+        return returncode
+
+
+def schedule(builds, build_script, memory_budget, max_parallel, on_finished, poll_interval=5):
+    """
+    Runs the builds, largest first, starting each one while the memory
+    estimates of those running plus its own fit within memory_budget and
+    fewer than max_parallel are running. A build that would not fit on its
+    own runs by itself, with lmplz given the whole budget.
+    """
+    pending = sorted(builds, key=lambda b: b.memory, reverse=True)
+    running = []
+    while len(pending) > 0 or len(running) > 0:
+        reserved = sum(b.memory for b in running)
+        for build in list(pending):
+            if len(running) >= max_parallel:
+                break
+            if reserved + build.memory > memory_budget and len(running) > 0:
+                continue
+
+            arpa_memory = min(build.arpa_memory, max(MIN_ARPA_MEMORY, memory_budget - JOB_MEMORY_OVERHEAD))
+            print ("Building %s (%.1f GB corpus, lmplz memory %.1f GB). %s running" % (build.scorer_file, build.corpus_bytes / GB, arpa_memory / GB, len(running) + 1))
+            build.start(build_script, arpa_memory)
+            pending.remove(build)
+            running.append(build)
+            reserved += build.memory
+
+        time.sleep(poll_interval)
+
+        for build in list(running):
+            returncode = build.poll()
+            if returncode is not None:
+                running.remove(build)
+                on_finished(build, returncode)
+
+
+def main(text_files, domain, output_dir, build_script, alphabet_file_path, memory_fraction, workers, force, dry_run, **args):
+
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    manifest = import_manifest(os.path.join(output_dir, "build_lm_scorers.json"))
+
+    builds = []
+    for text_file in text_files:
+        name = os.path.splitext(os.path.basename(text_file))[0]
+        build = scorer_build(text_file, domain, os.path.join(output_dir, name))
+        inputs = build.corpus_files + [alphabet_file_path, build_script]
+        if not force and manifest.stage_up_to_date(build.stage(), inputs, [build.scorer_file]):
+            print ("%s is up to date" % build.scorer_file)
+            continue
+        build.estimate_memory(os.cpu_count(), count=not dry_run)
+        builds.append(build)
+
+    memory_budget = int(available_memory() * memory_fraction)
+    if workers is None:
+        workers = max(1, os.cpu_count() // 2)
+
+    print ("%s scorers to build. Memory budget %.1f GB, at most %s at a time" % (len(builds), memory_budget / GB, workers))
+    if dry_run:
+        for build in sorted(builds, key=lambda b: b.memory, reverse=True):
+            print ("%s\t%.1f GB corpus\testimated %.1f GB (%s)" % (build.scorer_file, build.corpus_bytes / GB, build.memory / GB, "from counts" if build.counted else "from corpus size"))
+        return
+
+    failed = []
+    def on_finished(build, returncode):
+        if returncode == 0:
+            manifest.record_stage(build.stage(), build.corpus_files + [alphabet_file_path, build_script])
+            print ("Built %s in %.0f minutes" % (build.scorer_file, (time.time() - build.started) / 60))
+        else:
+            failed.append(build)
+            print ("FAILED %s. See %s" % (build.scorer_file, build.log_file.name))
+
+    schedule(builds, build_script, memory_budget, workers, on_finished)
+
+    if len(failed) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description=DESCRIPTION, formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument("--text_files", dest="text_files", nargs='+', required=True, help="corpus text files, or .list files of corpus text files, one scorer for each")
+    parser.add_argument("--domain", dest="domain", required=True, help="language model domain (e.g. 'macsen' or 'transcribe')")
+    parser.add_argument("--output_dir", dest="output_dir", required=True, help="each scorer is built in a subfolder named after its text file")
+    parser.add_argument("--build_script", dest="build_script", default=BUILD_LM_SCORER)
+    parser.add_argument("--alphabet", dest="alphabet_file_path", default=ALPHABET_FILE_PATH)
+    parser.add_argument("--memory_fraction", dest="memory_fraction", type=float, default=0.85, help="fraction of available memory that builds may use between them")
+    parser.add_argument("--workers", dest="workers", type=int, default=None, help="maximum number of builds at a time (default: half the number of cores)")
+    parser.add_argument("--force", dest="force", action="store_true", help="build all scorers, even those that are up to date")
+    parser.add_argument("--dry_run", dest="dry_run", action="store_true", help="only show what would be built, with memory estimated from counts already kept, or else from corpus size, without counting")
+
+    parser.set_defaults(func=main)
+    args = parser.parse_args()
+    args.func(**vars(args))
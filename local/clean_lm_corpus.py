@@ -5,27 +5,20 @@ import sys
 import re
 import pathlib 
 
-from utils.clean_transcript import clean_transcript
+from utils.corpus import clean_text_file
 
-from tqdm import tqdm
 from argparse import ArgumentParser, RawTextHelpFormatter
 
 DESCRIPTION = """
 
 """
 
-def main(source_text_file_path, output_text_file_path, alphabet_file_path, **args):
+def main(source_text_file_path, output_text_file_path, alphabet_file_path, workers, **args):
     
     source_text_file_extension = pathlib.Path(source_text_file_path).suffix
     ooa_text_file_path = source_text_file_path.replace(source_text_file_extension, ".ooa" + source_text_file_extension)
-    clean = clean_transcript(alphabet_file_path, ooa_text_file_path)
 
-    with open(output_text_file_path, 'w', encoding='utf-8') as out_file:
-        with open(source_text_file_path, 'r', encoding='utf-8') as in_file:
-            for i, transcript in enumerate(tqdm(in_file)):
-                cleaned, transcript = clean.clean(transcript)
-                if cleaned:
-                    out_file.write(transcript.lower() + "\n")
+    clean_text_file(source_text_file_path, output_text_file_path, alphabet_file_path, ooa_text_file_path, workers)
 
 
 if __name__ == "__main__":
@@ -33,6 +26,7 @@ if __name__ == "__main__":
     parser.add_argument("-s", dest="source_text_file_path", required=True, help="location of source text file")
     parser.add_argument("-o", dest="output_text_file_path", required=True, help="location of output text file")
     parser.add_argument("-a", dest="alphabet_file_path", default='/DeepSpeech/bin/bangor_welsh/alphabet.txt', help="location of alphabet file")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=1, help="number of processes cleaning shards of the source text file in parallel")
 
     parser.set_defaults(func=main)
     args = parser.parse_args()
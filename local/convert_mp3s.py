@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import csv
+import glob
+
+from utils.audio import convert_mp3_files
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+DESCRIPTION = """
+Trosi clipiau mp3 (e.e. o CommonVoice) i ffeiliau wav 16kHz mono yn baralel.
+Converts mp3 clips (e.g. from CommonVoice) to 16kHz mono wav files in parallel.
+
+Clips that already have a valid wav file are skipped, so an interrupted run
+can simply be started again. Clips that fail are listed in the report file.
+
+e.g.
+
+    convert_mp3s.py --clips_dir /data/commonvoice/clips --clips /data/commonvoice/validated.tsv --workers 48
+
+"""
+
+
+def read_clip_list(clips_file_path, clips_dir):
+    """
+    A clip list is either a CommonVoice tsv with a 'path' column, or a text
+    file with one mp3 file path per line. Relative paths are within clips_dir
+    """
+    with open(clips_file_path, 'r', encoding='utf-8') as clips_file:
+        if clips_file_path.endswith(".tsv"):
+            clips = [row['path'] for row in csv.DictReader(clips_file, delimiter='\t', quoting=csv.QUOTE_NONE)]
+        else:
+            clips = [line.strip() for line in clips_file if len(line.strip()) > 0]
+
+    mp3files = []
+    for clip in clips:
+        if not clip.endswith(".mp3"):
+            clip = clip + ".mp3"
+        mp3files.append(os.path.join(clips_dir, clip))
+
+    # the same clip may be listed in several splits
+    return sorted(set(mp3files))
+
+
+def main(clips_dir, clips_file_path, workers, failure_report_file_path, **args):
+
+    if clips_file_path:
+        mp3files = read_clip_list(clips_file_path, clips_dir)
+    else:
+        mp3files = sorted(glob.glob(os.path.join(clips_dir, "*.mp3")))
+
+    if failure_report_file_path is None:
+        failure_report_file_path = os.path.join(clips_dir, "convert_mp3s.failed.csv")
+
+    print ("Converting %s mp3 files with %s workers" % (len(mp3files), workers))
+    counts, failures = convert_mp3_files(mp3files, workers, failure_report_file_path)
+    if len(failures) > 0:
+        print ("Failed conversions listed in %s" % failure_report_file_path)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description=DESCRIPTION, formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument("--clips_dir", dest="clips_dir", required=True, help="directory containing the mp3 clips")
+    parser.add_argument("--clips", dest="clips_file_path", default=None, help="CommonVoice tsv or text file listing the clips to convert (default: all mp3 files in --clips_dir)")
+    parser.add_argument("--workers", dest="workers", type=int, default=os.cpu_count(), help="number of conversion processes")
+    parser.add_argument("--report", dest="failure_report_file_path", default=None, help="csv file listing failed conversions (default: convert_mp3s.failed.csv in --clips_dir)")
+
+    parser.set_defaults(func=main)
+    args = parser.parse_args()
+    args.func(**vars(args))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+
+from utils.lm_counts import ARPA_ORDER, TOP_K, SAMPLE_BITS, count_text_files, estimate_lm, physical_memory, text_file_paths, write_vocab
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+DESCRIPTION = """
+Cyfrif geiriau ac n-gramau corpws cyn adeiladu model iaith KenLM ohono.
+Counts the words and n-grams of a language model corpus before a KenLM model
+is built from it, in parallel shards, and writes
+
+    vocab-<top_k>.txt   the top_k most frequent words, as generate_lm.py
+                        would write them
+    lm_counts.json      numbers of n-grams of each order counted by lmplz,
+                        left after pruning and after filtering by the
+                        vocabulary, estimated sizes of lm.arpa,
+                        lm_filtered.arpa and lm.binary, and the memory for
+                        lmplz (as its --memory) to sort without using disk
+
+Distinct n-grams are estimated by counting exactly those whose hash falls in
+1 in 2^--sample_bits of the hash space. The counts of each corpus file are
+saved next to it (as <file>.lm_counts.pickle), so a corpus shared by many
+scorers (e.g. the base corpus of every k-fold) is only counted once.
+
+build_lm_scorer.sh runs this first, and builds with the vocabulary and
+memory estimate it gives.
+
+e.g.
+
+    count_lm_corpus.py --text_file /data/bangor/lm-data/oscar/corpus.clean.txt --output_dir /export/transcribe --workers 16
+
+"""
+
+
+def main(text_file_path, output_dir, top_k, order, sample_bits, workers, **args):
+
+    counts = count_text_files(text_file_paths(text_file_path), order, sample_bits, workers)
+    estimate = estimate_lm(counts, top_k, total_memory=physical_memory())
+
+    os.makedirs(output_dir, exist_ok=True)
+    vocab_file_path = write_vocab(counts.top_words(top_k), os.path.join(output_dir, "vocab-%s.txt" % top_k))
+
+    estimate_file_path = os.path.join(output_dir, "lm_counts.json")
+    with open(estimate_file_path, 'w', encoding='utf-8') as estimate_file:
+        json.dump(estimate, estimate_file, indent=2)
+
+    print ("%s lines, %s words, %s distinct" % (estimate['lines'], estimate['tokens'], estimate['words']))
+    print ("order\tcounted\tpruned\tfiltered")
+    for entry in estimate['ngrams']:
+        print ("%(order)s\t%(counted)s\t%(pruned)s\t%(filtered)s" % entry)
+    print ("lm.arpa %.1f MB, lm_filtered.arpa %.1f MB, lm.binary %.1f MB, lmplz memory %s" % (estimate['arpa_bytes'] / 1e6, estimate['filtered_arpa_bytes'] / 1e6, estimate['binary_bytes'] / 1e6, estimate['lmplz_memory']))
+    print ("Vocabulary in %s, estimates in %s" % (vocab_file_path, estimate_file_path))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=DESCRIPTION, formatter_class=RawTextHelpFormatter)
+    parser.add_argument("--text_file", dest="text_file_path", required=True, help="corpus text file, or .list of corpus text files")
+    parser.add_argument("--output_dir", dest="output_dir", required=True, help="directory for vocab-<top_k>.txt and lm_counts.json")
+    parser.add_argument("--top_k", dest="top_k", type=int, default=TOP_K, help="vocabulary size (default: %s)" % TOP_K)
+    parser.add_argument("--arpa_order", dest="order", type=int, default=ARPA_ORDER, help="order of the language model (default: %s)" % ARPA_ORDER)
+    parser.add_argument("--sample_bits", dest="sample_bits", type=int, default=SAMPLE_BITS, help="count 1 in 2^sample_bits distinct n-grams exactly, and estimate the rest from them. 0 counts them all (default: %s)" % SAMPLE_BITS)
+    parser.add_argument("--workers", dest="workers", type=int, default=os.cpu_count(), help="processes counting shards of the corpus in parallel")
+
+    parser.set_defaults(func=main)
+    args = parser.parse_args()
+    args.func(**vars(args))
@@ -101,7 +101,9 @@ echo "#### evaluating with transcriber testset                											   ###"
 echo "####################################################################################"
 set -x
 
-python -u /DeepSpeech/evaluate.py \
+# acoustic model outputs are cached, so evaluating the same checkpoint again
+# (e.g. with another scorer) only decodes
+python -u /DeepSpeech/bin/bangor_welsh/evaluate_scorers.py \
 	--test_files "${test_file}" \
 	--test_batch_size 1 \
 	--alphabet_config_path "${alphabet_file_path}" \
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Profi sawl model iaith yn erbyn set profi gydag un rhediad o'r model acwstig.
+Evaluates a checkpoint with several KenLM scorers against the same test sets,
+for the cost of one run of the acoustic model and one beam search decode per
+scorer.
+
+The acoustic model's outputs come from the logits cache, and are only
+computed for clips it has not seen with this checkpoint before. Each
+scorer's predictions are saved, as with evaluate.py's --test_output_file, in
+--output_dir (default: next to each test csv) as
+<test csv>.<scorer>.results.json, and the WER and CER of every scorer in
+<test csv>.scorers.tsv.
+
+e.g. (from /DeepSpeech)
+
+    python3 bin/bangor_welsh/evaluate_scorers.py \\
+        --test_files /data/bangor/testsets/data/trawsgrifio/deepspeech.csv \\
+        --load_checkpoint_dir /checkpoints/cy \\
+        --alphabet_config_path bin/bangor_welsh/alphabet.txt \\
+        --scorers /export/kfolds/corpus.train_1.union/kenlm.transcribe.scorer,/export/kenlm.transcribe.scorer
+"""
+import os
+import sys
+import json
+
+import absl.app
+import absl.flags
+import pandas as pd
+
+from deepspeech_training.util.config import initialize_globals
+from deepspeech_training.util.flags import create_flags, FLAGS
+
+from utils.logits import DEFAULT_CACHE_DIR, logits_cache, decode
+from utils.wer import error_counts, error_rates
+
+
+def define_flags():
+    f = absl.flags
+    f.DEFINE_list('scorers', [], 'comma separated scorer files to evaluate. Default: --scorer_path')
+    f.DEFINE_string('output_dir', '', 'directory to write results to. Default: the directory of each test csv')
+    f.DEFINE_string('logits_cache_dir', DEFAULT_CACHE_DIR, 'directory of the cache of acoustic model outputs')
+    f.DEFINE_integer('decode_workers', os.cpu_count(), 'number of processes decoding in parallel')
+
+
+def scorer_name(scorer_path):
+    name = os.path.basename(scorer_path)
+    if name.endswith(".scorer"):
+        name = name[:-len(".scorer")]
+    # kfold scorers are all kenlm.<domain>.scorer, in a folder per fold
+    return "%s.%s" % (os.path.basename(os.path.dirname(os.path.abspath(scorer_path))), name)
+
+
+def evaluate(wav_filenames, transcripts, probs, scorer, results_file_path):
+    predictions = decode(probs, scorer, FLAGS.beam_width, FLAGS.decode_workers, FLAGS.cutoff_prob, FLAGS.cutoff_top_n)
+
+    samples = pd.DataFrame({'wav_filename':wav_filenames, 'src':transcripts, 'res':predictions})
+    samples = error_rates(pd.concat([samples, error_counts(transcripts, predictions)], axis=1))
+    totals = samples[['word_distance', 'word_length', 'char_distance', 'char_length']].sum()
+
+    temp_file_path = results_file_path + ".tmp"
+    with open(temp_file_path, 'w', encoding='utf-8') as results_file:
+        json.dump(samples.to_dict(orient='records'), results_file, ensure_ascii=False, indent=2, default=int)
+    os.replace(temp_file_path, results_file_path)
+
+    return totals['word_distance'] / max(totals['word_length'], 1), totals['char_distance'] / max(totals['char_length'], 1)
+
+
+def main(_):
+    initialize_globals()
+
+    from ds_ctcdecoder import Scorer
+    from deepspeech_training.util.config import Config
+
+    scorer_paths = FLAGS.scorers or ([FLAGS.scorer_path] if FLAGS.scorer_path else [])
+    if not FLAGS.test_files or len(scorer_paths) == 0:
+        print ("--test_files and --scorers (or --scorer_path) are required")
+        sys.exit(1)
+
+    scorers = [(scorer_name(p), Scorer(FLAGS.lm_alpha, FLAGS.lm_beta, p, Config.alphabet)) for p in scorer_paths]
+    test_csvs = FLAGS.test_files.split(",")
+
+    with logits_cache(FLAGS.load_checkpoint_dir, FLAGS.logits_cache_dir) as cache:
+        for test_csv in test_csvs:
+            wav_filenames, transcripts, probs = cache.load(test_csv)
+
+            output_dir = FLAGS.output_dir or os.path.dirname(os.path.abspath(test_csv))
+            os.makedirs(output_dir, exist_ok=True)
+            test_name = os.path.splitext(os.path.basename(test_csv))[0]
+
+            with open(os.path.join(output_dir, "%s.scorers.tsv" % test_name), 'w', encoding='utf-8') as summary_file:
+                summary_file.write("scorer\tclips\twer\tcer\n")
+                for (name, scorer), scorer_path in zip(scorers, scorer_paths):
+                    if FLAGS.test_output_file and len(test_csvs) == 1 and len(scorers) == 1:
+                        results_file_path = FLAGS.test_output_file
+                    else:
+                        results_file_path = os.path.join(output_dir, "%s.%s.results.json" % (test_name, name))
+
+                    wer, cer = evaluate(wav_filenames, transcripts, probs, scorer, results_file_path)
+                    print ("%s with %s: WER %.4f, CER %.4f (%s clips). Results in %s" % (test_csv, scorer_path, wer, cer, len(probs), results_file_path))
+                    summary_file.write("%s\t%s\t%s\t%s\n" % (scorer_path, len(probs), wer, cer))
+                    summary_file.flush()
+
+
+if __name__ == '__main__':
+    create_flags()
+    define_flags()
+    absl.app.run(main)
@@ -3,8 +3,6 @@
 import os
 import csv
 import gzip
-import pandas
-import requests
 import json
 
 from enum import Enum
@@ -16,7 +14,6 @@ import functools
 from urllib.parse import urlparse
 
 from pathlib import Path
-from git import Repo
 
 import utils.kfold as kfold
 import utils.audio as audio
@@ -24,7 +21,7 @@ import utils.audio as audio
 from utils.clean_transcript import clean_transcript
 
 from utils.imports import import_textgrid, import_clips_dir, get_directory_structure
-from utils.corpus import clean_text_corpus, import_csv_textcorpus, join_corpus_files, get_macsen_textcorpus
+from utils.corpus import clean_text_corpus, clean_text_file, import_csv_textcorpus, join_corpus_files, get_macsen_textcorpus
 
 from argparse import ArgumentParser, RawTextHelpFormatter
 
@@ -45,32 +42,30 @@ MACSEN_TEXT_CORPUS_URL = "https://api.techiaith.org/assistant/get_all_sentences"
 
 
 def clone_bangor_testset(target_testset_dir):
+    from git import Repo
+
     Repo.clone_from(TESTSET_URL, target_testset_dir)
 
 
 def get_commonvoice_textcorpus(commonvoice_validated_csv_file_path, lm_data_root_dir):
     target_dir = os.path.join(lm_data_root_dir, 'commonvoice')
-    import_csv_textcorpus(commonvoice_validated_csv_file_path, target_dir)
+    return import_csv_textcorpus(commonvoice_validated_csv_file_path, target_dir)
 
 
 
-def get_oscar_textcorpus(oscar_archive_file_path, lm_data_root_dir):
+def get_oscar_textcorpus(oscar_archive_file_path, lm_data_root_dir, workers=1):
 
-    print ("Extracting: %s" % oscar_archive_file_path)
+    print ("Cleaning: %s" % oscar_archive_file_path)
 
     target_dir = os.path.join(lm_data_root_dir, 'oscar')
     Path(target_dir).mkdir(parents=True, exist_ok=True)
 
-    oscar_corpus_file_path = oscar_archive_file_path.replace('.gz','')
-    corpus_file_path = os.path.join(target_dir, "corpus.txt")
-
-    with gzip.open(oscar_archive_file_path, 'rb') as oscar_archive_file:
-        with open(oscar_corpus_file_path, 'wb') as oscar_file:
-            shutil.copyfileobj(oscar_archive_file, oscar_file)
-    
-    shutil.move(oscar_corpus_file_path, corpus_file_path)
+    # the archive (gzip, xz or zstd) is decompressed as a stream straight into
+    # the cleaner, without an uncompressed copy on disk
+    corpus_clean_file_path = os.path.join(target_dir, "corpus.clean.txt")
+    ooa_text_file_path = os.path.join(target_dir, "corpus.ooa.txt")
 
-    return clean_text_corpus(target_dir)
+    return clean_text_file(oscar_archive_file_path, corpus_clean_file_path, ALPHABET_FILE_PATH, ooa_text_file_path, workers)
 
 
 
@@ -106,12 +101,15 @@ def import_macsen_testset(target_testset_dir, **args):
                                 'wav_filesize':os.path.getsize(wavfilepath), 
                                 'transcript':transcript
                             })
+
+    clean.close()
                                                 
     kfold.create_kfolds(csv_file_path, target_testset_dir, 10)
    
 
 
-def main(bangor_target_root_dir, oscar_archive_file_path, commonvoice_root_dir, **args):
+def main(bangor_target_root_dir, oscar_archive_file_path, commonvoice_root_dir, workers, **args):
+    import pandas
 
     #
     target_testset_root_dir = os.path.join(bangor_target_root_dir, "testsets")
@@ -149,12 +147,12 @@ def main(bangor_target_root_dir, oscar_archive_file_path, commonvoice_root_dir,
 
     # language model for transcription made up of multiple text sources..
     corpus_files = []
-    corpus_files.append(get_oscar_textcorpus(oscar_archive_file_path, target_languagemodel_data_root_dir))
+    corpus_files.append(get_oscar_textcorpus(oscar_archive_file_path, target_languagemodel_data_root_dir, workers))
 
     commonvoice_validated_csv_file_path = os.path.join(commonvoice_root_dir, "validated.tsv")
     corpus_files.append(get_commonvoice_textcorpus(commonvoice_validated_csv_file_path, target_languagemodel_data_root_dir))
 
-    corpus_file_path = join_corpus_files(corpus_files, target_languagemodel_data_root_dir)
+    corpus_file_path = join_corpus_files(corpus_files, target_languagemodel_data_root_dir, "corpus.clean.txt", workers)
     print ("Transcription text corpus ready at %s " % corpus_file_path )
 
 
@@ -167,6 +165,7 @@ if __name__ == "__main__":
     parser.add_argument("--bangor_dir", dest="bangor_target_root_dir", default="/data/bangor")
     parser.add_argument("--oscar_archive", dest="oscar_archive_file_path", required=True)
     parser.add_argument("--cv_dir", dest="commonvoice_root_dir", required=True)
+    parser.add_argument("--workers", dest="workers", type=int, default=1, help="number of processes for cleaning text corpora")
 
     parser.set_defaults(func=main)
     args = parser.parse_args()
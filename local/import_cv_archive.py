@@ -2,42 +2,227 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
-import tarfile
+import csv
 import shlex
 import shutil
+import tarfile
 import subprocess
-import glob
+import multiprocessing
 
 from pathlib import Path
 from argparse import ArgumentParser, RawTextHelpFormatter
 
+from utils.audio import convert_mp3_file
+
 DESCRIPTION = """
+Echdynnu archif CommonVoice (e.e. cy.tar.gz) a'i baratoi ar gyfer DeepSpeech.
+Extracts a CommonVoice archive (e.g. cy.tar.gz) and prepares it for DeepSpeech
+with import_cv2.py.
+
+The archive is read once, as a stream, and each file written straight to
+--target_dir (tsv files) or --target_dir/clips (mp3 clips), whatever folders
+it is in within the archive. Only the tsv files of --splits, and the clips
+they list, are extracted. Clips that come in the archive before those tsv
+files are extracted anyway, and removed at the end if no split needs them.
+
+Every file extracted is recorded in import_cv_archive.progress in
+--target_dir, so a run that is killed can be started again and skips what
+was done (the archive is still decompressed from the start, but not written
+out again). With --workers, clips are converted to wav while extraction
+continues, and import_cv2.py then finds them already converted.
+
+e.g.
+
+    import_cv_archive.py --archive /data/commonvoice/cy.tar.gz --target_dir /data/commonvoice/ --workers 16
 
 """
 
+SPLITS = ['train', 'dev', 'test', 'validated', 'invalidated', 'other']
 
-def extract(source_tar_gz, target_dir):
+PROGRESS_FILE_NAME = "import_cv_archive.progress"
 
-    print ("Extracting: %s" % source_tar_gz)
 
-    tar = tarfile.open(source_tar_gz, "r:gz")
-    tar.extractall(target_dir)
-    tar.close()
-    
-    # files may exist in levels of subdirectories. Need to move them
-    # up to the target_dir
-    extracted_clips_path = glob.glob(os.path.join(target_dir,"**","clips"), recursive=True)
-    if len(extracted_clips_path) > 0:
-        extracted_clips_parent_path = str(Path(extracted_clips_path[0]).parent)
-        for file_path in glob.glob(extracted_clips_parent_path + "/*"):
-            print ("Moving from %s to %s " % (file_path, target_dir)) 
-            shutil.move(file_path, target_dir)
+def member_target_path(member_name):
+    """
+    Where a member of the archive goes, relative to the target directory.
+    Clips go in clips/ and everything else at the top, so the archive's own
+    folders (e.g. cv-corpus-5.1-2020-06-22/cy/) are dropped.
+    """
+    parts = Path(member_name).parts
+    if len(parts) > 1 and parts[-2] == "clips":
+        return os.path.join("clips", parts[-1])
+    return parts[-1]
+
+
+def split_name(target_path):
+    name, extension = os.path.splitext(target_path)
+    if extension == ".tsv" and os.path.dirname(target_path) == "":
+        return name
+    return None
+
+
+def read_split_clips(tsv_file_path):
+    with open(tsv_file_path, 'r', encoding='utf-8') as tsv_file:
+        clips = [row['path'] for row in csv.DictReader(tsv_file, delimiter='\t', quoting=csv.QUOTE_NONE)]
+    return set(c if c.endswith(".mp3") else c + ".mp3" for c in clips)
+
+
+class extraction_progress(object):
+    """
+    Log of the members extracted from an archive, one per line after a
+    header that identifies the archive and splits. A log for another archive,
+    or for other splits, is started afresh.
+    """
+
+    def __init__(self, progress_file_path, archive_file_path, splits):
+        stat = os.stat(archive_file_path)
+        self.header = "%s\t%s\t%s\t%s" % (os.path.abspath(archive_file_path), stat.st_size, stat.st_mtime_ns, ",".join(splits))
+        self.done = dict()
+
+        if os.path.isfile(progress_file_path):
+            with open(progress_file_path, 'r', encoding='utf-8') as progress_file:
+                if progress_file.readline().rstrip("\n") == self.header:
+                    for line in progress_file:
+                        fields = line.rstrip("\n").split("\t")
+                        if len(fields) == 2:
+                            self.done[fields[0]] = int(fields[1])
 
+        resumed = len(self.done) > 0
+        self.progress_file = open(progress_file_path, 'a' if resumed else 'w', encoding='utf-8')
+        if not resumed:
+            self.progress_file.write(self.header + "\n")
 
-def main(cv_archive_file_path, cv_root_dir, **args):
 
-    extract(cv_archive_file_path, cv_root_dir)
-    
+    def close(self):
+        self.progress_file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def is_done(self, target_path, file_path, size):
+        return self.done.get(target_path) == size and os.path.isfile(file_path) and os.path.getsize(file_path) == size
+
+
+    def record(self, target_path, size):
+        self.done[target_path] = size
+        self.progress_file.write("%s\t%s\n" % (target_path, size))
+        # flushed every so often, rather than on every clip
+        if len(self.done) % 1000 == 0:
+            self.progress_file.flush()
+
+
+def extract_member(tar, member, file_path):
+    temp_file_path = file_path + ".partial"
+    with tar.extractfile(member) as member_file, open(temp_file_path, 'wb') as out_file:
+        shutil.copyfileobj(member_file, out_file, 1024 * 1024)
+    os.replace(temp_file_path, file_path)
+
+
+def extract(source_tar_gz, target_dir, splits=SPLITS, workers=0):
+    """
+    Streams source_tar_gz into target_dir, as described above. Returns the
+    clips that failed to convert, as (mp3 file, error).
+    """
+    print ("Extracting: %s" % source_tar_gz)
+
+    clips_dir = os.path.join(target_dir, "clips")
+    Path(clips_dir).mkdir(parents=True, exist_ok=True)
+
+    split_clips = dict()
+    unconfirmed = []
+    counts = { 'extracted' : 0, 'resumed' : 0, 'not needed' : 0 }
+
+    pool = multiprocessing.Pool(workers) if workers > 0 else None
+    conversions = []
+
+    with extraction_progress(os.path.join(target_dir, PROGRESS_FILE_NAME), source_tar_gz, splits) as progress, \
+         tarfile.open(source_tar_gz, "r|gz") as tar:
+
+        # when resuming, the tsvs already extracted filter clips from the start
+        for split in splits:
+            file_path = os.path.join(target_dir, split + ".tsv")
+            if progress.is_done(split + ".tsv", file_path, progress.done.get(split + ".tsv")):
+                split_clips[split] = read_split_clips(file_path)
+
+        for member in tar:
+            if not member.isfile():
+                continue
+
+            target_path = member_target_path(member.name)
+            file_path = os.path.join(target_dir, target_path)
+            split = split_name(target_path)
+            is_clip = target_path.startswith("clips" + os.sep)
+
+            if split in SPLITS and split not in splits:
+                counts['not needed'] += 1
+                continue
+
+            # once the tsvs of all the splits have been seen, only their clips are needed
+            if is_clip and set(split_clips) == set(splits):
+                if not any(os.path.basename(target_path) in clips for clips in split_clips.values()):
+                    counts['not needed'] += 1
+                    continue
+            elif is_clip:
+                unconfirmed.append(target_path)
+
+            if progress.is_done(target_path, file_path, member.size):
+                counts['resumed'] += 1
+            else:
+                extract_member(tar, member, file_path)
+                progress.record(target_path, member.size)
+                counts['extracted'] += 1
+
+            if split in splits:
+                split_clips[split] = read_split_clips(file_path)
+
+            if pool is not None and is_clip and file_path.endswith(".mp3"):
+                conversions.append(pool.apply_async(convert_mp3_file, (file_path,)))
+
+            if (counts['extracted'] + counts['resumed']) % 10000 == 0:
+                print ("%(extracted)s extracted, %(resumed)s already extracted, %(not needed)s not needed" % counts)
+
+    failures = []
+    if pool is not None:
+        print ("Waiting for %s conversions to wav" % len(conversions))
+        for conversion in conversions:
+            mp3file, status, error = conversion.get()
+            if status == 'failed':
+                failures.append((mp3file, error))
+        pool.close()
+        pool.join()
+        print ("%s clips converted to wav, %s failed" % (len(conversions) - len(failures), len(failures)))
+
+    # clips from before the tsvs that turned out not to be needed
+    if len(split_clips) > 0:
+        needed = set.union(*split_clips.values())
+        removed = set()
+        for target_path in unconfirmed:
+            if os.path.basename(target_path) not in needed:
+                file_path = os.path.join(target_dir, target_path)
+                for f in [file_path, os.path.splitext(file_path)[0] + ".wav"]:
+                    if os.path.isfile(f):
+                        os.remove(f)
+                removed.add(file_path)
+        counts['not needed'] += len(removed)
+        failures = [(mp3file, error) for mp3file, error in failures if mp3file not in removed]
+
+    print ("%(extracted)s extracted, %(resumed)s already extracted, %(not needed)s not needed" % counts)
+
+    return failures
+
+
+def main(cv_archive_file_path, cv_root_dir, splits, workers, **args):
+
+    failures = extract(cv_archive_file_path, cv_root_dir, splits.split(","), workers)
+    for mp3file, error in failures:
+        print ("Failed to convert %s: %s" % (mp3file, error))
+
     #
     print ("Preparing for DeepSpeech with import_cv2.py")
     cmd = "python3 /DeepSpeech/bin/import_cv2.py %s --validate_label_locale /DeepSpeech/bin/bangor_welsh/utils/validate_label_locale.py" % (cv_root_dir)
@@ -47,13 +232,15 @@ def main(cv_archive_file_path, cv_root_dir, **args):
 
 
 
-if __name__ == "__main__": 
+if __name__ == "__main__":
 
-    parser = ArgumentParser(description=DESCRIPTION, formatter_class=RawTextHelpFormatter) 
+    parser = ArgumentParser(description=DESCRIPTION, formatter_class=RawTextHelpFormatter)
 
     parser.add_argument("--archive", dest="cv_archive_file_path", required=True, help="path to downloaded tar.gz containing speech corpus in CommonVoice v2.0 format")
     parser.add_argument("--target_dir", dest="cv_root_dir", required=True, help="target directory for extracted archive, also root directory for training data")
-   
+    parser.add_argument("--splits", dest="splits", default=",".join(SPLITS), help="comma separated splits to extract (default: %s)" % ",".join(SPLITS))
+    parser.add_argument("--workers", dest="workers", type=int, default=0, help="processes converting clips to wav during extraction (default: 0, leave it to import_cv2.py)")
+
     parser.set_defaults(func=main)
     args = parser.parse_args()
     args.func(**vars(args))
@@ -1,48 +1,83 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
-import pandas
+import hashlib
 import functools
 
 from pathlib import Path
 
 from utils.imports import import_textgrid, import_srt
-from utils.corpus import import_csv_textcorpus, join_corpus_files
+from utils.corpus import import_csv_textcorpus, join_corpus_files, link_corpus_files
 from utils.kfold import create_kfolds
+from utils.manifest import import_manifest
 
 from argparse import ArgumentParser, RawTextHelpFormatter
 
 DESCRIPTION = """
 Paratoi adnoddau ychwanegol ar gyfer hyfforddi rhagor.
 
+Only sources that are new or have changed since the last run (as recorded in
+import_manifest.json in the target folder) are imported again. The language
+model corpus and k-folds are only rebuilt when deepspeech.csv (or, for the
+k-folds, how they are made) has changed.
+
 © Prifysgol Bangor University
 
 """
-def create_kfolds_and_lm_data(bangor_data_root_dir, csv_file_path, target_kfolds_dir):
-    create_kfolds(csv_file_path, target_kfolds_dir, 10)
+
+# how the k-folds are made, recorded in the manifest so that folds made
+# otherwise (e.g. before they were grouped by source) are made again
+KFOLD_PARAMETERS = {'k':10, 'group_by':'source', 'balance_duration':True, 'seed':2}
+
+
+def source_groups(source_csv_files):
+    import pandas
+
+    # clips cut from the same recording (usually the same speakers) are kept
+    # within one fold, so they are never tested on with a model trained on them
+    groups = dict()
+    for source_csv in source_csv_files:
+        for wav_filename in pandas.read_csv(source_csv, encoding='utf-8', usecols=['wav_filename'])['wav_filename']:
+            groups[wav_filename] = source_csv
+    return groups
+
+
+def create_kfolds_and_lm_data(bangor_data_root_dir, csv_file_path, target_kfolds_dir, source_csv_files):
+    create_kfolds(csv_file_path, target_kfolds_dir, KFOLD_PARAMETERS['k'], group_by=source_groups(source_csv_files), balance_duration=KFOLD_PARAMETERS['balance_duration'], seed=KFOLD_PARAMETERS['seed'])
 
     target_languagemodel_data_root_dir = os.path.join(target_kfolds_dir, "lm-data")
     Path(target_languagemodel_data_root_dir).mkdir(parents=True, exist_ok=True)
 
+    # each fold's language model corpus is the (large) base corpus plus the
+    # fold's transcripts. The base corpus is not copied for every fold. Only
+    # the fold's transcripts are written, alongside a .list of the two files
+    # that build_lm_scorer.sh streams from.
     base_text_corpus_file_path = os.path.join(bangor_data_root_dir, "lm-data", "corpus.clean.txt")
     for kfold_csv in os.listdir(target_kfolds_dir):
         if kfold_csv.startswith("train_"):
+            kfold_name = kfold_csv.replace(".csv","")
             corpus_files = []
-            corpus_files.append(import_csv_textcorpus(os.path.join(target_kfolds_dir, kfold_csv), target_languagemodel_data_root_dir))
+            corpus_files.append(import_csv_textcorpus(os.path.join(target_kfolds_dir, kfold_csv), target_languagemodel_data_root_dir, "corpus.%s" % kfold_name))
             corpus_files.append(base_text_corpus_file_path)
-            corpus_file_path = join_corpus_files(corpus_files, target_languagemodel_data_root_dir, "corpus.%s.union.clean.txt" % kfold_csv.replace(".csv",""))
-            print ("lm-data for kfold %s created in %s" % (kfold_csv, corpus_file_path))
+            corpus_list_file_path = link_corpus_files(corpus_files, target_languagemodel_data_root_dir, "corpus.%s.union.list" % kfold_name)
+            print ("lm-data for kfold %s listed in %s" % (kfold_csv, corpus_list_file_path))
 
 
-def main(bangor_data_root_dir, finetune_data_file, target_finetuning_root_dir, **args):
+def source_csv_file_path(target_finetuning_root_dir, source_file_path):
+    source_id = hashlib.sha1(os.path.abspath(source_file_path).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(target_finetuning_root_dir, "sources", "%s.%s.csv" % (os.path.basename(source_file_path), source_id))
 
-    target_languagemodel_data_root_dir = os.path.join(target_finetuning_root_dir, "lm-data")
-    Path(target_languagemodel_data_root_dir).mkdir(parents=True, exist_ok=True)
 
-    target_csv_file_path = os.path.join(target_finetuning_root_dir, "deepspeech.csv")
-    
-    #
-    transcribed_clips = []
+def import_sources(manifest, finetune_data_file, target_finetuning_root_dir, target_csv_file_path, workers):
+    """
+    Imports each TextGrid/srt source listed in finetune_data_file into its
+    own csv, unless it (and its wav file) are unchanged since the last run.
+    Returns the csv files of all sources, in list order.
+    """
+    Path(os.path.join(target_finetuning_root_dir, "sources")).mkdir(parents=True, exist_ok=True)
+
+    sources = []
+    source_csv_files = []
     with open(finetune_data_file, 'r', encoding='utf-8') as finetune_files:
         for finetune_file_path in finetune_files:            
             if finetune_file_path.startswith("#"):
@@ -53,22 +88,90 @@ def main(bangor_data_root_dir, finetune_data_file, target_finetuning_root_dir, *
                 continue
             
             if finetune_file_path.endswith(".TextGrid"):
-                transcribed_clips.append(import_textgrid(target_csv_file_path, finetune_file_path))
+                import_source = import_textgrid
+                wav_file_path = finetune_file_path.replace(".TextGrid", ".wav")
             elif finetune_file_path.endswith(".srt"):
-                transcribed_clips.append(import_srt(target_csv_file_path, finetune_file_path))
+                import_source = import_srt
+                wav_file_path = finetune_file_path.replace(".srt", ".wav")
+            else:
+                continue
+
+            source = os.path.abspath(finetune_file_path)
+            sources.append(source)
+
+            outputs = manifest.source_outputs(source, [finetune_file_path, wav_file_path])
+            if outputs is None:
+                source_csv = source_csv_file_path(target_finetuning_root_dir, finetune_file_path)
+                import_source(target_csv_file_path, finetune_file_path, workers).to_csv(source_csv, index=False)
+                manifest.record_source(source, [finetune_file_path, wav_file_path], [source_csv])
+                manifest.save()
+                outputs = [source_csv]
+            else:
+                print ("%s unchanged since last import" % finetune_file_path)
+
+            source_csv_files.append(outputs[0])
+
+    manifest.forget_sources(sources)
+    return source_csv_files
+
+
+def join_source_csvs(manifest, source_csv_files, target_csv_file_path):
+    """
+    deepspeech.csv is the concatenation of the sources' csv files. When
+    sources have only been added since it was last written, their rows are
+    appended to it; otherwise it is written again.
+    """
+    import pandas
+
+    new_source_csv_files = manifest.appendable_parts(target_csv_file_path, source_csv_files)
+    if new_source_csv_files is None:
+        print ("Writing %s" % target_csv_file_path)
+        df_transcribed_clips = pandas.concat([pandas.read_csv(f, encoding='utf-8', dtype={'transcript':str}) for f in source_csv_files])
+        df_transcribed_clips.to_csv(target_csv_file_path, index=False)
+    elif len(new_source_csv_files) > 0:
+        print ("Appending %s sources to %s" % (len(new_source_csv_files), target_csv_file_path))
+        df_transcribed_clips = pandas.concat([pandas.read_csv(f, encoding='utf-8', dtype={'transcript':str}) for f in new_source_csv_files])
+        df_transcribed_clips.to_csv(target_csv_file_path, index=False, header=False, mode='a')
+
+    manifest.record_joined(target_csv_file_path, source_csv_files)
+
+
+def main(bangor_data_root_dir, finetune_data_file, target_finetuning_root_dir, workers, force, **args):
+
+    target_languagemodel_data_root_dir = os.path.join(target_finetuning_root_dir, "lm-data")
+    Path(target_languagemodel_data_root_dir).mkdir(parents=True, exist_ok=True)
+
+    target_csv_file_path = os.path.join(target_finetuning_root_dir, "deepspeech.csv")
     
-    df_transcribed_clips = pandas.concat(transcribed_clips)
-    df_transcribed_clips.to_csv(target_csv_file_path, index=False)
+    manifest_file_path = os.path.join(target_finetuning_root_dir, "import_manifest.json")
+    if force and os.path.isfile(manifest_file_path):
+        os.remove(manifest_file_path)
+    manifest = import_manifest(manifest_file_path)
+
+    #
+    source_csv_files = import_sources(manifest, finetune_data_file, target_finetuning_root_dir, target_csv_file_path, workers)
+    join_source_csvs(manifest, source_csv_files, target_csv_file_path)
     
     # collect transcriptions into additions for fine tune training a language model
     base_text_corpus_file_path = os.path.join(bangor_data_root_dir, "lm-data", "corpus.clean.txt")
-    corpus_files = []   
-    corpus_files.append(import_csv_textcorpus(target_csv_file_path, target_languagemodel_data_root_dir))
-    corpus_files.append(base_text_corpus_file_path)
-    corpus_file_path = join_corpus_files(corpus_files, target_languagemodel_data_root_dir, "corpus.union.clean.txt")
+    corpus_file_path = os.path.join(target_languagemodel_data_root_dir, "corpus.union.clean.txt")
+    if manifest.stage_up_to_date("lm-data", [target_csv_file_path, base_text_corpus_file_path], [corpus_file_path]):
+        print ("Corpus for fine tuning language model is up to date")
+    else:
+        corpus_files = []   
+        corpus_files.append(import_csv_textcorpus(target_csv_file_path, target_languagemodel_data_root_dir))
+        corpus_files.append(base_text_corpus_file_path)
+        corpus_file_path = join_corpus_files(corpus_files, target_languagemodel_data_root_dir, "corpus.union.clean.txt")
+        manifest.record_stage("lm-data", [target_csv_file_path, base_text_corpus_file_path])
 
     # create k-folds for determining new WER from fine tuned data. 
-    create_kfolds_and_lm_data(bangor_data_root_dir, target_csv_file_path, os.path.join(target_finetuning_root_dir, "kfolds"))
+    target_kfolds_dir = os.path.join(target_finetuning_root_dir, "kfolds")
+    kfold_files = [os.path.join(target_kfolds_dir, "%s_%s.csv" % (split, k)) for split in ["train", "test"] for k in range(1, KFOLD_PARAMETERS['k'] + 1)]
+    if manifest.stage_up_to_date("kfolds", [target_csv_file_path, base_text_corpus_file_path], kfold_files, KFOLD_PARAMETERS):
+        print ("k-folds in %s are up to date" % target_kfolds_dir)
+    else:
+        create_kfolds_and_lm_data(bangor_data_root_dir, target_csv_file_path, target_kfolds_dir, source_csv_files)
+        manifest.record_stage("kfolds", [target_csv_file_path, base_text_corpus_file_path], KFOLD_PARAMETERS)
 
     #
     print ("Import fine tuning data to %s finished." % (target_finetuning_root_dir))
@@ -82,6 +185,8 @@ if __name__ == "__main__":
     parser.add_argument("--bangor_dir", dest="bangor_data_root_dir", default="/data/bangor")
     parser.add_argument("--target_dir", dest="target_finetuning_root_dir", help="target folder for all finetuning resources. should have an accompanying wav file (of the same name but with .wav extension)", default="/data/finetuning")
     parser.add_argument("--finetuning_data_file", dest="finetune_data_file", help="File containing paths (one per line) to srt and/or TextGrid files", required=True)
+    parser.add_argument("--force", dest="force", action="store_true", help="import all sources and rebuild everything, rather than only what has changed since the last run")
+    parser.add_argument("--workers", dest="workers", type=int, default=8, help="number of threads writing clips")
     # parser.add_argument("-c", dest="base_text_corpus_file_path", help=" file path to a text corpus that will be fined tuned e.g. OSCAR corpus", required=True)
     
     parser.set_defaults(func=main)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Optimeiddio paramedrau alpha a beta model iaith KenLM heb ymyrraeth.
+Finds the best alpha and beta for a KenLM scorer without any interaction,
+and saves them as optimal_alpha.<domain>.txt and optimal_beta.<domain>.txt
+in --output_dir for build_lm_scorer.sh to package with the scorer.
+
+Unlike DeepSpeech's lm_optimizer.py, the acoustic model is run over the test
+set only once, and its outputs kept in the logits cache so that later runs
+with the same checkpoint and clips skip it too. Each trial is then only a
+beam search decode, spread over --decode_workers processes. Trials are a
+grid of --grid_size x --grid_size values between 0 and --lm_alpha_max /
+--lm_beta_max, pruned by successive halving: all of them are scored on a
+small sample of the test set, and only the best 1/--halving_rate go on to a
+sample --halving_rate times larger, until the survivors are scored on the
+whole test set.
+
+e.g. (from /DeepSpeech)
+
+    python3 bin/bangor_welsh/optimize_lm_scorer.py \\
+        --test_files /data/bangor/testsets/data/trawsgrifio/deepspeech.csv \\
+        --checkpoint_dir /checkpoints/cy \\
+        --alphabet_config_path bin/bangor_welsh/alphabet.txt \\
+        --scorer_path /export/kenlm.transcribe.scorer \\
+        --domain transcribe --output_dir /export
+"""
+import os
+import sys
+import math
+
+import absl.app
+import absl.flags
+import numpy as np
+
+from deepspeech_training.util.config import initialize_globals
+from deepspeech_training.util.flags import create_flags, FLAGS
+
+from utils.logits import DEFAULT_CACHE_DIR, load_logits, decode
+from utils.wer import word_error_rate
+
+
+def define_flags():
+    f = absl.flags
+    f.DEFINE_string('domain', '', 'language model domain (e.g. macsen or transcribe). Names the optimal_alpha/beta files')
+    f.DEFINE_string('output_dir', '.', 'directory to write optimal_alpha.<domain>.txt and optimal_beta.<domain>.txt to')
+    f.DEFINE_string('logits_cache_dir', DEFAULT_CACHE_DIR, 'directory of the cache of acoustic model outputs')
+    f.DEFINE_integer('grid_size', 10, 'number of alpha values, and of beta values, to try')
+    f.DEFINE_integer('decode_workers', os.cpu_count(), 'number of processes decoding in parallel')
+    f.DEFINE_integer('halving_rate', 3, 'keep the best 1/halving_rate of trials at each round of successive halving')
+    f.DEFINE_integer('min_clips', 100, 'number of clips in the first round of successive halving')
+    f.DEFINE_integer('seed', 2, 'seed for sampling clips for each round')
+
+
+def trial_grid():
+    alphas = np.linspace(0.0, FLAGS.lm_alpha_max, FLAGS.grid_size)
+    betas = np.linspace(0.0, FLAGS.lm_beta_max, FLAGS.grid_size)
+    return [(float(alpha), float(beta)) for alpha in alphas for beta in betas]
+
+
+def score_trials(trials, scorer, transcripts, probs):
+    scores = []
+    for alpha, beta in trials:
+        scorer.reset_params(alpha, beta)
+        predictions = decode(probs, scorer, FLAGS.beam_width, FLAGS.decode_workers, FLAGS.cutoff_prob, FLAGS.cutoff_top_n)
+        scores.append(word_error_rate(transcripts, predictions))
+    return scores
+
+
+def successive_halving(trials, scorer, transcripts, probs, results_file):
+    order = np.random.RandomState(FLAGS.seed).permutation(len(probs))
+
+    num_clips = min(FLAGS.min_clips, len(probs))
+    round_num = 0
+    while True:
+        round_num += 1
+        sample = order[:num_clips]
+        print ("Round %s: %s trials on %s clips" % (round_num, len(trials), num_clips))
+
+        scores = score_trials(trials, scorer, [transcripts[i] for i in sample], [probs[i] for i in sample])
+        for (alpha, beta), wer in zip(trials, scores):
+            results_file.write("%s\t%s\t%s\t%s\t%s\n" % (round_num, num_clips, alpha, beta, wer))
+        results_file.flush()
+
+        ranked = sorted(zip(scores, trials))
+        if num_clips == len(probs) or len(trials) == 1:
+            return ranked[0]
+
+        trials = [trial for wer, trial in ranked[:max(1, math.ceil(len(trials) / FLAGS.halving_rate))]]
+        num_clips = min(num_clips * FLAGS.halving_rate, len(probs))
+
+
+def main(_):
+    initialize_globals()
+
+    from ds_ctcdecoder import Scorer
+    from deepspeech_training.util.config import Config
+
+    if not FLAGS.test_files or not FLAGS.scorer_path or not FLAGS.domain:
+        print ("--test_files, --scorer_path and --domain are required")
+        sys.exit(1)
+
+    test_csv = FLAGS.test_files.split(",")[0]
+    wav_filenames, transcripts, probs = load_logits(test_csv, FLAGS.load_checkpoint_dir, FLAGS.logits_cache_dir)
+
+    scorer = Scorer(FLAGS.lm_alpha, FLAGS.lm_beta, FLAGS.scorer_path, Config.alphabet)
+
+    os.makedirs(FLAGS.output_dir, exist_ok=True)
+    results_file_path = os.path.join(FLAGS.output_dir, "optimize_lm_scorer.%s.tsv" % FLAGS.domain)
+    with open(results_file_path, 'w', encoding='utf-8') as results_file:
+        results_file.write("round\tclips\talpha\tbeta\twer\n")
+        wer, (alpha, beta) = successive_halving(trial_grid(), scorer, transcripts, probs, results_file)
+
+    print ("Best params: lm_alpha=%s and lm_beta=%s with WER=%s" % (alpha, beta, wer))
+
+    with open(os.path.join(FLAGS.output_dir, "optimal_alpha.%s.txt" % FLAGS.domain), 'w', encoding='utf-8') as alpha_file:
+        alpha_file.write("%s\n" % alpha)
+    with open(os.path.join(FLAGS.output_dir, "optimal_beta.%s.txt" % FLAGS.domain), 'w', encoding='utf-8') as beta_file:
+        beta_file.write("%s\n" % beta)
+
+    print ("Saved to %s. Run build_lm_scorer.sh once more to package them with the scorer" % FLAGS.output_dir)
+
+
+if __name__ == '__main__':
+    create_flags()
+    define_flags()
+    absl.app.run(main)
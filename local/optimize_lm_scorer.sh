@@ -24,8 +24,8 @@ lm_domain=''
 test_file=''
 checkpoint_cy_dir=''
 
-SHORT=hd:c:p
-LONG=help,domain:,csv_test_file:,checkpoint_dir
+SHORT=hd:c:p:
+LONG=help,domain:,csv_test_file:,checkpoint_dir:
 
 # read options
 OPTS=$(getopt --options $SHORT --long $LONG --name "$0" -- "$@")
@@ -43,7 +43,7 @@ while true ; do
       lm_domain="$2"
       shift 2
       ;;
-    -t | --csv_test_file )
+    -c | --csv_test_file )
       test_file="$2"
       shift 2
       ;;
@@ -101,28 +101,15 @@ cd ${output_dir}
 export PYTHONIOENCODING=utf-8	
 
 echo "####################################################################################"
-echo "#### Determine optimal alpha and beta parameters                                ####"
+echo "#### Determine and save optimal alpha and beta parameters                       ####"
+echo "#### run build_lm_scorer.sh once more afterwards                                ####"
 echo "####################################################################################"
-python /DeepSpeech/lm_optimizer.py \
+python /DeepSpeech/bin/bangor_welsh/optimize_lm_scorer.py \
   --test_files ${test_file} \
   --checkpoint_dir ${checkpoint_cy_dir} \
   --alphabet_config_path ${alphabet_file_path} \
-  --scorer kenlm.${lm_domain}.scorer
-
-
-echo "####################################################################################"
-echo "#### Input required....                                                         ####"
-echo "####################################################################################"
-read -p "Enter best default alpha: " alpha
-read -p "Enter best default beta: " beta
-
-
-echo "####################################################################################"
-echo "#### saving optimal alpha and beta values. run build_lm_scorer.sh once more     ####"
-echo "####################################################################################"
-default_alpha_file="${output_dir}/optimal_alpha.${lm_domain}.txt"
-default_beta_file="${output_dir}/optimal_beta.${lm_domain}.txt"
-echo ${alpha} > ${default_alpha_file}
-echo ${beta} > ${default_beta_file}
+  --scorer_path kenlm.${lm_domain}.scorer \
+  --domain ${lm_domain} \
+  --output_dir ${output_dir}
 
 cd -
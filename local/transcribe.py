@@ -9,11 +9,11 @@ import subprocess
 import glob
 
 import json
-import srt
-from datetime import timedelta
 
-from praatio import tgio
 from utils.audio import downsample_wavfile
+from utils.transcription import deepspeech_model, stub_model, transcriber, write_textgrid, write_srt, request_transcription
+from utils.transcription import find_wavfiles, read_manifest, outputs_up_to_date, transcribe_batch
+from utils.transcription import serve as transcription_server
 
 from utils.clean_transcript import clean_transcript
 from argparse import ArgumentParser, RawTextHelpFormatter
@@ -25,6 +25,7 @@ ALPHABET_FILE_PATH = "/DeepSpeech/bin/bangor_welsh/alphabet.txt"
 TECHIAITH_RELEASE = os.environ['TECHIAITH_RELEASE']
 CHECKPOINTS_DIR = "/checkpoints/cy"
 LANGUAGE_MODEL = "/models/techiaith/techiaith_bangor_transcribe_%s.scorer" % TECHIAITH_RELEASE
+ACOUSTIC_MODEL = "/models/techiaith/techiaith_bangor_%s.pbmm" % TECHIAITH_RELEASE
 
 
 def convert_json_to_textgrid(wav_file_path, transcript_file_path):
@@ -32,40 +33,21 @@ def convert_json_to_textgrid(wav_file_path, transcript_file_path):
     textgrid_file_path = transcript_file_path.replace(".tlog",".TextGrid")    
 
     with open(transcript_file_path) as json_file:        
-        textgrid_entries_list = []
-        json_data = json.load(json_file)
-        for transcript in json_data:
-            start_seconds = float(transcript["start"] / 1000)
-            end_seconds = float(transcript["end"] / 1000)
-            textgrid_entry = (start_seconds,end_seconds, transcript["transcript"])
-            textgrid_entries_list.append(textgrid_entry)
-            
-        utterance_tier = tgio.IntervalTier('utterance', textgrid_entries_list, 0, pairedWav=wav_file_path)
-        tg = tgio.Textgrid()
-        tg.addTier(utterance_tier)
-        tg.save(textgrid_file_path, useShortForm=False, outputFormat='textgrid')
-
-        print ("Textgrid of transcription saved to %s" % textgrid_file_path)
+        write_textgrid(wav_file_path, json.load(json_file), textgrid_file_path)
+
+    print ("Textgrid of transcription saved to %s" % textgrid_file_path)
 
 
 def convert_json_to_srt(transcript_file_path):
     srt_file_path = transcript_file_path.replace(".tlog",".srt")
-    srt_segments = []
     with open(transcript_file_path) as json_file:
-        json_data = json.load(json_file)
-        i=1;
-        for transcript in json_data:
-            start_seconds = float(transcript["start"] / 1000)
-            end_seconds = float(transcript["end"] / 1000)
-            start_delta=timedelta(seconds=start_seconds)
-            end_delta=timedelta(seconds=end_seconds)
-            srt_segments.append(srt.Subtitle(i, start=start_delta, end=end_delta, content=transcript["transcript"]))
+        write_srt(json.load(json_file), srt_file_path)
 
-    str_string = srt.compose(srt_segments)
-    with open(srt_file_path, 'w', encoding='utf-8') as srt_file:
-        srt_file.write(str_string)
 
-    #print(str_string)
+def load_model(model_file_path, scorer_file_path, stub, **args):
+    if stub:
+        return stub_model()
+    return deepspeech_model(model_file_path, scorer_file_path)
 
 
 def copy_checkpoint():
@@ -87,7 +69,7 @@ def ensure_checkpoint():
         copy_checkpoint()
 
 
-def main(wav_file_path, **args):
+def transcribe_with_subprocess(wav_file_path):
 
     cmd = "python3 /DeepSpeech/transcribe.py --src %s --checkpoint_dir %s --alphabet_config_path %s --scorer %s --vad_aggressiveness 0 --force"
     cmd = cmd % (wav_file_path, CHECKPOINTS_DIR, ALPHABET_FILE_PATH, LANGUAGE_MODEL)
@@ -105,13 +87,72 @@ def main(wav_file_path, **args):
     convert_json_to_srt(transcript_file)
 
 
+def transcribe_files(wav_file_paths, server, workers, force, **args):
+
+    if server:
+        failed = []
+        for wav_file_path in wav_file_paths:
+            if not force and outputs_up_to_date(wav_file_path):
+                continue
+            result = request_transcription(server, wav_file_path)
+            if 'error' in result:
+                print ("Transcription of %s failed: %s" % (wav_file_path, result['error']))
+                failed.append(wav_file_path)
+        return failed
+
+    return transcribe_batch(transcriber(load_model(**args)), wav_file_paths, workers=workers, force=force)
+
+
+def main(wav_file_path, input_dir, manifest_file_path, serve, server, host, port, socket_file_path, **args):
+
+    if serve:
+        # keep the model and scorer loaded, and take jobs from the socket
+        transcription_server(load_model(**args), host, port, socket_file_path)
+        return
+
+    if input_dir or manifest_file_path:
+        wav_file_paths = find_wavfiles(input_dir) if input_dir else read_manifest(manifest_file_path)
+        failed = transcribe_files(wav_file_paths, server, **args)
+        if len(failed) > 0:
+            sys.exit(1)
+        return
+
+    if wav_file_path is None:
+        print ("--wavfile, --input_dir or --manifest missing. Use --help for more info.")
+        sys.exit(2)
+
+    if server:
+        result = request_transcription(server, wav_file_path)
+        if 'error' in result:
+            print ("Transcription of %s failed: %s" % (wav_file_path, result['error']))
+            sys.exit(1)
+        print ("Transcribed %s in %.2f seconds. Outputs: %s" % (wav_file_path, result['inference_seconds'], ", ".join(result['outputs'].values())))
+        return
+
+    transcribe_with_subprocess(wav_file_path)
+
+
     
 if __name__ == "__main__": 
 
     parser = ArgumentParser(description=DESCRIPTION, formatter_class=RawTextHelpFormatter) 
 
-    parser.add_argument("--wavfile", dest="wav_file_path", required=True, help="path to downloaded tar.gz containing speech corpus in CommonVoice v2.0 format")
+    parser.add_argument("--wavfile", dest="wav_file_path", help="path to wav file to be transcribed")
     #parser.add_argument("--target_dir", dest="cv_root_dir", required=True, help="target directory for extracted archive, also root directory for training data")
+
+    parser.add_argument("--input_dir", dest="input_dir", default=None, help="transcribe all wav files within this directory (and subdirectories)")
+    parser.add_argument("--manifest", dest="manifest_file_path", default=None, help="transcribe all wav files listed in this file (one per line, or a DeepSpeech csv)")
+    parser.add_argument("--workers", dest="workers", type=int, default=4, help="number of threads reading and resampling audio ahead of the model with --input_dir or --manifest")
+    parser.add_argument("--force", dest="force", action="store_true", help="transcribe again files whose outputs are already up to date")
+
+    parser.add_argument("--serve", dest="serve", action="store_true", help="run as a transcription server with the model and scorer kept loaded")
+    parser.add_argument("--host", dest="host", default="127.0.0.1", help="address for --serve to listen on")
+    parser.add_argument("--port", dest="port", type=int, default=5511, help="port for --serve to listen on")
+    parser.add_argument("--socket", dest="socket_file_path", default=None, help="listen on this unix socket instead of host and port")
+    parser.add_argument("--model", dest="model_file_path", default=ACOUSTIC_MODEL, help="acoustic model (.pbmm) for --serve, --input_dir or --manifest. These use the deepspeech package with an exported model, not the checkpoint in %s that --wavfile alone transcribes with. Export a fine-tuned checkpoint (DeepSpeech.py --export_dir) and give its .pbmm here to use it (default: %s)" % (CHECKPOINTS_DIR, ACOUSTIC_MODEL))
+    parser.add_argument("--scorer", dest="scorer_file_path", default=LANGUAGE_MODEL, help="language model scorer for --serve, --input_dir or --manifest")
+    parser.add_argument("--stub", dest="stub", action="store_true", help="use a stub model that doesn't need DeepSpeech (for testing)")
+    parser.add_argument("--server", dest="server", default=None, help="send --wavfile to a running server, e.g. http://127.0.0.1:5511 or the path of its unix socket")
    
     parser.set_defaults(func=main)
     args = parser.parse_args()
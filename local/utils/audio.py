@@ -3,22 +3,67 @@
 import sys
 
 import os
+import csv
+import mmap
+import math
+import decimal
 import shutil
+import struct
+import tempfile
+import threading
+import multiprocessing
 
 import wave
-import sox
 
-import pandas as pd
-import numpy as np
+from collections import namedtuple
 
-import scipy.io.wavfile as wav
-
-from python_speech_features import mfcc
+# numpy, scipy, sox and python_speech_features are imported by the functions
+# that need them, since most callers (e.g. transcribe.py or convert_mp3s.py)
+# only use a few functions here and shouldn't pay for the rest at startup.
+# utils.benchmark.bench_import_time checks that they stay that way.
 
 N_CONTEXT=9
 
+SAMPLE_RATE=16000
+
+# MFCC window length and step (seconds)
+WINLEN=0.032
+WINSTEP=0.02
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+wav_header = namedtuple('wav_header', ['audio_format', 'channels', 'sample_rate', 'bits_per_sample', 'block_align', 'data_offset', 'data_size', 'num_frames', 'complete'])
+
 
 def downsample_wavfile(wavfile):
+    try:
+        header = read_wav_header(wavfile)
+    except ValueError:
+        header = None
+
+    if header is None or header.audio_format not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+        # not something we can read natively. Leave it to sox.
+        return downsample_wavfile_sox(wavfile)
+
+    if header.sample_rate == SAMPLE_RATE and header.channels == 1 and header.bits_per_sample == 16 and header.audio_format == WAVE_FORMAT_PCM:
+        return True
+
+    print ("Downsampliing %s" % wavfile)
+
+    try:
+        audio = load_audio(wavfile)
+    except ValueError:
+        return downsample_wavfile_sox(wavfile)
+
+    write_wav(wavfile, audio)
+    return True
+
+
+def downsample_wavfile_sox(wavfile):
+    import sox
+
     if sox.file_info.sample_rate(wavfile)==16000.0:
         return True
 
@@ -31,19 +76,282 @@ def downsample_wavfile(wavfile):
     return True
 
 
+def read_wav_header(wavfile):
+    """
+    Reads the format and the position of the sample data from the RIFF
+    chunks of a WAV file, without decoding any audio or starting soxi.
+    """
+    with open(wavfile, 'rb') as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[0:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            raise ValueError("%s is not a RIFF WAVE file" % wavfile)
+
+        fmt = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError("%s has no data chunk" % wavfile)
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size)
+                if chunk_size % 2:
+                    f.seek(1, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                data_offset = f.tell()
+                break
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+    if fmt is None or len(fmt) < 16:
+        raise ValueError("%s has no fmt chunk" % wavfile)
+
+    audio_format, channels, sample_rate, byte_rate, block_align, bits_per_sample = struct.unpack('<HHIIHH', fmt[:16])
+    if audio_format == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        audio_format = struct.unpack('<H', fmt[24:26])[0]
+
+    # the data chunk size is unreliable in streamed/truncated files
+    available_size = os.path.getsize(wavfile) - data_offset
+    data_size = min(chunk_size, available_size)
+    num_frames = data_size // block_align if block_align > 0 else 0
+
+    return wav_header(audio_format, channels, sample_rate, bits_per_sample, block_align, data_offset, data_size, num_frames, chunk_size <= available_size)
+
+
+def read_wav(wavfile):
+    """
+    Returns the samples of a PCM or float WAV file as a float32 array of
+    shape (frames, channels) scaled to [-1, 1], and its sample rate
+    """
+    import numpy as np
+
+    header = read_wav_header(wavfile)
+    data = np.fromfile(wavfile, dtype=np.uint8, count=header.num_frames * header.block_align, offset=header.data_offset)
+
+    sample_width = header.bits_per_sample // 8
+    if header.audio_format == WAVE_FORMAT_IEEE_FLOAT and sample_width == 4:
+        samples = data.view('<f4').astype(np.float32)
+    elif header.audio_format == WAVE_FORMAT_IEEE_FLOAT and sample_width == 8:
+        samples = data.view('<f8').astype(np.float32)
+    elif header.audio_format != WAVE_FORMAT_PCM:
+        raise ValueError("%s has unsupported format %s" % (wavfile, header.audio_format))
+    elif sample_width == 1:
+        samples = (data.astype(np.float32) - 128.0) / 128.0
+    elif sample_width == 2:
+        samples = data.view('<i2').astype(np.float32) / 32768.0
+    elif sample_width == 3:
+        # sign extend little endian 24 bit samples into int32
+        data = data.reshape(-1, 3).astype(np.int32)
+        samples = ((data[:, 0] << 8) | (data[:, 1] << 16) | (data[:, 2] << 24)) >> 8
+        samples = samples.astype(np.float32) / 8388608.0
+    elif sample_width == 4:
+        samples = data.view('<i4').astype(np.float32) / 2147483648.0
+    else:
+        raise ValueError("%s has unsupported sample width %s" % (wavfile, sample_width))
+
+    return samples.reshape(-1, header.channels), header.sample_rate
+
+
+def resample(samples, sample_rate, target_sample_rate=SAMPLE_RATE):
+    """
+    Mixes (frames, channels) samples down to mono and resamples with a
+    polyphase filter. Returns 16 bit PCM samples
+    """
+    import numpy as np
+    from scipy.signal import resample_poly
+
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+
+    if sample_rate != target_sample_rate:
+        divisor = math.gcd(int(sample_rate), int(target_sample_rate))
+        samples = resample_poly(samples, target_sample_rate // divisor, int(sample_rate) // divisor)
+
+    return np.clip(np.round(samples * 32768.0), -32768, 32767).astype(np.int16)
+
+
+def load_audio(wavfile, target_sample_rate=SAMPLE_RATE):
+    """
+    Reads a WAV file into memory as mono 16 bit PCM at target_sample_rate,
+    ready to be handed to inference or written with write_wav
+    """
+    samples, sample_rate = read_wav(wavfile)
+    return resample(samples, sample_rate, target_sample_rate)
+
+
+def load_audio_sox(wavfile, target_sample_rate=SAMPLE_RATE):
+    """
+    As load_audio, for files that only sox can read (e.g. compressed wavs).
+    sox converts them to a temporary file, so wavfile itself is left as it is.
+    """
+    import sox
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_wavfile = os.path.join(temp_dir, "audio.wav")
+        tf = sox.Transformer()
+        tf.convert(samplerate=target_sample_rate, n_channels=1, bitdepth=16)
+        tf.build(wavfile, temp_wavfile)
+        return load_audio(temp_wavfile, target_sample_rate)
+
+
+def write_wav(wavfile, audio, sample_rate=SAMPLE_RATE):
+    # written to a temporary file first, so that wavfile is never left half written
+    temp_wavfile = wavfile + ".tmp"
+    with wave.open(temp_wavfile, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(audio.astype('<i2').tobytes())
+    os.replace(temp_wavfile, wavfile)
+
+
+def wav_file_header(audio_format, channels, sample_rate, bits_per_sample, data_size):
+    # canonical 44 byte RIFF/WAVE header
+    block_align = channels * bits_per_sample // 8
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+                       b'RIFF', 36 + data_size, b'WAVE',
+                       b'fmt ', 16, audio_format, channels, sample_rate, sample_rate * block_align, block_align, bits_per_sample,
+                       b'data', data_size)
+
+
+class wav_segmenter(object):
+    """
+    Cuts intervals out of a (long) WAV file without decoding it. The source
+    is memory mapped once, and each segment is written as the slice of its
+    sample data behind a new header, in the source's own format.
+    """
+
+    def __init__(self, wavfile):
+        self.wavfile = wavfile
+        self.header = read_wav_header(wavfile)
+        self.file = open(wavfile, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def frame_range(self, start, end):
+        # start and end in seconds. Frames are truncated, as pydub's slicing did
+        first = min(max(int(start * self.header.sample_rate), 0), self.header.num_frames)
+        last = min(max(int(end * self.header.sample_rate), first), self.header.num_frames)
+        return first, last
+
+
+    def frames(self, first, last):
+        offset = self.header.data_offset + first * self.header.block_align
+        return memoryview(self.data)[offset:offset + (last - first) * self.header.block_align]
+
+
+    def segment(self, start, end):
+        return self.frames(*self.frame_range(start, end))
+
+
+    def write(self, wavfile, wav_header, pcm):
+        temp_wavfile = "%s.%s.tmp" % (wavfile, threading.get_ident())
+        with open(temp_wavfile, 'wb') as f:
+            f.write(wav_header)
+            f.write(pcm)
+        os.replace(temp_wavfile, wavfile)
+
+
+    def export(self, wavfile, start, end):
+        """
+        Writes the audio between start and end seconds to wavfile and returns
+        its size in bytes
+        """
+        pcm = self.segment(start, end)
+        try:
+            wav_header = wav_file_header(self.header.audio_format, self.header.channels, self.header.sample_rate, self.header.bits_per_sample, len(pcm))
+            self.write(wavfile, wav_header, pcm)
+            return len(wav_header) + len(pcm)
+        finally:
+            pcm.release()
+
+
 def convert_mp3(mp3file):
-    wavfile = mp3file.replace(".mp3",".wav")
-    if os.path.isfile(wavfile):
-        return
+    mp3file, status, error = convert_mp3_file(mp3file)
+    return status != 'failed'
+
 
+def is_valid_wav(wavfile, sample_rate=SAMPLE_RATE):
+    """
+    Checks from its header that wavfile is a complete 16 bit mono PCM WAV
+    file at sample_rate, and not e.g. left truncated by an interrupted run
+    """
     try:
-        transform_audio(mp3file, wavfile)
-        return True
-    except:
+        header = read_wav_header(wavfile)
+    except (ValueError, OSError):
         return False
 
+    return header.audio_format == WAVE_FORMAT_PCM and header.channels == 1 and header.bits_per_sample == 16 \
+        and header.sample_rate == sample_rate and header.num_frames > 0 and header.complete
+
+
+def convert_mp3_file(mp3file):
+    """
+    Converts mp3file to a 16kHz mono WAV file alongside it, unless a valid
+    one exists already. Returns (mp3file, status, error) where status is one
+    of 'converted', 'skipped' or 'failed'
+    """
+    wavfile = os.path.splitext(mp3file)[0] + ".wav"
+    if is_valid_wav(wavfile):
+        return mp3file, 'skipped', ''
+
+    # sox determines the output type from the extension, so the temporary
+    # file must end in .wav as well
+    temp_wavfile = os.path.splitext(mp3file)[0] + ".partial.wav"
+    try:
+        transform_audio(mp3file, temp_wavfile)
+        if not is_valid_wav(temp_wavfile):
+            raise ValueError("sox output is not a valid 16kHz mono wav file")
+        os.replace(temp_wavfile, wavfile)
+    except Exception as e:
+        if os.path.exists(temp_wavfile):
+            os.remove(temp_wavfile)
+        return mp3file, 'failed', "%s: %s" % (type(e).__name__, e)
+
+    return mp3file, 'converted', ''
+
+
+def convert_mp3_files(mp3files, workers=os.cpu_count(), failure_report_file_path=None):
+    """
+    Converts many mp3 files in a pool of processes. Interrupted runs can be
+    resumed, since existing valid outputs are skipped and outputs only appear
+    once complete. Failures are written to failure_report_file_path
+    """
+    from tqdm import tqdm
+
+    counts = { 'converted' : 0, 'skipped' : 0, 'failed' : 0 }
+    failures = []
+    with multiprocessing.Pool(workers) as pool:
+        for mp3file, status, error in tqdm(pool.imap_unordered(convert_mp3_file, mp3files, chunksize=32), total=len(mp3files)):
+            counts[status] += 1
+            if status == 'failed':
+                failures.append((mp3file, error))
+
+    if failure_report_file_path:
+        with open(failure_report_file_path, 'w', encoding='utf-8', newline='') as report_file:
+            report = csv.writer(report_file)
+            report.writerow(['mp3_filename', 'error'])
+            report.writerows(sorted(failures))
+
+    print ("%(converted)s converted, %(skipped)s already converted, %(failed)s failed" % counts)
+    return counts, failures
+
 
 def transform_audio(old_file, new_file):
+    import sox
+
     tf = sox.Transformer()
     tf.convert(samplerate=16000, n_channels=1)
     tf.build(old_file, new_file)
@@ -58,18 +366,32 @@ def get_duration_wav(wavfile):
     return duration
 
 
-def audiofile_to_input_vector(audio_filename, numcep, numcontext):
+def audiofile_to_input_vector(audio_filename, numcep, numcontext, cache=None):
     r"""
     Given a WAV audio file at ``audio_filename``, calculates ``numcep`` MFCC features
     at every 0.01s time step with a window length of 0.025s. Appends ``numcontext``
     context frames to the left and right of each time step, and returns this data
     in a numpy array.
+
+    If a ``utils.feature_cache.feature_cache`` is given, features of audio
+    that has been seen before are loaded from it instead of recomputed.
     """
+    if cache is not None:
+        return cache.features(audio_filename, numcep, numcontext)
+
+    return compute_input_vector(audio_filename, numcep, numcontext)
+
+
+def compute_input_vector(audio_filename, numcep, numcontext):
+    import numpy as np
+    import scipy.io.wavfile as wav
+    from python_speech_features import mfcc
+
     # Load wav files
     fs, audio = wav.read(audio_filename)
 
     # Get mfcc coefficients
-    features = mfcc(audio, samplerate=fs, numcep=numcep, winlen=0.032, winstep=0.02, winfunc=np.hamming)
+    features = mfcc(audio, samplerate=fs, numcep=numcep, winlen=WINLEN, winstep=WINSTEP, winfunc=np.hamming)
 
     # Add empty initial and final contexts
     empty_context = np.zeros((numcontext, numcep), dtype=features.dtype)
@@ -78,12 +400,38 @@ def audiofile_to_input_vector(audio_filename, numcep, numcontext):
     return features
 
 
+def round_half_up(number):
+    # as python_speech_features.sigproc.round_half_up
+    return int(decimal.Decimal(number).quantize(decimal.Decimal('1'), rounding=decimal.ROUND_HALF_UP))
+
+
+def feature_frame_counts(num_samples, sample_rates, winlen=WINLEN, winstep=WINSTEP):
+    """
+    The number of MFCC frames that audiofile_to_input_vector would produce
+    (excluding context padding) for audio of num_samples at sample_rates.
+    Follows python_speech_features' framesig, without computing any features.
+    Works on scalars as well as on whole arrays of clips at once.
+    """
+    import numpy as np
+
+    num_samples = np.asarray(num_samples, dtype=np.int64)
+    sample_rates = np.broadcast_to(np.asarray(sample_rates, dtype=np.int64), num_samples.shape)
+
+    frame_len = np.zeros(num_samples.shape, dtype=np.int64)
+    frame_step = np.ones(num_samples.shape, dtype=np.int64)
+    for sample_rate in np.unique(sample_rates):
+        rate_mask = sample_rates == sample_rate
+        frame_len[rate_mask] = round_half_up(winlen * sample_rate)
+        frame_step[rate_mask] = max(1, round_half_up(winstep * sample_rate))
+
+    frames = 1 + np.ceil((num_samples - frame_len) / frame_step)
+    return np.where(num_samples <= frame_len, 1, frames).astype(np.int64)
+
+
 def is_feasible_transcription(wavfile, transcription):
     try:
-        aftiv_length=audiofile_to_input_vector(wavfile, 26, N_CONTEXT).shape[0] - 2*N_CONTEXT
-    except:
+        header = read_wav_header(wavfile)
+    except (ValueError, OSError):
         return False
 
-    return aftiv_length > len(transcription)
-
-
+    return int(feature_frame_counts(header.num_frames, header.sample_rate)) > len(transcription)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import itertools
+
+from utils.clean_transcript import clean_transcript
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+DESCRIPTION = """
+Cymharu cyflymder clean_transcript.normalise yn erbyn y fersiwn wreiddiol cam wrth gam.
+Compares clean_transcript.normalise against the original step by step implementation
+and checks that both give the same results.
+
+e.g. (from /DeepSpeech/bin/bangor_welsh)
+
+    python3 -m utils.benchmark.bench_clean_transcript -s /data/bangor/lm-data/oscar/corpus.txt -n 1000000
+
+"""
+
+SAMPLE_SENTENCES = [
+    "Mae'r tywydd yn braf heddiw, on'd yw e?",
+    "Beth yw’r newyddion diweddaraf o Gaerdydd?",
+    "“Diolch yn fawr iawn” meddai hi – ac yna aeth hi adref.",
+    "Rhowch gân gan Bryn Fôn i mi!",
+    "Faint o’r gloch yw hi yn Efrog Newydd (UDA)?",
+    "Ydy hi'n mynd i fwrw glaw yfory; neu dros y penwythnos?",
+    "Gosod larwm am 7:30 bore fory",
+    "Mae 3 cath a 2 gi gyda ni.",
+    "Pwy sy'n canu ‘Yma o Hyd’ ar Radio Cymru?",
+    "Darllenwch y penawdau chwaraeon/newyddion i mi",
+    "Sut mae'r gwynt yn Aberystwyth?",
+    "Croeso i Gymru — gwlad y gân.",
+]
+
+
+def legacy_normalise(clean, transcript):
+    # clean_transcript.clean() prior to the translation table
+    transcript = clean.replace(transcript)
+    transcript = clean.remove_seperators(transcript)
+    ooa = clean.out_of_alphabet(transcript)
+    if len(ooa) > 0:
+        return False, transcript.lower()
+    # normalise() also strips what the separators leave at either end, as
+    # cleaning the joined corpus a second time used to
+    return True, transcript.lower().strip()
+
+
+def load_sample(source_text_file_path, max_lines):
+    if source_text_file_path:
+        with open(source_text_file_path, 'r', encoding='utf-8') as in_file:
+            return list(itertools.islice(in_file, max_lines))
+
+    return list(itertools.islice(itertools.cycle(SAMPLE_SENTENCES), max_lines))
+
+
+def time_function(func, lines):
+    start = time.perf_counter()
+    results = [func(line) for line in lines]
+    return time.perf_counter() - start, results
+
+
+def main(source_text_file_path, alphabet_file_path, max_lines, repeats, **args):
+
+    lines = load_sample(source_text_file_path, max_lines)
+    clean = clean_transcript(alphabet_file_path)
+
+    print ("Benchmarking with %s lines (%.1f MB)" % (len(lines), sum(len(l) for l in lines) / 1e6))
+
+    legacy_times = []
+    compiled_times = []
+    for i in range(repeats):
+        legacy_time, legacy_results = time_function(lambda l: legacy_normalise(clean, l), lines)
+        compiled_time, compiled_results = time_function(clean.normalise, lines)
+        legacy_times.append(legacy_time)
+        compiled_times.append(compiled_time)
+
+    mismatches = [(line, l, c) for line, l, c in zip(lines, legacy_results, compiled_results) if l != c]
+    for line, l, c in mismatches[:10]:
+        print ("MISMATCH: %r\n\tlegacy:   %r\n\tcompiled: %r" % (line, l, c))
+
+    legacy_time = min(legacy_times)
+    compiled_time = min(compiled_times)
+    print ("legacy\t\t%.3f seconds\t%.0f lines/second" % (legacy_time, len(lines) / legacy_time))
+    print ("compiled\t%.3f seconds\t%.0f lines/second" % (compiled_time, len(lines) / compiled_time))
+    print ("speedup\t\t%.2fx" % (legacy_time / compiled_time))
+    print ("mismatches\t%s" % len(mismatches))
+
+    if len(mismatches) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=DESCRIPTION, formatter_class=RawTextHelpFormatter)
+    parser.add_argument("-s", dest="source_text_file_path", default='', help="location of a (large) Welsh text file. Default: built in sample sentences")
+    parser.add_argument("-a", dest="alphabet_file_path", default='/DeepSpeech/bin/bangor_welsh/alphabet.txt', help="location of alphabet file")
+    parser.add_argument("-n", dest="max_lines", type=int, default=500000, help="number of lines to benchmark with")
+    parser.add_argument("-r", dest="repeats", type=int, default=3, help="number of timed repeats (best is reported)")
+
+    parser.set_defaults(func=main)
+    args = parser.parse_args()
+    args.func(**vars(args))
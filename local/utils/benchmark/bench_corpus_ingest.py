@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import gzip
+import time
+import shutil
+import tempfile
+import threading
+
+from utils.corpus import clean_text_file, compression_type
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+DESCRIPTION = """
+Mesur defnydd disg ac I/O wrth lanhau corpws testun wedi'i gywasgu (e.e. OSCAR).
+Measures peak scratch disk, I/O and time for cleaning a compressed text corpus (e.g. OSCAR)
+the old way (decompress to disk, move, re-read) against streaming straight into the cleaner.
+
+e.g. (from /DeepSpeech/bin/bangor_welsh)
+
+    python3 -m utils.benchmark.bench_corpus_ingest -s /data/oscar/cy.txt.gz -t /data/scratch
+
+"""
+
+
+def process_io():
+    # bytes actually read from and written to storage by this process
+    io = {}
+    with open("/proc/self/io", 'r') as proc_io:
+        for line in proc_io:
+            key, value = line.split(":")
+            io[key] = int(value)
+    return io
+
+
+def directory_size(dir_path):
+    total = 0
+    for root, dirs, files in os.walk(dir_path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class peak_disk_usage(object):
+
+    def __init__(self, dir_path, interval=0.2):
+        self.dir_path = dir_path
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.poll, daemon=True)
+
+    def poll(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, directory_size(self.dir_path))
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, directory_size(self.dir_path))
+
+
+def ingest_decompress_to_disk(archive_file_path, target_dir, alphabet_file_path, workers):
+    # import_bangor_resources.get_oscar_textcorpus prior to streaming
+    decompressed_file_path = os.path.join(target_dir, "oscar.txt")
+    corpus_file_path = os.path.join(target_dir, "corpus.txt")
+    with gzip.open(archive_file_path, 'rb') as archive_file:
+        with open(decompressed_file_path, 'wb') as decompressed_file:
+            shutil.copyfileobj(archive_file, decompressed_file)
+    shutil.move(decompressed_file_path, corpus_file_path)
+    return clean_text_file(corpus_file_path, os.path.join(target_dir, "corpus.clean.txt"), alphabet_file_path, os.path.join(target_dir, "corpus.ooa.txt"), workers)
+
+
+def ingest_streamed(archive_file_path, target_dir, alphabet_file_path, workers):
+    return clean_text_file(archive_file_path, os.path.join(target_dir, "corpus.clean.txt"), alphabet_file_path, os.path.join(target_dir, "corpus.ooa.txt"), workers)
+
+
+def measure(name, ingest, archive_file_path, scratch_dir, alphabet_file_path, workers):
+    target_dir = tempfile.mkdtemp(prefix=name + ".", dir=scratch_dir)
+    try:
+        io_before = process_io()
+        start = time.perf_counter()
+        with peak_disk_usage(target_dir) as disk:
+            ingest(archive_file_path, target_dir, alphabet_file_path, workers)
+        elapsed = time.perf_counter() - start
+        io_after = process_io()
+    finally:
+        shutil.rmtree(target_dir)
+
+    print ("%s\t%.1f seconds\tpeak disk %.1f MB\tread %.1f MB\twritten %.1f MB" % (
+        name, elapsed, disk.peak / 1e6,
+        (io_after['read_bytes'] - io_before['read_bytes']) / 1e6,
+        (io_after['write_bytes'] - io_before['write_bytes']) / 1e6))
+
+
+def main(archive_file_path, scratch_dir, alphabet_file_path, workers, **args):
+
+    if compression_type(archive_file_path) != 'gzip':
+        print ("%s is not a gzip archive" % archive_file_path)
+        sys.exit(2)
+
+    print ("%s (%.1f MB compressed). I/O counts exclude worker processes when --workers > 1" % (archive_file_path, os.path.getsize(archive_file_path) / 1e6))
+    measure("decompress_to_disk", ingest_decompress_to_disk, archive_file_path, scratch_dir, alphabet_file_path, workers)
+    measure("streamed", ingest_streamed, archive_file_path, scratch_dir, alphabet_file_path, workers)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=DESCRIPTION, formatter_class=RawTextHelpFormatter)
+    parser.add_argument("-s", dest="archive_file_path", required=True, help="location of a gzip compressed text corpus")
+    parser.add_argument("-t", dest="scratch_dir", default=tempfile.gettempdir(), help="scratch directory on the disk to be measured")
+    parser.add_argument("-a", dest="alphabet_file_path", default='/DeepSpeech/bin/bangor_welsh/alphabet.txt', help="location of alphabet file")
+    parser.add_argument("-w", dest="workers", type=int, default=1, help="number of cleaning processes")
+
+    parser.set_defaults(func=main)
+    args = parser.parse_args()
+    args.func(**vars(args))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import subprocess
+
+from pathlib import Path
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+DESCRIPTION = """
+Mesur amser cychwyn y sgriptiau yn local/.
+Measures how long the entry points in local/ (and the utils modules they share)
+take to import, with 'python3 -X importtime', and checks them against a
+startup-time budget. Scripts started thousands of times, e.g. from SLURM
+array jobs, pay this on every run before doing any work.
+
+A module fails the check if its import takes longer than its budget (the
+fastest of -n runs, times --tolerance), or if it imports any of the heavy
+modules below that it isn't allowed. Those should be imported by the
+functions that use them, so that a code path only pays for what it needs.
+The second check doesn't depend on how fast the machine is. Exits with 1 if
+any module fails, so it can be run as a regression test after changes.
+
+-X importtime is only in Python 3.7 onwards. On older versions (e.g. the
+training image's 3.6) each import is instead timed, and the modules it
+imports listed from sys.modules, within the subprocess.
+
+e.g. (from /DeepSpeech/bin/bangor_welsh)
+
+    python3 -m utils.benchmark.bench_import_time -n 5
+
+"""
+
+# modules that take tens or hundreds of milliseconds to import
+HEAVY_MODULES = ['numpy', 'pandas', 'scipy', 'sox', 'python_speech_features', 'librosa', 'praatio', 'srt', 'pydub', 'requests', 'git', 'tqdm', 'kenlm', 'tensorflow', 'deepspeech']
+
+# module : (budget in ms, heavy modules it may import at startup)
+BUDGETS = {
+    'transcribe' : (150, []),
+    'convert_mp3s' : (75, []),
+    'import_cv_archive' : (75, []),
+    'clean_lm_corpus' : (75, []),
+    'build_lm_scorers' : (75, []),
+    'count_lm_corpus' : (75, []),
+    'import_fine_tuning_resources' : (300, ['numpy']),
+    'import_bangor_resources' : (300, ['numpy']),
+    'analyze_cv' : (750, ['numpy', 'pandas']),
+    'utils.audio' : (50, []),
+    'utils.transcription' : (150, []),
+    'utils.corpus' : (75, []),
+    'utils.imports' : (75, []),
+    'utils.kfold' : (250, ['numpy']),
+}
+
+LOCAL_DIR = Path(__file__).resolve().parents[2]
+
+IMPORTTIME = sys.version_info >= (3, 7)
+
+# run in a subprocess without -X importtime. The last two lines it prints are
+# the import time in seconds and the modules imported.
+TIME_IMPORT = """
+import sys, time, importlib
+before = set(sys.modules)
+start = time.perf_counter()
+importlib.import_module(%r)
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(" ".join(sorted(set(sys.modules) - before)))
+"""
+
+
+def run_python(statement, importtime=False):
+    env = dict(os.environ)
+    # transcribe.py reads the release it loads models of at import
+    env.setdefault('TECHIAITH_RELEASE', 'import_time')
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', statement]
+    result = subprocess.run(command, cwd=str(LOCAL_DIR), env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "exit code %s" % result.returncode)
+    return result.stderr if importtime else result.stdout
+
+
+def parse_importtime(output):
+    """
+    The cumulative import time (microseconds) of each module in the output
+    of -X importtime
+    """
+    times = dict()
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        times[fields[2].strip()] = int(fields[1])
+    return times
+
+
+def top_level_modules(times):
+    return set(name.split(".")[0] for name in times)
+
+
+def startup_modules():
+    # e.g. .pth files can import modules before any script does. Without
+    # -X importtime, those are already in sys.modules before the import.
+    if not IMPORTTIME:
+        return set()
+    return top_level_modules(parse_importtime(run_python("pass", importtime=True)))
+
+
+def time_import(module):
+    """
+    (import time of module in ms, top level modules imported with it)
+    """
+    if IMPORTTIME:
+        times = parse_importtime(run_python("import %s" % module, importtime=True))
+        if module not in times:
+            raise RuntimeError("%s not in -X importtime output" % module)
+        return times[module] / 1000.0, top_level_modules(times)
+
+    # the module itself may print when imported
+    lines = run_python(TIME_IMPORT % module).splitlines()
+    if len(lines) < 2:
+        raise RuntimeError("no import time for %s" % module)
+    return float(lines[-2]) * 1000.0, top_level_modules(lines[-1].split())
+
+
+def measure(module, repeats, startup_modules):
+    """
+    (fastest import time of module in ms, heavy modules it imports)
+    """
+    best = None
+    imported = set()
+    for i in range(repeats):
+        elapsed, imported = time_import(module)
+        best = elapsed if best is None else min(best, elapsed)
+    imported = imported - startup_modules
+    return best, sorted(m for m in HEAVY_MODULES if m in imported)
+
+
+def main(modules, repeats, tolerance, **args):
+
+    startup = startup_modules()
+
+    failures = 0
+    print ("module\tms\tbudget\theavy imports\tresult")
+    for module in modules or sorted(BUDGETS):
+        budget, allowed = BUDGETS.get(module, (None, []))
+        try:
+            elapsed, heavy = measure(module, repeats, startup)
+        except RuntimeError as e:
+            print ("%s\t-\t%s\t-\tFAILED (%s)" % (module, budget, e))
+            failures += 1
+            continue
+
+        problems = ["imports %s" % m for m in heavy if m not in allowed]
+        if budget is not None and elapsed > budget * tolerance:
+            problems.append("over budget")
+        if problems:
+            failures += 1
+
+        print ("%s\t%.1f\t%s\t%s\t%s" % (module, elapsed, budget if budget is not None else '-', ",".join(heavy) or '-', "FAILED (%s)" % ", ".join(problems) if problems else "ok"))
+
+    if failures > 0:
+        print ("%s of %s modules failed" % (failures, len(modules or BUDGETS)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=DESCRIPTION, formatter_class=RawTextHelpFormatter)
+    parser.add_argument("modules", nargs="*", help="modules to measure (default: all those with a budget)")
+    parser.add_argument("-n", dest="repeats", type=int, default=5, help="number of runs of each import, of which the fastest is taken")
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=1.0, help="multiplier of the budgets, e.g. 2 on a slow or busy machine")
+
+    parser.set_defaults(func=main)
+    args = parser.parse_args()
+    args.func(**vars(args))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import glob
+import shutil
+import tempfile
+
+import numpy as np
+
+from utils.audio import transform_audio, load_audio, read_wav
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+DESCRIPTION = """
+Cymharu ailsamplu gyda sox yn erbyn ailsamplu yn y cof.
+Compares resampling clips to 16kHz with sox (temporary file round trip, as
+downsample_wavfile used to) against utils.audio.load_audio (native header,
+in memory polyphase resampling), and checks that the outputs are equivalent.
+
+The clips should be WAV files at their original sample rate, e.g. CommonVoice
+mp3s converted with 'sox clip.mp3 clip.wav'
+
+e.g. (from /DeepSpeech/bin/bangor_welsh)
+
+    python3 -m utils.benchmark.bench_resample --clips_dir /data/commonvoice/clips_48kHz -n 500
+
+"""
+
+
+def sox_resample(wavfile, temp_dir):
+    temp_wavfile = os.path.join(temp_dir, os.path.basename(wavfile))
+    transform_audio(wavfile, temp_wavfile)
+    samples, sample_rate = read_wav(temp_wavfile)
+    os.remove(temp_wavfile)
+    return np.round(samples[:, 0] * 32768.0).astype(np.int16)
+
+
+def snr_db(reference, other):
+    length = min(len(reference), len(other))
+    reference = reference[:length].astype(np.float64)
+    noise = reference - other[:length].astype(np.float64)
+    noise_power = np.sum(noise ** 2)
+    if noise_power == 0:
+        return float('inf')
+    return 10 * np.log10(np.sum(reference ** 2) / noise_power)
+
+
+def main(clips_dir, max_clips, min_snr, **args):
+
+    wavfiles = sorted(glob.glob(os.path.join(clips_dir, "*.wav")))[:max_clips]
+    if len(wavfiles) == 0:
+        print ("No wav files in %s" % clips_dir)
+        sys.exit(2)
+
+    temp_dir = tempfile.mkdtemp()
+    sox_time = 0.0
+    native_time = 0.0
+    snrs = []
+    length_mismatches = 0
+    try:
+        for wavfile in wavfiles:
+            start = time.perf_counter()
+            sox_audio = sox_resample(wavfile, temp_dir)
+            sox_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            native_audio = load_audio(wavfile)
+            native_time += time.perf_counter() - start
+
+            if abs(len(sox_audio) - len(native_audio)) > 1:
+                length_mismatches += 1
+            snrs.append(snr_db(sox_audio, native_audio))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    snrs = np.array(snrs)
+    print ("%s clips" % len(wavfiles))
+    print ("sox\t\t%.2f seconds\t%.1f ms/clip" % (sox_time, 1000 * sox_time / len(wavfiles)))
+    print ("in memory\t%.2f seconds\t%.1f ms/clip" % (native_time, 1000 * native_time / len(wavfiles)))
+    print ("speedup\t\t%.2fx" % (sox_time / native_time))
+    print ("SNR of in memory against sox: min %.1f dB, median %.1f dB" % (np.min(snrs), np.median(snrs)))
+    print ("length mismatches (more than 1 sample)\t%s" % length_mismatches)
+
+    if length_mismatches > 0 or np.min(snrs) < min_snr:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=DESCRIPTION, formatter_class=RawTextHelpFormatter)
+    parser.add_argument("--clips_dir", dest="clips_dir", required=True, help="directory of wav clips at their original sample rate")
+    parser.add_argument("-n", dest="max_clips", type=int, default=500, help="maximum number of clips")
+    parser.add_argument("--min_snr", dest="min_snr", type=float, default=30.0, help="minimum SNR (dB) between the two outputs for them to be treated as equivalent")
+
+    parser.set_defaults(func=main)
+    args = parser.parse_args()
+    args.func(**vars(args))
@@ -3,35 +3,164 @@
 import os
 import sys
 import re
-import pathlib 
+import shutil
+import pathlib
+import unicodedata
+
+from collections import Counter
+
+
+# characters removed by replace()
+REMOVED_CHARACTERS = ":-\u2010\u2011\u2012\u2013\u2014\u201C\u201D"
+
+# characters removed by remove_seperators()
+SEPERATOR_CHARACTERS = "\\,.?!()\";/|`"
+
+# A single compiled character class removes everything in one scan. For
+# Welsh text (i.e. not pure ASCII) this is quicker than str.translate, which
+# falls back to a dictionary lookup for every character.
+REMOVE_REGEX = re.compile("[%s]+" % re.escape(REMOVED_CHARACTERS + SEPERATOR_CHARACTERS))
+
+# Text cleaned by an earlier version of normalise() is cleaned again. Increment
+# whenever a change to clean() or normalise() changes their output.
+NORMALISER_VERSION = 1
+
+
+def remove_and_replace(transcript):
+    transcript = REMOVE_REGEX.sub('', transcript.strip())
+    return transcript.replace("\u2019","'").replace("\u2018","'")
+
+
+class ooa_collector(object):
+    """
+    Collects the lines rejected for containing out of alphabet characters
+    during a whole cleaning run. Rejected lines are written through a large
+    buffer to ooa_file_path, while counts per offending character and up to
+    max_examples distinct example lines per character are kept for a summary
+    that is written once by close().
+    """
+
+    def __init__(self, ooa_file_path, max_examples=10, buffer_size=1024*1024):
+        self.ooa_file_path = ooa_file_path
+        self.max_examples = max_examples
+        self.ooa_file = open(ooa_file_path, 'w', encoding='utf-8', buffering=buffer_size)
+        self.rejected = 0
+        self.counts = Counter()
+        self.examples = dict()
+
+
+    def add(self, ooa, transcript):
+        self.ooa_file.write("%s\t%s\n" % ("".join(sorted(ooa)), transcript))
+        self.rejected += 1
+        self.counts.update(ooa)
+        for character in ooa:
+            examples = self.examples.setdefault(character, [])
+            if len(examples) < self.max_examples and transcript not in examples:
+                examples.append(transcript)
+
+
+    def state(self):
+        return self.rejected, self.counts, self.examples
+
+
+    def merge(self, ooa_file_path, state):
+        """
+        Appends the rejected lines and summary of another collector, e.g. from
+        a shard cleaned in another process
+        """
+        with open(ooa_file_path, 'r', encoding='utf-8') as ooa_file:
+            shutil.copyfileobj(ooa_file, self.ooa_file)
+
+        rejected, counts, examples = state
+        self.rejected += rejected
+        self.counts.update(counts)
+        for character, other_examples in examples.items():
+            examples = self.examples.setdefault(character, [])
+            for example in other_examples:
+                if len(examples) < self.max_examples and example not in examples:
+                    examples.append(example)
+
+
+    def summary_file_path(self):
+        return os.path.splitext(self.ooa_file_path)[0] + ".summary.txt"
+
+
+    def close(self, write_summary=True):
+        if self.ooa_file.closed:
+            return
+
+        self.ooa_file.close()
+        if write_summary:
+            self.write_summary()
+
+
+    def write_summary(self):
+        with open(self.summary_file_path(), 'w', encoding='utf-8') as summary_file:
+            summary_file.write("# %s rejected lines. Out of alphabet characters by number of lines\n" % self.rejected)
+            for character, count in self.counts.most_common():
+                summary_file.write("%r\tU+%04X\t%s\t%s\n" % (character, ord(character), unicodedata.name(character, ''), count))
+                for example in self.examples.get(character, []):
+                    summary_file.write("\t\t%s\n" % example)
 
 
 class clean_transcript(object):
 
 
-    def __init__(self, alphabet_file_path, ooa_file_path=''):
+    def __init__(self, alphabet_file_path, ooa_file_path='', max_ooa_examples=10):
         self.valid_alphabet = self.load_alphabet(alphabet_file_path)
+        self.ooa_regex = self.compile_out_of_alphabet_regex(self.valid_alphabet)
         self.ooa_file_path=ooa_file_path
+        self.ooa = None
         if len(ooa_file_path) > 0:
-            # reset content
-            open(ooa_file_path, 'w').close()
-        
+            self.ooa = ooa_collector(ooa_file_path, max_ooa_examples)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self, write_summary=True):
+        if self.ooa is not None:
+            self.ooa.close(write_summary)
+
 
     def clean(self, transcript):
-        transcript = self.replace(transcript)
-        transcript = self.remove_seperators(transcript)
-        
-        ooa = self.out_of_alphabet(transcript)
-        if (len(ooa) > 0):
-            #print (ooa, transcript)
-            if len(self.ooa_file_path) > 0:
-                with open(self.ooa_file_path, 'w+', encoding='utf-8') as ooa_out_file:
-                    ooa_out_file.write("%s\t%s\n" % (ooa, transcript))
+        transcript = remove_and_replace(transcript)
+
+        if self.ooa_regex.search(transcript.lower()):
+            self.report_out_of_alphabet(transcript)
             return False, transcript
-            
+
         return True, transcript
 
 
+    def normalise(self, transcript):
+        """
+        Same as clean() but returns the transcript lowercased, as needed
+        by the text corpora, without a further call to lower()
+        """
+        transcript = remove_and_replace(transcript)
+        lower_transcript = transcript.lower()
+
+        if self.ooa_regex.search(lower_transcript):
+            self.report_out_of_alphabet(transcript)
+            return False, lower_transcript
+
+        # removing characters can leave spaces at either end. Stripping them
+        # makes normalise() idempotent, so normalised text can be joined
+        # with other corpora without being cleaned again.
+        return True, lower_transcript.strip()
+
+
+    def report_out_of_alphabet(self, transcript):
+        if self.ooa is not None:
+            self.ooa.add(self.out_of_alphabet(transcript), transcript)
+
+
     def load_alphabet(self, alphabet_file_path):
         alpha = set()
         alpha.add(' ')
@@ -43,7 +172,19 @@ class clean_transcript(object):
         return alpha
 
 
-    def remove_seperators(self, transcript):    
+    def compile_out_of_alphabet_regex(self, alphabet):
+        # matches any single character that is not in the alphabet. Entries
+        # longer than one character can never match a character in set
+        # difference of out_of_alphabet(), so are left out here too.
+        letters = sorted(letter for letter in alphabet if len(letter) == 1)
+        return re.compile("[^%s]" % "".join(re.escape(letter) for letter in letters))
+
+
+    #
+    # Original step by step implementation of clean(). Kept as the reference
+    # for utils/benchmark/bench_clean_transcript.py
+    #
+    def remove_seperators(self, transcript):
         transcript = re.sub(r"[\\,\.\?!()\";/\\|`]", '', transcript)
         return transcript
 
@@ -53,7 +194,7 @@ class clean_transcript(object):
 
         transcript = transcript.replace(":","")
         transcript = transcript.replace("-","")
-    
+
         transcript = transcript.replace("\u2019","'")
         transcript = transcript.replace("\u2018","'")
         transcript = transcript.replace("\u2010","")
@@ -63,11 +204,10 @@ class clean_transcript(object):
         transcript = transcript.replace("\u2014","")
         transcript = transcript.replace("\u201C","")
         transcript = transcript.replace("\u201D","")
-        
+
         return transcript
 
 
     def out_of_alphabet(self, transcript):
         transcript = transcript.lower()
         return set(transcript) - self.valid_alphabet
-
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import csv
+import hashlib
+import concurrent.futures
+
+from .audio import wav_file_header
+
+
+INDEX_FILE_NAME = "index.tsv"
+INDEX_COLUMNS = ['source', 'source_size', 'source_mtime_ns', 'start_frame', 'end_frame', 'content_hash', 'clip', 'size']
+
+
+class clip_store(object):
+    """
+    Directory of clips cut from longer recordings. Each clip is named by the
+    sha1 of its content, so identical audio is stored only once however many
+    segments it was cut for, and segments with the same transcript no longer
+    overwrite each other. Clips are sharded over subdirectories by hash
+    prefix.
+
+    index.tsv records, for each source file and span of frames, the clip
+    that was cut from it. Spans of a source that is unchanged since (same
+    size and mtime) are looked up there, rather than cut and hashed again.
+    """
+
+    def __init__(self, clips_dir):
+        self.clips_dir = clips_dir
+        os.makedirs(clips_dir, exist_ok=True)
+        self.index_file_path = os.path.join(clips_dir, INDEX_FILE_NAME)
+        self.index = dict()
+        self.added = []
+
+        if os.path.isfile(self.index_file_path):
+            with open(self.index_file_path, 'r', encoding='utf-8', newline='') as index_file:
+                for row in csv.DictReader(index_file, delimiter='\t'):
+                    self.index[self.span_key(row['source'], row['source_size'], row['source_mtime_ns'], row['start_frame'], row['end_frame'])] = row
+
+
+    def close(self):
+        self.flush()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def flush(self):
+        if len(self.added) == 0:
+            return
+
+        write_header = not os.path.isfile(self.index_file_path)
+        with open(self.index_file_path, 'a', encoding='utf-8', newline='') as index_file:
+            index = csv.DictWriter(index_file, fieldnames=INDEX_COLUMNS, delimiter='\t')
+            if write_header:
+                index.writeheader()
+            index.writerows(self.added)
+        self.added = []
+
+
+    @staticmethod
+    def span_key(source, source_size, source_mtime_ns, start_frame, end_frame):
+        return (source, int(source_size), int(source_mtime_ns), int(start_frame), int(end_frame))
+
+
+    def clip_path(self, content_hash):
+        return os.path.join(self.clips_dir, content_hash[0:2], content_hash[2:4], content_hash + ".wav")
+
+
+    def lookup(self, key):
+        """
+        The (clip file path, size) previously cut for a span key, if its clip
+        is still in the store
+        """
+        row = self.index.get(key)
+        if row is None:
+            return None
+
+        clip_file_path = os.path.join(self.clips_dir, row['clip'])
+        if not os.path.isfile(clip_file_path):
+            return None
+        return clip_file_path, int(row['size'])
+
+
+    def store_segment(self, segmenter, start_frame, end_frame):
+        header = segmenter.header
+        pcm = segmenter.frames(start_frame, end_frame)
+        try:
+            wav_header = wav_file_header(header.audio_format, header.channels, header.sample_rate, header.bits_per_sample, len(pcm))
+            sha1 = hashlib.sha1(wav_header)
+            sha1.update(pcm)
+            content_hash = sha1.hexdigest()
+
+            clip_file_path = self.clip_path(content_hash)
+            if not os.path.isfile(clip_file_path):
+                os.makedirs(os.path.dirname(clip_file_path), exist_ok=True)
+                segmenter.write(clip_file_path, wav_header, pcm)
+            return content_hash, clip_file_path, len(wav_header) + len(pcm)
+        finally:
+            pcm.release()
+
+
+    def add_segments(self, segmenter, spans, workers=1):
+        """
+        Stores the clips for spans, (start, end) seconds, of the recording
+        open in segmenter. Returns the (clip file path, size) of each span,
+        in order.
+        """
+        stat = os.stat(segmenter.wavfile)
+        source = os.path.abspath(segmenter.wavfile)
+
+        keys = [self.span_key(source, stat.st_size, stat.st_mtime_ns, *segmenter.frame_range(start, end)) for start, end in spans]
+
+        clips = dict()
+        missing = []
+        for key in keys:
+            if key in clips:
+                continue
+            clips[key] = self.lookup(key)
+            if clips[key] is None:
+                missing.append(key)
+
+        def store(key):
+            return self.store_segment(segmenter, key[3], key[4])
+
+        if workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                stored = list(pool.map(store, missing))
+        else:
+            stored = [store(key) for key in missing]
+
+        for key, (content_hash, clip_file_path, size) in zip(missing, stored):
+            row = dict(zip(INDEX_COLUMNS, key))
+            row.update({'content_hash':content_hash, 'clip':os.path.relpath(clip_file_path, self.clips_dir), 'size':size})
+            self.index[key] = row
+            self.added.append(row)
+            clips[key] = (clip_file_path, size)
+
+        return [clips[key] for key in keys]
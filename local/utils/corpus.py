@@ -2,36 +2,54 @@
 # -*- coding: utf-8 -*-
 import os
 import csv
+import json
 import hashlib
 from typing import ContextManager
-import srt 
-import pandas
-import requests
 
+import io
+import bz2
+import gzip
+import lzma
+import shutil
+import itertools
 import functools
-
-from tqdm import tqdm
-from pydub import AudioSegment
+import collections
+import multiprocessing
 
 from datetime import datetime, timedelta
 from pathlib import Path
-from praatio import tgio
 
-from .clean_transcript import clean_transcript
+from .clean_transcript import clean_transcript, ooa_collector, NORMALISER_VERSION
+from .shard import line_shards, read_shard_lines
 
 
 ALPHABET_FILE_PATH = "/DeepSpeech/bin/bangor_welsh/alphabet.txt"
 
+MAX_SHARD_SIZE = 64 * 1024 * 1024
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+STREAM_BATCH_SIZE = 100000
 
+COMPRESSION_MAGIC = {
+    'gzip' : b'\x1f\x8b',
+    'xz' : b'\xfd7zXZ\x00',
+    'bz2' : b'BZh',
+    'zstd' : b'\x28\xb5\x2f\xfd',
+}
+
+# sidecar file recording that a text file is the output of the normaliser
+CLEAN_MARKER_SUFFIX = ".normalised.json"
+
+
+
+def import_csv_textcorpus(csv_file_path, lm_data_root_dir, corpus_name="corpus"):
+    import pandas
 
-def import_csv_textcorpus(csv_file_path, lm_data_root_dir):
-    
     print ("Extracting texts from csv file: %s " % csv_file_path)
     if not os.path.isfile(csv_file_path):
         print ("Proceeding with missing file %s " % csv_file_path)
 
     Path(lm_data_root_dir).mkdir(parents=True, exist_ok=True)    
-    corpus_file_path = os.path.join(lm_data_root_dir, "corpus.txt")
+    corpus_file_path = os.path.join(lm_data_root_dir, corpus_name + ".txt")
 
     df = pandas.read_csv(csv_file_path, encoding='utf-8', sep=',', header=0, dtype={'transcript':str})
     sentences = df['transcript']
@@ -40,30 +58,275 @@ def import_csv_textcorpus(csv_file_path, lm_data_root_dir):
         for t in sentences:
             corpus_file.write(t + "\n")
 
-    return clean_text_corpus(lm_data_root_dir)       
+    return clean_text_corpus(lm_data_root_dir, corpus_name=corpus_name)
 
 
-def clean_text_corpus(lm_data_root_dir):
+def clean_text_corpus(lm_data_root_dir, workers=1, corpus_name="corpus"):
 
     print ("Cleaning corpus files in %s " % lm_data_root_dir)
     
-    source_text_file_path = os.path.join(lm_data_root_dir, "corpus.txt")
-    output_text_file_path = os.path.join(lm_data_root_dir, "corpus.clean.txt")
+    source_text_file_path = os.path.join(lm_data_root_dir, corpus_name + ".txt")
+    output_text_file_path = os.path.join(lm_data_root_dir, corpus_name + ".clean.txt")
 
     ooa_text_file_path = source_text_file_path.replace(".txt", ".ooa.txt")
-    clean = clean_transcript(ALPHABET_FILE_PATH, ooa_text_file_path)
-    
-    with open(output_text_file_path, 'w', encoding='utf-8') as out_file:
-        with open(source_text_file_path, 'r', encoding='utf-8') as in_file:
-            for i, transcript in enumerate(tqdm(in_file)):
-                cleaned, transcript = clean.clean(transcript)
-                if cleaned:
-                    out_file.write(transcript.lower() + "\n")
 
+    return clean_text_file(source_text_file_path, output_text_file_path, ALPHABET_FILE_PATH, ooa_text_file_path, workers)
+
+
+def compression_type(file_path):
+    with open(file_path, 'rb') as in_file:
+        magic = in_file.read(6)
+
+    for compression, compression_magic in COMPRESSION_MAGIC.items():
+        if magic.startswith(compression_magic):
+            return compression
+
+    return None
+
+
+def open_text_source(file_path):
+    """
+    Opens a plain, gzip, xz, bzip2 or zstd compressed text file for reading
+    lines, decompressing as a stream.
+    """
+    compression = compression_type(file_path)
+    if compression is None:
+        return open(file_path, 'r', encoding='utf-8')
+    if compression == 'gzip':
+        return gzip.open(file_path, 'rt', encoding='utf-8')
+    if compression == 'xz':
+        return lzma.open(file_path, 'rt', encoding='utf-8')
+    if compression == 'bz2':
+        return bz2.open(file_path, 'rt', encoding='utf-8')
+
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("%s is zstd compressed. pip install zstandard to read it" % file_path)
+
+    # the decompressor closes the underlying file when it is closed
+    reader = zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+    return io.TextIOWrapper(reader, encoding='utf-8')
+
+
+def clean_text_file(source_text_file_path, output_text_file_path, alphabet_file_path, ooa_text_file_path, workers=1):
+    from tqdm import tqdm
+
+    # compressed sources can't be split into byte ranges, but can be
+    # cleaned as they are streamed.
+    compressed = compression_type(source_text_file_path) is not None
+
+    if workers > 1 and compressed:
+        clean_text_file_streamed(source_text_file_path, output_text_file_path, alphabet_file_path, ooa_text_file_path, workers)
+    elif workers > 1:
+        clean_text_file_sharded(source_text_file_path, output_text_file_path, alphabet_file_path, ooa_text_file_path, workers)
+    else:
+        with clean_transcript(alphabet_file_path, ooa_text_file_path) as clean:
+            with open(output_text_file_path, 'w', encoding='utf-8') as out_file:
+                with open_text_source(source_text_file_path) as in_file:
+                    for i, transcript in enumerate(tqdm(in_file)):
+                        cleaned, transcript = clean.normalise(transcript)
+                        if cleaned:
+                            out_file.write(transcript + "\n")
+
+    write_clean_marker(output_text_file_path, alphabet_file_path)
     return output_text_file_path
 
 
+def alphabet_hash(alphabet_file_path):
+    with open(alphabet_file_path, 'rb') as alphabet_file:
+        return hashlib.sha1(alphabet_file.read()).hexdigest()
+
+
+def clean_marker(text_file_path, alphabet_file_path):
+    stat = os.stat(text_file_path)
+    return {
+        'alphabet_sha1' : alphabet_hash(alphabet_file_path),
+        'normaliser_version' : NORMALISER_VERSION,
+        'size' : stat.st_size,
+        'mtime_ns' : stat.st_mtime_ns
+    }
+
+
+def write_clean_marker(text_file_path, alphabet_file_path):
+    with open(text_file_path + CLEAN_MARKER_SUFFIX, 'w', encoding='utf-8') as marker_file:
+        json.dump(clean_marker(text_file_path, alphabet_file_path), marker_file)
+
+
+def is_clean_text_file(text_file_path, alphabet_file_path):
+    """
+    True if text_file_path was written by clean_text_file against the same
+    alphabet and normaliser version, and hasn't been modified since
+    """
+    try:
+        with open(text_file_path + CLEAN_MARKER_SUFFIX, 'r', encoding='utf-8') as marker_file:
+            marker = json.load(marker_file)
+        return marker == clean_marker(text_file_path, alphabet_file_path)
+    except (OSError, ValueError):
+        return False
+
+
+def copy_file_contents(source_file_path, out_file):
+    """
+    Appends the bytes of source_file_path to the binary out_file, in the
+    kernel with sendfile where possible
+    """
+    out_file.flush()
+    with open(source_file_path, 'rb') as in_file:
+        size = os.fstat(in_file.fileno()).st_size
+        offset = 0
+        try:
+            while offset < size:
+                sent = os.sendfile(out_file.fileno(), in_file.fileno(), offset, min(size - offset, 1024 * 1024 * 1024))
+                if sent == 0:
+                    break
+                offset += sent
+        except (AttributeError, OSError):
+            pass
+
+        if offset < size:
+            in_file.seek(offset)
+            shutil.copyfileobj(in_file, out_file, COPY_BUFFER_SIZE)
+
+
+def clean_text_shard(source_text_file_path, start, end, shard_output_file_path, alphabet_file_path, shard_ooa_file_path):
+    clean = clean_transcript(alphabet_file_path, shard_ooa_file_path)
+    with open(shard_output_file_path, 'w', encoding='utf-8') as out_file:
+        for transcript in read_shard_lines(source_text_file_path, start, end):
+            cleaned, transcript = clean.normalise(transcript)
+            if cleaned:
+                out_file.write(transcript + "\n")
+
+    # the summary is written once, after merging all the shards
+    ooa_state = None
+    if clean.ooa is not None:
+        clean.close(write_summary=False)
+        ooa_state = clean.ooa.state()
+
+    return end - start, ooa_state
+
+
+def clean_text_shard_indexed(indexed_args):
+    i, args = indexed_args
+    return i, clean_text_shard(*args)
+
+
+def clean_text_file_sharded(source_text_file_path, output_text_file_path, alphabet_file_path, ooa_text_file_path, workers):
+    from tqdm import tqdm
+
+    # many more shards than workers, so that progress is reported often and
+    # a few slow shards don't leave the other workers idle at the end.
+    file_size = os.path.getsize(source_text_file_path)
+    num_shards = max(workers * 4, file_size // MAX_SHARD_SIZE + 1)
+    shards = line_shards(source_text_file_path, num_shards)
+
+    print ("Cleaning %s in %s shards with %s workers" % (source_text_file_path, len(shards), workers))
+
+    shard_jobs = []
+    for i, (start, end) in enumerate(shards):
+        shard_output_file_path = "%s.shard%05d" % (output_text_file_path, i)
+        shard_ooa_file_path = "%s.shard%05d" % (ooa_text_file_path, i) if len(ooa_text_file_path) > 0 else ''
+        shard_jobs.append((source_text_file_path, start, end, shard_output_file_path, alphabet_file_path, shard_ooa_file_path))
+
+    ooa_states = [None] * len(shard_jobs)
+    with multiprocessing.Pool(workers) as pool:
+        with tqdm(total=file_size, unit='B', unit_scale=True) as progress:
+            for i, (shard_bytes, ooa_state) in pool.imap_unordered(clean_text_shard_indexed, enumerate(shard_jobs)):
+                ooa_states[i] = ooa_state
+                progress.update(shard_bytes)
+
+    # concatenate in shard order, so that the output is the same as
+    # cleaning the file in a single process
+    concatenate_shards([job[3] for job in shard_jobs], output_text_file_path)
+    if len(ooa_text_file_path) > 0:
+        ooa = ooa_collector(ooa_text_file_path)
+        for job, ooa_state in zip(shard_jobs, ooa_states):
+            ooa.merge(job[5], ooa_state)
+            os.remove(job[5])
+        ooa.close()
+
+    return output_text_file_path
+
+
+class ooa_batch(list):
+    # stands in for an ooa_collector in clean_text_batch, so that rejected
+    # lines can be returned to the main process
+    def add(self, ooa, transcript):
+        self.append((ooa, transcript))
+
+
+batch_clean = None
+
+def init_clean_text_batch(alphabet_file_path):
+    global batch_clean
+    batch_clean = clean_transcript(alphabet_file_path)
+
+
+def clean_text_batch(transcripts):
+    batch_clean.ooa = ooa_batch()
+    cleaned_transcripts = []
+    for transcript in transcripts:
+        cleaned, transcript = batch_clean.normalise(transcript)
+        if cleaned:
+            cleaned_transcripts.append(transcript + "\n")
+
+    return "".join(cleaned_transcripts), batch_clean.ooa
+
+
+def read_batches(in_file, batch_size):
+    while True:
+        batch = list(itertools.islice(in_file, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def clean_text_file_streamed(source_text_file_path, output_text_file_path, alphabet_file_path, ooa_text_file_path, workers):
+    from tqdm import tqdm
+
+    print ("Cleaning %s as a stream with %s workers" % (source_text_file_path, workers))
+
+    ooa = ooa_collector(ooa_text_file_path) if len(ooa_text_file_path) > 0 else None
+
+    def write_batch(result):
+        cleaned_transcripts, rejected = result.get()
+        out_file.write(cleaned_transcripts)
+        if ooa is not None:
+            for ooa_characters, transcript in rejected:
+                ooa.add(ooa_characters, transcript)
+        progress.update(1)
+
+    # batches are submitted in order and written in order. Only a few batches
+    # per worker are in flight at a time, so that memory use stays bounded
+    # however large the source is.
+    pending = collections.deque()
+    with multiprocessing.Pool(workers, init_clean_text_batch, (alphabet_file_path,)) as pool:
+        with open(output_text_file_path, 'w', encoding='utf-8') as out_file:
+            with open_text_source(source_text_file_path) as in_file:
+                with tqdm(unit=' batches') as progress:
+                    for batch in read_batches(in_file, STREAM_BATCH_SIZE):
+                        pending.append(pool.apply_async(clean_text_batch, (batch,)))
+                        if len(pending) >= workers * 2:
+                            write_batch(pending.popleft())
+                    while pending:
+                        write_batch(pending.popleft())
+
+    if ooa is not None:
+        ooa.close()
+
+    return output_text_file_path
+
+
+def concatenate_shards(shard_file_paths, output_file_path):
+    with open(output_file_path, 'wb') as out_file:
+        for shard_file_path in shard_file_paths:
+            with open(shard_file_path, 'rb') as shard_file:
+                shutil.copyfileobj(shard_file, out_file, COPY_BUFFER_SIZE)
+            os.remove(shard_file_path)
+
+
 def get_macsen_textcorpus(url, lm_data_root_dir):
+    import requests
 
     target_dir = os.path.join(lm_data_root_dir, 'macsen')
     Path(target_dir).mkdir(parents=True, exist_ok=True)
@@ -76,16 +339,76 @@ def get_macsen_textcorpus(url, lm_data_root_dir):
     return clean_text_corpus(target_dir)
 
 
-def join_corpus_files(corpus_files, target_languagemodel_data_root_dir, joined_file_name):
-    
+def join_corpus_files(corpus_files, target_languagemodel_data_root_dir, joined_file_name, workers=1, alphabet_file_path=ALPHABET_FILE_PATH):
+    """
+    Joins text corpora into one clean corpus. Files that are already clean
+    for this alphabet (see is_clean_text_file), such as the outputs of
+    clean_text_file, are copied in as they are. Only other files are cleaned.
+    """
     corpus_file_path = os.path.join(target_languagemodel_data_root_dir, joined_file_name)
 
     print ("Join corpus text files %s into %s" % (corpus_files, corpus_file_path) )
 
-    with open(corpus_file_path, 'w', encoding='utf-8') as corpus_outfile:
+    with open(corpus_file_path, 'wb') as corpus_outfile:
         for fname in corpus_files:
-            with open(fname, 'r', encoding='utf-8') as corpus_infile:
-                for line in corpus_infile:
-                    corpus_outfile.write(line)
+            if is_clean_text_file(fname, alphabet_file_path):
+                copy_file_contents(fname, corpus_outfile)
+                continue
+
+            print ("Cleaning %s before joining" % fname)
+            cleaned_file_path = corpus_file_path + ".part"
+            ooa_text_file_path = os.path.splitext(fname)[0] + ".ooa.txt"
+            clean_text_file(fname, cleaned_file_path, alphabet_file_path, ooa_text_file_path, workers)
+            copy_file_contents(cleaned_file_path, corpus_outfile)
+            os.remove(cleaned_file_path)
+            os.remove(cleaned_file_path + CLEAN_MARKER_SUFFIX)
+
+    write_clean_marker(corpus_file_path, alphabet_file_path)
+    return corpus_file_path
+
+
+def link_corpus_files(corpus_files, target_languagemodel_data_root_dir, list_file_name, workers=1, alphabet_file_path=ALPHABET_FILE_PATH):
+    """
+    As join_corpus_files, but rather than writing yet another copy of
+    (large) corpora that are already clean, writes a list of the files that
+    make up the union, one path per line. build_lm_scorer.sh accepts such a
+    .list file as its --text_file, and streams the files in turn.
+    """
+    list_file_path = os.path.join(target_languagemodel_data_root_dir, list_file_name)
+
+    print ("Listing corpus text files %s in %s" % (corpus_files, list_file_path) )
+
+    clean_corpus_files = []
+    for fname in corpus_files:
+        if not is_clean_text_file(fname, alphabet_file_path):
+            # cleaned once into the list's directory, and shared by every
+            # list made there from the same file, until the file changes
+            source_id = hashlib.sha1(os.path.abspath(fname).encode('utf-8')).hexdigest()[:12]
+            cleaned_file_path = os.path.join(target_languagemodel_data_root_dir, "%s.%s.clean.txt" % (os.path.splitext(os.path.basename(fname))[0], source_id))
+            if not is_clean_text_file(cleaned_file_path, alphabet_file_path) or os.path.getmtime(cleaned_file_path) < os.path.getmtime(fname):
+                print ("Cleaning %s before listing" % fname)
+                ooa_text_file_path = os.path.splitext(fname)[0] + ".ooa.txt"
+                clean_text_file(fname, cleaned_file_path, alphabet_file_path, ooa_text_file_path, workers)
+            fname = cleaned_file_path
+        clean_corpus_files.append(os.path.abspath(fname))
+
+    with open(list_file_path, 'w', encoding='utf-8') as list_file:
+        for fname in clean_corpus_files:
+            list_file.write(fname + "\n")
+
+    return list_file_path
+
+
+def read_corpus_list(list_file_path):
+    with open(list_file_path, 'r', encoding='utf-8') as list_file:
+        return [line.rstrip("\n") for line in list_file if len(line.strip()) > 0]
+
 
-    return clean_text_corpus(target_languagemodel_data_root_dir)
\ No newline at end of file
+def stream_corpus_list(list_file_path, out_file):
+    """
+    Writes the union of the corpora listed in list_file_path to the binary
+    out_file (e.g. a pipe into KenLM)
+    """
+    for fname in read_corpus_list(list_file_path):
+        with open(fname, 'rb') as corpus_file:
+            shutil.copyfileobj(corpus_file, out_file, COPY_BUFFER_SIZE)
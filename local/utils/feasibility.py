@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import argparse
+
+import pandas as pd
+
+from .audio import feature_frame_counts
+from .wav_info import wav_info_cache
+
+
+def feasible_transcriptions(df, csv_dir, cache):
+    """
+    Boolean mask of the rows of a DeepSpeech csv whose clip has more feature
+    frames than its transcript has characters, as is_feasible_transcription,
+    for all rows in one pass over their WAV headers
+    """
+    paths = df['wav_filename'].astype(str).map(lambda p: os.path.join(csv_dir, p))
+    info = cache.lookup(paths)
+
+    frames = feature_frame_counts(info['num_frames'].clip(lower=0).values, info['sample_rate'].values)
+    transcript_lengths = df['transcript'].fillna('').astype(str).str.len().values
+
+    return pd.Series((info['num_frames'].values >= 0) & (frames > transcript_lengths), index=df.index)
+
+
+def filter_feasible_csv(csv_file_path, output_csv_file_path, cache_file_path=None, workers=16):
+
+    print ("Filtering %s for feasible transcriptions" % csv_file_path)
+
+    csv_dir = os.path.dirname(os.path.abspath(csv_file_path))
+    if cache_file_path is None:
+        cache_file_path = os.path.join(csv_dir, ".wav_info.sqlite")
+
+    df = pd.read_csv(csv_file_path, encoding='utf-8', dtype={'transcript':str})
+    with wav_info_cache(cache_file_path, workers) as cache:
+        feasible = feasible_transcriptions(df, csv_dir, cache)
+
+    df[feasible].to_csv(output_csv_file_path, index=False, encoding='utf-8')
+    print ("%s of %s rows feasible. Saved to %s" % (feasible.sum(), len(df), output_csv_file_path))
+
+    return output_csv_file_path
+
+
+def main(csvfile, output_csvfile, cache_file_path, workers, **args):
+    if output_csvfile is None:
+        output_csvfile = csvfile.replace(".csv", ".feasible.csv")
+    filter_feasible_csv(csvfile, output_csvfile, cache_file_path, workers)
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Filter a DeepSpeech csv for clips that are long enough for their transcripts')
+
+    parser.add_argument('--csv',
+                        dest='csvfile',
+                        required=True,
+                        help='DeepSpeech CSV file.')
+
+    parser.add_argument('--output_csv',
+                        dest='output_csvfile',
+                        default=None,
+                        help='output CSV file (default: <csv>.feasible.csv)')
+
+    parser.add_argument('--cache',
+                        dest='cache_file_path',
+                        default=None,
+                        help='wav header cache (default: .wav_info.sqlite next to the csv)')
+
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=16,
+                        help='threads reading wav headers that are not cached')
+
+    parser.set_defaults(func=main)
+    args = parser.parse_args()
+    args.func(**vars(args))
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import argparse
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from .audio import compute_input_vector, N_CONTEXT, WINLEN, WINSTEP
+
+
+DEFAULT_CACHE_DIR = "/data/cache/features"
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024 * 1024
+
+# new entries and access times are written to the index in batches of this many
+FLUSH_INTERVAL = 1000
+
+# eviction makes room down to this fraction of max_size, so that a full store
+# isn't scanned for every new entry
+EVICT_TO = 0.9
+
+
+def content_hash(file_path, block_size=1024*1024):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def feature_key(audio_hash, numcep, numcontext, winlen=WINLEN, winstep=WINSTEP):
+    return "%s_%s_%s_%s_%s" % (audio_hash, numcep, numcontext, winlen, winstep)
+
+
+def feature_file_path(cache_dir, key):
+    # sharded by hash prefix, so that no single directory gets too big
+    return os.path.join(cache_dir, key[0:2], key[2:4], key + ".npy")
+
+
+def save_features(cache_dir, key, features):
+    file_path = feature_file_path(cache_dir, key)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_file_path = "%s.%s.tmp" % (file_path, os.getpid())
+    with open(temp_file_path, 'wb') as f:
+        np.save(f, features)
+    os.replace(temp_file_path, file_path)
+    return file_path, os.path.getsize(file_path)
+
+
+class feature_cache(object):
+    """
+    On disk store of MFCC features. Each clip's features are a .npy file,
+    loaded memory mapped, and indexed in sqlite by the clip's content hash and
+    the feature parameters. The least recently used entries are evicted when
+    the store grows beyond max_size bytes, until it is back to EVICT_TO of it.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS features (key TEXT PRIMARY KEY, size INTEGER, last_access REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS features_last_access ON features (last_access)")
+        # access times and new entries are written in batches, rather than on
+        # every lookup or miss
+        self.accessed = dict()
+        self.added = dict()
+        # running total of the size of the store, so that the index is only
+        # scanned when the store may have grown beyond max_size
+        self.total_size = None
+
+
+    def close(self):
+        self.evict()
+        self.flush()
+        self.db.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def get(self, key):
+        file_path = feature_file_path(self.cache_dir, key)
+        try:
+            features = np.load(file_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+        self.accessed[key] = time.time()
+        if len(self.accessed) + len(self.added) >= FLUSH_INTERVAL:
+            self.flush()
+        return features
+
+
+    def put(self, key, features):
+        file_path, size = save_features(self.cache_dir, key, features)
+        self.add(key, size)
+
+
+    def add(self, key, size):
+        total_size = self.size()
+        if key in self.added:
+            replaced = self.added[key]
+        else:
+            row = self.db.execute("SELECT size FROM features WHERE key = ?", (key,)).fetchone()
+            replaced = row[0] if row else 0
+        self.total_size = total_size + size - replaced
+
+        self.added[key] = size
+        if len(self.accessed) + len(self.added) >= FLUSH_INTERVAL:
+            self.flush()
+
+
+    def flush(self):
+        if len(self.added) == 0 and len(self.accessed) == 0:
+            return
+        now = time.time()
+        self.db.executemany("INSERT OR REPLACE INTO features VALUES (?, ?, ?)", [(k, s, now) for k, s in self.added.items()])
+        self.db.executemany("UPDATE features SET last_access = ? WHERE key = ?", [(t, k) for k, t in self.accessed.items()])
+        self.db.commit()
+        self.added.clear()
+        self.accessed.clear()
+
+
+    def size(self):
+        if self.total_size is None:
+            self.flush()
+            self.total_size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM features").fetchone()[0]
+        return self.total_size
+
+
+    def evict(self):
+        if self.size() <= self.max_size:
+            return 0
+
+        # other processes may have added to (or evicted from) the store too
+        self.total_size = None
+        if self.size() <= self.max_size:
+            return 0
+        excess = self.size() - int(self.max_size * EVICT_TO)
+
+        evicted = []
+        for key, size in self.db.execute("SELECT key, size FROM features ORDER BY last_access"):
+            if excess <= 0:
+                break
+            try:
+                os.remove(feature_file_path(self.cache_dir, key))
+            except FileNotFoundError:
+                pass
+            evicted.append((key,))
+            excess -= size
+            self.total_size -= size
+
+        self.db.executemany("DELETE FROM features WHERE key = ?", evicted)
+        self.db.commit()
+        return len(evicted)
+
+
+    def features(self, audio_filename, numcep, numcontext):
+        """
+        audiofile_to_input_vector, served from the cache when the same audio
+        has been featurised with the same parameters before
+        """
+        key = feature_key(content_hash(audio_filename), numcep, numcontext)
+        features = self.get(key)
+        if features is None:
+            features = compute_input_vector(audio_filename, numcep, numcontext)
+            self.put(key, features)
+            self.evict()
+        return features
+
+
+def precompute_clip(job):
+    cache_dir, audio_filename, numcep, numcontext = job
+    try:
+        key = feature_key(content_hash(audio_filename), numcep, numcontext)
+        file_path = feature_file_path(cache_dir, key)
+        if os.path.isfile(file_path):
+            return key, os.path.getsize(file_path), None
+        file_path, size = save_features(cache_dir, key, compute_input_vector(audio_filename, numcep, numcontext))
+        return key, size, None
+    except Exception as e:
+        return None, 0, "%s: %s" % (audio_filename, e)
+
+
+def precompute(cache, audio_filenames, numcep=26, numcontext=N_CONTEXT, workers=os.cpu_count()):
+    """
+    Fills the cache for many clips in a pool of processes. The workers write
+    the feature files; only this process writes to the index.
+    """
+    from tqdm import tqdm
+
+    jobs = [(cache.cache_dir, f, numcep, numcontext) for f in audio_filenames]
+    failed = 0
+    with multiprocessing.Pool(workers) as pool:
+        for key, size, error in tqdm(pool.imap_unordered(precompute_clip, jobs, chunksize=16), total=len(jobs)):
+            if error:
+                print ("Failed to featurise %s" % error)
+                failed += 1
+                continue
+            cache.add(key, size)
+
+    cache.flush()
+    evicted = cache.evict()
+    print ("Featurised %s clips (%s failed). %s evicted. Cache size %.1f GB" % (len(jobs) - failed, failed, evicted, cache.size() / 1e9))
+
+
+
+def main(csvfiles, cache_dir, max_size_gb, numcep, numcontext, workers, **args):
+    audio_filenames = []
+    for csvfile in csvfiles:
+        csv_dir = os.path.dirname(os.path.abspath(csvfile))
+        df = pd.read_csv(csvfile, encoding='utf-8', usecols=['wav_filename'])
+        audio_filenames.extend(os.path.join(csv_dir, f) for f in df['wav_filename'])
+
+    with feature_cache(cache_dir, int(max_size_gb * 1024 * 1024 * 1024)) as cache:
+        precompute(cache, sorted(set(audio_filenames)), numcep, numcontext, workers)
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Precompute MFCC features for the clips in DeepSpeech csv files into the feature cache')
+
+    parser.add_argument('--csv',
+                        dest='csvfiles',
+                        action='append',
+                        required=True,
+                        help='DeepSpeech CSV file. Can be given more than once.')
+
+    parser.add_argument('--cache_dir',
+                        dest='cache_dir',
+                        default=DEFAULT_CACHE_DIR,
+                        help='feature cache directory')
+
+    parser.add_argument('--max_size',
+                        dest='max_size_gb',
+                        type=float,
+                        default=DEFAULT_MAX_SIZE / 1024 / 1024 / 1024,
+                        help='maximum size of the cache in GB')
+
+    parser.add_argument('--numcep', dest='numcep', type=int, default=26)
+    parser.add_argument('--numcontext', dest='numcontext', type=int, default=N_CONTEXT)
+
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='number of processes computing features')
+
+    parser.set_defaults(func=main)
+    args = parser.parse_args()
+    args.func(**vars(args))
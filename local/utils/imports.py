@@ -2,20 +2,16 @@
 # -*- coding: utf-8 -*-
 import os
 import csv
-import hashlib
 from typing import ContextManager
-import srt 
-import pandas
 import functools
 
-from pydub import AudioSegment
 
 from datetime import datetime, timedelta
 from pathlib import Path
 
-from praatio import tgio
-
 from .clean_transcript import clean_transcript
+from .audio import wav_segmenter
+from .clip_store import clip_store
 
 
 ALPHABET_FILE_PATH = "/DeepSpeech/bin/bangor_welsh/alphabet.txt"
@@ -33,91 +29,70 @@ def get_directory_structure(rootdir):
     return dir
 
 
-def import_textgrid(target_csv_file, textfile):
+def import_segments(target_csv_file, soundfile, intervals, workers=1):
+    """
+    Cuts the (start, end, text) intervals, in seconds, that have a clean
+    transcript out of soundfile into the clips directory next to
+    target_csv_file, and returns them as a DeepSpeech DataFrame
+    """
+    import pandas
 
-    print ("Importing clips and transcripts from %s " % textfile)
     target_data_root_dir = Path(target_csv_file).parent
-    
+
     target_clips_dir = os.path.join(target_data_root_dir, "clips")
     Path(target_clips_dir).mkdir(parents=True, exist_ok=True)
 
-    df = pandas.DataFrame(columns=['wav_filename', 'wav_filesize', 'transcript'])
-
-    textgrid_file_path = os.path.join(target_data_root_dir, textfile)
-    soundfile = textgrid_file_path.replace(".TextGrid",".wav")
-
-    audio_file = AudioSegment.from_wav(os.path.join(target_data_root_dir, soundfile))
-
     ooa_text_file_path = os.path.join(target_data_root_dir, 'deepspeech.ooa.txt')
     clean = clean_transcript(ALPHABET_FILE_PATH, ooa_text_file_path)
 
-    tg = tgio.openTextgrid(textgrid_file_path)
-    entryList = tg.tierDict["utterance"].entryList
-    i=0
-    for interval in entryList:
-        text = interval.label        
+    rows = []
+    for start, end, text in intervals:
         cleaned, transcript = clean.clean(text)
-            
+
         if cleaned and len(transcript)>0:
             transcript = transcript.lower()
-                
-            start = float(interval.start) * 1000
-            end = float(interval.end) * 1000
-
-            #print (start, end, transcript)
+            rows.append((start, end, transcript))
 
-            split_audio = audio_file[start:end]  
-            hashId = hashlib.md5(transcript.encode('utf-8')).hexdigest()
-            wav_segment_filepath = os.path.join(target_clips_dir, hashId + ".wav")   
-            split_audio.export(wav_segment_filepath, format="wav")
+    clean.close()
 
-            df.loc[i] = [wav_segment_filepath, os.path.getsize(wav_segment_filepath), transcript]
-            i += 1
+    with wav_segmenter(os.path.join(target_data_root_dir, soundfile)) as segmenter, clip_store(target_clips_dir) as clips:
+        clip_files = clips.add_segments(segmenter, [(start, end) for start, end, transcript in rows], workers)
 
-    return df
+    return pandas.DataFrame([[f, size, t] for (f, size), (start, end, t) in zip(clip_files, rows)], columns=['wav_filename', 'wav_filesize', 'transcript'])
 
 
-def import_srt(target_csv_file, srtfile):
+def import_textgrid(target_csv_file, textfile, workers=1):
 
-    print ("Importing transcripts from srt file in %s " % srtfile)    
+    print ("Importing clips and transcripts from %s " % textfile)
     target_data_root_dir = Path(target_csv_file).parent
 
-    target_clips_dir = os.path.join(target_data_root_dir, "clips")
-    Path(target_clips_dir).mkdir(parents=True, exist_ok=True)
+    textgrid_file_path = os.path.join(target_data_root_dir, textfile)
+    soundfile = textgrid_file_path.replace(".TextGrid",".wav")
 
-    df = pandas.DataFrame(columns=['wav_filename', 'wav_filesize', 'transcript'])
+    from praatio import tgio
 
-    srt_file_path = os.path.join(target_data_root_dir, srtfile)
-    soundfile = srt_file_path.replace(".srt",".wav")
+    tg = tgio.openTextgrid(textgrid_file_path)
+    entryList = tg.tierDict["utterance"].entryList
+    intervals = [(float(interval.start), float(interval.end), interval.label) for interval in entryList]
 
-    audio_file = AudioSegment.from_wav(os.path.join(target_data_root_dir, soundfile))
+    return import_segments(target_csv_file, soundfile, intervals, workers)
 
-    ooa_text_file_path = os.path.join(target_data_root_dir, 'deepspeech.ooa.txt')
-    clean = clean_transcript(ALPHABET_FILE_PATH, ooa_text_file_path)
 
-    subs = list(srt.parse(open(srt_file_path, 'r', encoding='utf-8').read()))
-    i = 0
-    for s in subs:
-        text = s.content 
-        cleaned, transcript = clean.clean(text)
-            
-        if cleaned and len(transcript)>0:
-            transcript = transcript.lower()
+def import_srt(target_csv_file, srtfile, workers=1):
 
-            start = float(s.start.total_seconds()) * 1000
-            end = float(s.end.total_seconds()) * 1000
+    print ("Importing transcripts from srt file in %s " % srtfile)    
+    target_data_root_dir = Path(target_csv_file).parent
 
-            #print (start, end, transcript)
+    srt_file_path = os.path.join(target_data_root_dir, srtfile)
+    soundfile = srt_file_path.replace(".srt",".wav")
 
-            split_audio = audio_file[start:end]  
-            hashId = hashlib.md5(transcript.encode('utf-8')).hexdigest()
-            wav_segment_filepath = os.path.join(target_clips_dir, hashId + ".wav")   
-            split_audio.export(wav_segment_filepath, format="wav")
+    import srt
 
-            df.loc[i] = [wav_segment_filepath, os.path.getsize(wav_segment_filepath), transcript]
-            i += 1                                    
+    with open(srt_file_path, 'r', encoding='utf-8') as srt_file:
+        subs = list(srt.parse(srt_file.read()))
+    intervals = [(s.start.total_seconds(), s.end.total_seconds(), s.content) for s in subs]
 
-    return df
+    return import_segments(target_csv_file, soundfile, intervals, workers)
 
 
 
@@ -154,5 +129,7 @@ def import_clips_dir(target_testset_dir, **args):
                             'transcript':transcript
                         })
     
+    clean.close()
+
     #return pandas.read_csv(csv_file_path, delimiter=',', encoding='utf-8')
     return csv_file_path
@@ -4,48 +4,174 @@ from __future__ import absolute_import, division, print_function
 
 import os
 import sys
-import pandas as pd
+import csv
+import heapq
+import numpy as np
 
 from pathlib import Path
 
-from sklearn.model_selection import KFold
-from sklearn import datasets, linear_model
-from sklearn.model_selection import train_test_split
-
 import argparse
 
-def create_kfolds(csvfile, dest_dir, k):
-    
+
+FOLD_COLUMN = 'fold'
+
+
+def kfold_assignments(num_rows, k, seed=2, groups=None, weights=None):
+    """
+    The fold (0 to k-1) of each of num_rows rows, as a compact integer array.
+
+    Without groups or weights, rows are shuffled and cut into k folds of
+    (nearly) equal size, exactly as sklearn's KFold(shuffle=True,
+    random_state=seed) does, so that existing folds stay the same.
+
+    Otherwise each group (e.g. a speaker; each row is its own group if no
+    groups are given) goes to a single fold, so that no group is in both a
+    fold's train and test sets. Groups are placed largest first, each into
+    the fold with the least so far, measuring size by the sum of weights
+    (e.g. durations) or else by rows.
+    """
+    dtype = np.int8 if k < 128 else np.int32
+
+    if groups is None and weights is None:
+        indices = np.arange(num_rows)
+        np.random.RandomState(seed).shuffle(indices)
+        fold_sizes = np.full(k, num_rows // k, dtype=np.int64)
+        fold_sizes[:num_rows % k] += 1
+        folds = np.empty(num_rows, dtype=dtype)
+        folds[indices] = np.repeat(np.arange(k, dtype=dtype), fold_sizes)
+        return folds
+
+    if groups is None:
+        group_index = np.arange(num_rows)
+        num_groups = num_rows
+    else:
+        _, group_index = np.unique(np.asarray(groups), return_inverse=True)
+        num_groups = group_index.max() + 1 if num_rows > 0 else 0
+
+    group_sizes = np.bincount(group_index, weights=weights, minlength=num_groups)
+
+    # shuffled first, so that groups of equal size are placed at random
+    order = np.random.RandomState(seed).permutation(num_groups)
+    order = order[np.argsort(-group_sizes[order], kind='stable')]
+
+    group_folds = np.empty(num_groups, dtype=dtype)
+    loads = [(0.0, fold) for fold in range(k)]
+    for group in order:
+        load, fold = heapq.heappop(loads)
+        group_folds[group] = fold
+        heapq.heappush(loads, (load + group_sizes[group], fold))
+
+    return group_folds[group_index]
+
+
+def read_kfold_columns(csvfile, group_by=None, balance_duration=False):
+    """
+    Only the columns that folds are made from, rather than the whole csv.
+    group_by is a column name, or a dict from wav_filename to group.
+    Returns (number of rows, groups, weights).
+    """
+    import pandas as pd
+
+    columns = ['wav_filename']
+    if isinstance(group_by, str):
+        columns.append(group_by)
+    if balance_duration:
+        # all clips are 16kHz mono, so their size is in proportion to their duration
+        columns.append('wav_filesize')
+
+    df = pd.read_csv(csvfile, encoding='utf-8', usecols=columns, dtype={'wav_filename':str})
+
+    groups = None
+    if isinstance(group_by, str):
+        groups = df[group_by].astype(str).values
+    elif group_by is not None:
+        groups = df['wav_filename'].map(lambda f: group_by.get(f, f)).astype(str).values
+
+    weights = df['wav_filesize'].values.astype(np.float64) if balance_duration else None
+    return len(df), groups, weights
+
+
+def write_kfold_csvs(csvfile, dest_dir, folds, k):
+    """
+    Streams the rows of csvfile into train_<n>.csv and test_<n>.csv for each
+    fold n (1 to k), without holding the csv in memory.
+    """
+    train_files = [open(os.path.join(dest_dir, 'train_%s.csv' % (n + 1)), 'w', encoding='utf-8', newline='') for n in range(k)]
+    test_files = [open(os.path.join(dest_dir, 'test_%s.csv' % (n + 1)), 'w', encoding='utf-8', newline='') for n in range(k)]
+    try:
+        train_writers = [csv.writer(f, lineterminator='\n') for f in train_files]
+        test_writers = [csv.writer(f, lineterminator='\n') for f in test_files]
+
+        with open(csvfile, 'r', encoding='utf-8', newline='') as in_file:
+            reader = csv.reader(in_file)
+            header = next(reader)
+            for writer in train_writers + test_writers:
+                writer.writerow(header)
+
+            for row, fold in zip(reader, folds):
+                test_writers[fold].writerow(row)
+                for n in range(k):
+                    if n != fold:
+                        train_writers[n].writerow(row)
+    finally:
+        for f in train_files + test_files:
+            f.close()
+
+
+def write_fold_column(csvfile, dest_file, folds, chunksize=100000):
+    """
+    Writes csvfile with an extra FOLD_COLUMN (1 to k) to dest_file, as a
+    single alternative to 2 x k csv files. See read_fold.
+    """
+    import pandas as pd
+
+    offset = 0
+    for i, chunk in enumerate(pd.read_csv(csvfile, encoding='utf-8', dtype=str, keep_default_na=False, chunksize=chunksize)):
+        chunk[FOLD_COLUMN] = folds[offset:offset + len(chunk)].astype(np.int32) + 1
+        chunk.to_csv(dest_file, index=False, encoding='utf-8', mode='w' if i == 0 else 'a', header=(i == 0))
+        offset += len(chunk)
+
+
+def read_fold(kfolds_csv, fold, train, chunksize=100000):
+    """
+    The train (or test) rows of fold (1 to k) from a csv written by
+    write_fold_column, filtered as it is read, chunk by chunk.
+    """
+    import pandas as pd
+
+    for chunk in pd.read_csv(kfolds_csv, encoding='utf-8', dtype={'transcript':str}, chunksize=chunksize):
+        in_fold = chunk[FOLD_COLUMN] == fold
+        yield chunk[~in_fold if train else in_fold].drop(columns=[FOLD_COLUMN])
+
+
+def create_kfolds(csvfile, dest_dir, k, group_by=None, balance_duration=False, fold_column=False, seed=2):
+    import pandas as pd
+
     print ("Splitting %s into kfolds" % csvfile)
 
     Path(dest_dir).mkdir(parents=True, exist_ok=True)
-    
-    kf = KFold(n_splits=k, shuffle=True, random_state=2)
 
     try:
-        speech_corpus_df = pd.read_csv(csvfile, encoding='utf-8', delimiter=',')
+        num_rows, groups, weights = read_kfold_columns(csvfile, group_by, balance_duration)
     except pd.errors.EmptyDataError:
         print ("Failed to split %s into kfolds" % csvfile)
         return
 
-    fold_num = 0
-    for train_indexes, test_indexes in kf.split(speech_corpus_df):
-        fold_num+=1
+    if groups is not None and len(set(groups)) < k:
+        print ("Only %s groups in %s, fewer than %s folds. Not grouping" % (len(set(groups)), csvfile, k))
+        groups = None
 
-        train_file = os.path.join(dest_dir, 'train_' + str(fold_num) + '.csv')
-        train_df = pd.DataFrame(speech_corpus_df.iloc[train_indexes])
-        train_df.to_csv(train_file, index=False, sep=',', encoding='utf-8')
-        
-        test_file = os.path.join(dest_dir, 'test_' + str(fold_num) + '.csv')
-        test_df = pd.DataFrame(speech_corpus_df.iloc[test_indexes])
-        test_df.to_csv(test_file, index=False, sep=',', encoding='utf-8')
+    folds = kfold_assignments(num_rows, k, seed, groups, weights)
 
-        #print ('train: %s, test %s' % (train_indexes, test_indexes))
+    if fold_column:
+        write_fold_column(csvfile, os.path.join(dest_dir, 'kfolds.csv'), folds)
+    else:
+        write_kfold_csvs(csvfile, dest_dir, folds, k)
 
 
 
-def main(csvfile, dest_dir, k, **args):
-    create_kfolds(csvfile, dest_dir, k)
+def main(csvfile, dest_dir, k, group_column, balance_duration, fold_column, **args):
+    create_kfolds(csvfile, dest_dir, int(k), group_column, balance_duration, fold_column)
 
 
 
@@ -53,12 +179,12 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='k-fold')
 
-    parser.add_argument('--k', 
+    parser.add_argument('--k',
                         dest="k",
                         default=10,
                         help='k')
 
-    parser.add_argument('--csv', 
+    parser.add_argument('--csv',
                         dest='csvfile',
                         required=True,
                         help='DeepSpeech CSV file.')
@@ -68,7 +194,21 @@ if __name__ == '__main__':
                         required=True,
                         help='dest dir')
 
+    parser.add_argument('--group_column',
+                        dest='group_column',
+                        default=None,
+                        help='column (e.g. client_id) whose values are kept within a single fold')
+
+    parser.add_argument('--balance_duration',
+                        dest='balance_duration',
+                        action='store_true',
+                        help='make folds of even duration (by wav_filesize) rather than of even numbers of clips')
+
+    parser.add_argument('--fold_column',
+                        dest='fold_column',
+                        action='store_true',
+                        help='write one kfolds.csv with a fold column, rather than train_n.csv and test_n.csv for each fold')
+
     parser.set_defaults(func=main)
     args = parser.parse_args()
     args.func(**vars(args))
-
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import hashlib
+import itertools
+import multiprocessing
+
+from .corpus import compression_type, open_text_source, read_corpus_list
+from .shard import line_shards, read_shard_lines
+
+# numpy and pandas are imported by the functions that count and estimate, so
+# that build_lm_scorers.py doesn't pay for them at startup when its scorers
+# are up to date.
+
+ARPA_ORDER = 6
+TOP_K = 50000
+
+# as generate_lm.py is given --arpa_prune in build_lm_scorer.sh: n-grams seen
+# no more than this many times are pruned (the last value for higher orders)
+ARPA_PRUNE = [0, 0, 1]
+
+# n-grams whose hash falls in 1 / 2**SAMPLE_BITS of the hash space are
+# counted exactly, and the counts of all n-grams estimated from them
+SAMPLE_BITS = 8
+
+BATCH_LINES = 100000
+MAX_SHARD_SIZE = 64 * 1024 * 1024
+
+COUNTS_SUFFIX = ".lm_counts.pickle"
+COUNTS_VERSION = 1
+
+SENTENCE_START = "<s>"
+SENTENCE_END = "</s>"
+
+# lmplz writes probabilities and backoffs as e.g. -4.4870243
+ARPA_FLOAT_BYTES = 10
+
+# lmplz sorts records of 4 byte word ids and an 8 byte count per n-gram,
+# and works within --memory by spilling sorted blocks to disk beyond it
+LMPLZ_WORD_BYTES = 4
+LMPLZ_COUNT_BYTES = 8
+
+MB = 1024 * 1024
+MIN_LMPLZ_MEMORY = 1024 * MB
+MAX_LMPLZ_MEMORY_FRACTION = 0.85
+
+MIX_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+class corpus_counts(object):
+    """
+    Word frequencies of a corpus, in order of first occurrence as
+    generate_lm.py's Counter has them, and exact counts of the sample of its
+    n-grams (of order 2 and up, one dict per order) whose hash has
+    sample_bits trailing zeros.
+    """
+
+    def __init__(self, order=ARPA_ORDER, sample_bits=SAMPLE_BITS):
+        self.order = order
+        self.sample_bits = sample_bits
+        self.lines = 0
+        self.tokens = 0
+        self.bytes = 0
+        self.lowercase = True
+        self.words = dict()
+        self.ngrams = [dict() for n in range(2, order + 1)]
+
+
+    def add(self, other):
+        # merged in corpus order, so that words keep their first occurrence order
+        self.lines += other.lines
+        self.tokens += other.tokens
+        self.bytes += other.bytes
+        self.lowercase = self.lowercase and other.lowercase
+        add_counts(self.words, other.words)
+        for ngrams, other_ngrams in zip(self.ngrams, other.ngrams):
+            add_counts(ngrams, other_ngrams)
+        return self
+
+
+    def top_words(self, top_k=TOP_K):
+        # as Counter.most_common(top_k): by count, then by first occurrence
+        return [word for word, count in sorted(self.words.items(), key=lambda item: item[1], reverse=True)[:top_k]]
+
+
+def add_counts(counts, other_counts):
+    for key, count in other_counts.items():
+        counts[key] = counts.get(key, 0) + count
+
+
+def word_hash(word):
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def mix(hashes):
+    # splitmix64's finaliser, so that the low bits sampled on depend on every word
+    import numpy as np
+
+    hashes = hashes ^ (hashes >> np.uint64(30))
+    hashes = hashes * np.uint64(0xBF58476D1CE4E5B9)
+    hashes = hashes ^ (hashes >> np.uint64(27))
+    hashes = hashes * np.uint64(0x94D049BB133111EB)
+    return hashes ^ (hashes >> np.uint64(31))
+
+
+def count_batch(counts, lines, word_hashes):
+    """
+    Adds a batch of lines to counts. The batch is lowercased and split in
+    one go, with sentence start and end markers around every line as lmplz
+    sees them, and its words factorized into one flat array, so that the
+    hash of every n-gram of an order is computed at once from those of
+    order n-1.
+    """
+    import numpy as np
+    import pandas as pd
+
+    text = "".join(line if line.endswith("\n") else line + "\n" for line in lines)
+    lower_text = text.lower()
+    counts.bytes += len(text.encode('utf-8')) - (0 if lines[-1].endswith("\n") else 1)
+    counts.lowercase = counts.lowercase and lower_text == text
+    counts.lines += len(lines)
+
+    tokens = (SENTENCE_START + " " + lower_text.replace("\n", " %s %s " % (SENTENCE_END, SENTENCE_START))).split()[:-1]
+    codes, uniques = pd.factorize(np.array(tokens, dtype=object))
+
+    # the batch starts with a sentence start marker, so its code is 0
+    sentence_ids = np.cumsum(codes == 0) - 1
+    word_counts = np.bincount(codes, minlength=len(uniques))
+    for word, count in zip(uniques, word_counts.tolist()):
+        if word != SENTENCE_START and word != SENTENCE_END:
+            counts.words[word] = counts.words.get(word, 0) + count
+    counts.tokens += len(tokens) - 2 * len(lines)
+
+    for word in uniques:
+        if word not in word_hashes:
+            word_hashes[word] = word_hash(word)
+    hashes = np.array([word_hashes[word] for word in uniques], dtype=np.uint64)[codes]
+
+    sample_mask = np.uint64((1 << counts.sample_bits) - 1)
+    multiplier = np.uint64(MIX_MULTIPLIER)
+    ngram_hashes = hashes
+    for n in range(2, counts.order + 1):
+        ngram_hashes = mix(ngram_hashes[:-1] * multiplier + hashes[n - 1:])
+        within_sentence = sentence_ids[:len(ngram_hashes)] == sentence_ids[n - 1:]
+        starts = np.flatnonzero(within_sentence & ((ngram_hashes & sample_mask) == 0))
+        if len(starts) == 0:
+            continue
+        windows = uniques.take(codes[starts[:, None] + np.arange(n)])
+        add_counts(counts.ngrams[n - 2], count_strings(" ".join(words) for words in windows.tolist()))
+
+
+def count_strings(strings):
+    counts = dict()
+    for s in strings:
+        counts[s] = counts.get(s, 0) + 1
+    return counts
+
+
+def count_lines(lines, order=ARPA_ORDER, sample_bits=SAMPLE_BITS):
+    counts = corpus_counts(order, sample_bits)
+    word_hashes = dict()
+    while True:
+        batch = list(itertools.islice(lines, BATCH_LINES))
+        if len(batch) == 0:
+            return counts
+        count_batch(counts, batch, word_hashes)
+
+
+def count_shard(job):
+    file_path, start, end, order, sample_bits = job
+    if start is None:
+        # compressed files can't be split into byte ranges
+        with open_text_source(file_path) as in_file:
+            return count_lines(in_file, order, sample_bits)
+    return count_lines(read_shard_lines(file_path, start, end), order, sample_bits)
+
+
+def counts_header(text_file_path, order, sample_bits):
+    stat = os.stat(text_file_path)
+    return {
+        'version' : COUNTS_VERSION,
+        'size' : stat.st_size,
+        'mtime_ns' : stat.st_mtime_ns,
+        'order' : order,
+        'sample_bits' : sample_bits
+    }
+
+
+def read_cached_counts(text_file_path, order, sample_bits):
+    """
+    The counts saved next to text_file_path, if it hasn't changed since and
+    they were made with the same parameters. Otherwise None.
+    """
+    try:
+        with open(text_file_path + COUNTS_SUFFIX, 'rb') as counts_file:
+            header, counts = pickle.load(counts_file)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        return None
+
+    if header != counts_header(text_file_path, order, sample_bits):
+        return None
+    return counts
+
+
+def write_cached_counts(text_file_path, counts):
+    temp_file_path = "%s%s.%s.tmp" % (text_file_path, COUNTS_SUFFIX, os.getpid())
+    try:
+        with open(temp_file_path, 'wb') as counts_file:
+            pickle.dump((counts_header(text_file_path, counts.order, counts.sample_bits), counts), counts_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file_path, text_file_path + COUNTS_SUFFIX)
+    except OSError as e:
+        # e.g. a read only corpus. Counted again next time.
+        print ("Counts of %s not cached: %s" % (text_file_path, e))
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+
+
+def count_text_files(text_file_paths, order=ARPA_ORDER, sample_bits=SAMPLE_BITS, workers=1):
+    """
+    The counts of the union of text_file_paths (e.g. a base corpus and a
+    k-fold's transcripts). Each file is counted in shards, in parallel, and
+    its counts cached next to it, so that a corpus shared by many builds is
+    only counted once.
+    """
+    file_counts = dict()
+    jobs = []
+    for text_file_path in text_file_paths:
+        if text_file_path in file_counts:
+            continue
+        file_counts[text_file_path] = read_cached_counts(text_file_path, order, sample_bits)
+        if file_counts[text_file_path] is not None:
+            print ("Counts of %s are up to date" % text_file_path)
+        elif compression_type(text_file_path) is not None:
+            jobs.append((text_file_path, None, None, order, sample_bits))
+        else:
+            num_shards = max(workers * 4, os.path.getsize(text_file_path) // MAX_SHARD_SIZE + 1)
+            for start, end in line_shards(text_file_path, num_shards):
+                jobs.append((text_file_path, start, end, order, sample_bits))
+
+    counted = [f for f, counts in file_counts.items() if counts is None]
+    for text_file_path in counted:
+        file_counts[text_file_path] = corpus_counts(order, sample_bits)
+
+    if len(jobs) > 0:
+        print ("Counting words and n-grams in %s shards with %s workers" % (len(jobs), workers))
+        # shards come back in order, and are merged in order
+        with multiprocessing.Pool(workers) as pool:
+            for job, counts in zip(jobs, pool.imap(count_shard, jobs)):
+                file_counts[job[0]].add(counts)
+
+    for text_file_path in counted:
+        write_cached_counts(text_file_path, file_counts[text_file_path])
+
+    total = corpus_counts(order, sample_bits)
+    for text_file_path in text_file_paths:
+        total.add(file_counts[text_file_path])
+    return total
+
+
+def cached_counts(text_file_paths, order=ARPA_ORDER, sample_bits=SAMPLE_BITS):
+    """
+    The counts of the union of text_file_paths from their caches alone, or
+    None if any of them hasn't been counted (or has changed since).
+    """
+    total = corpus_counts(order, sample_bits)
+    for text_file_path in text_file_paths:
+        counts = read_cached_counts(text_file_path, order, sample_bits)
+        if counts is None:
+            return None
+        total.add(counts)
+    return total
+
+
+def prune_threshold(n, arpa_prune=ARPA_PRUNE):
+    return arpa_prune[min(n, len(arpa_prune)) - 1]
+
+
+def arpa_line_bytes(ngram, n, order):
+    # probability, n-gram and (below the highest order) backoff
+    return ARPA_FLOAT_BYTES + 1 + len(ngram.encode('utf-8')) + (1 + ARPA_FLOAT_BYTES if n < order else 0) + 1
+
+
+def estimate_lm(counts, top_k=TOP_K, arpa_prune=ARPA_PRUNE, total_memory=None):
+    """
+    Estimates, from counts, the number of n-grams of each order that lmplz
+    counts, keeps after pruning and keeps after filtering by the top_k
+    vocabulary, the sizes of lm.arpa, lm_filtered.arpa and a quantized trie
+    lm.binary, and the memory for lmplz to sort its n-grams without
+    spilling to disk (capped at 85% of total_memory)
+    """
+    import numpy as np
+
+    scale = 1 << counts.sample_bits
+    vocab = set(counts.top_words(top_k)) | set([SENTENCE_START, SENTENCE_END])
+    order = counts.order
+
+    # unigrams are counted exactly. <unk>, <s> and </s> are added by lmplz
+    unigram_bytes = sum(arpa_line_bytes(word, 1, order) for word in counts.words)
+    ngrams = [{
+        'order' : 1,
+        'counted' : len(counts.words) + 3,
+        'pruned' : len(counts.words) + 3,
+        'filtered' : min(top_k, len(counts.words)) + 3
+    }]
+    arpa_bytes = unigram_bytes
+    filtered_arpa_bytes = sum(arpa_line_bytes(word, 1, order) for word in vocab)
+
+    for n, sampled in enumerate(counts.ngrams, start=2):
+        threshold = prune_threshold(n, arpa_prune)
+        kept = [ngram for ngram, count in sampled.items() if count > threshold]
+        filtered = [ngram for ngram in kept if all(word in vocab for word in ngram.split(" "))]
+        ngrams.append({
+            'order' : n,
+            'counted' : len(sampled) * scale,
+            'pruned' : len(kept) * scale,
+            'filtered' : len(filtered) * scale
+        })
+        arpa_bytes += sum(arpa_line_bytes(ngram, n, order) for ngram in kept) * scale
+        filtered_arpa_bytes += sum(arpa_line_bytes(ngram, n, order) for ngram in filtered) * scale
+
+    # trie with 8 bit quantized probabilities and backoffs (build_binary -q 8):
+    # unigrams are a plain array of probability, backoff and pointer, and
+    # each higher order n-gram has a word id, quantized values and, below the
+    # highest order, a pointer to its extensions
+    word_bits = max(1, int(np.ceil(np.log2(max(ngrams[0]['filtered'], 2)))))
+    binary_bits = ngrams[0]['filtered'] * 16 * 8
+    for i, entry in enumerate(ngrams[1:], start=1):
+        n = entry['order']
+        if n < order:
+            pointer_bits = int(np.ceil(np.log2(max(ngrams[i + 1]['filtered'], 2))))
+            binary_bits += entry['filtered'] * (word_bits + 16 + pointer_bits)
+        else:
+            binary_bits += entry['filtered'] * (word_bits + 8)
+
+    lmplz_memory = sum(entry['counted'] * (entry['order'] * LMPLZ_WORD_BYTES + LMPLZ_COUNT_BYTES) for entry in ngrams)
+    lmplz_memory = max(MIN_LMPLZ_MEMORY, lmplz_memory)
+    if total_memory is not None:
+        lmplz_memory = min(lmplz_memory, max(MIN_LMPLZ_MEMORY, int(total_memory * MAX_LMPLZ_MEMORY_FRACTION)))
+
+    return {
+        'lines' : counts.lines,
+        'tokens' : counts.tokens,
+        'bytes' : counts.bytes,
+        'words' : len(counts.words),
+        'lowercase' : counts.lowercase,
+        'top_k' : top_k,
+        'order' : order,
+        'sample_bits' : counts.sample_bits,
+        'ngrams' : ngrams,
+        'arpa_bytes' : int(arpa_bytes),
+        'filtered_arpa_bytes' : int(filtered_arpa_bytes),
+        'binary_bytes' : int(binary_bits // 8),
+        'lmplz_memory_bytes' : int(lmplz_memory),
+        'lmplz_memory' : "%dM" % (lmplz_memory // MB)
+    }
+
+
+def physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def write_vocab(words, vocab_file_path):
+    # as generate_lm.py writes it, without a final newline
+    with open(vocab_file_path, 'w', encoding='utf-8') as vocab_file:
+        vocab_file.write("\n".join(words))
+    return vocab_file_path
+
+
+def text_file_paths(text_file_path):
+    # a .list names the corpus files that together make up the corpus
+    if text_file_path.endswith(".list"):
+        return read_corpus_list(text_file_path)
+    return [text_file_path]
+
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from .manifest import import_manifest
+
+
+DEFAULT_CACHE_DIR = "/data/cache/logits"
+
+
+def checkpoint_hash(checkpoint_dir):
+    """
+    Identifies the checkpoint that DeepSpeech would load from checkpoint_dir.
+    A TensorFlow checkpoint's .index file holds a checksum of every tensor,
+    so hashing it is enough to tell checkpoints apart.
+    """
+    import tensorflow.compat.v1 as tfv1
+
+    for checkpoint_filename in ['best_dev_checkpoint', 'checkpoint']:
+        checkpoint_state = tfv1.train.get_checkpoint_state(checkpoint_dir, checkpoint_filename)
+        if checkpoint_state is not None:
+            break
+    else:
+        raise FileNotFoundError("No checkpoint in %s" % checkpoint_dir)
+
+    with open(checkpoint_state.model_checkpoint_path + ".index", 'rb') as index_file:
+        return hashlib.sha1(index_file.read()).hexdigest()
+
+
+def compute_logits(test_csv):
+    """
+    Runs the acoustic model, loaded as evaluate.py does from the DeepSpeech
+    FLAGS, over the clips of test_csv. Returns a dict of wav_filename to
+    softmax outputs (time steps x alphabet + 1), ready for the CTC decoder.
+    """
+    import tensorflow as tf
+    import tensorflow.compat.v1 as tfv1
+
+    from deepspeech_training.train import create_model
+    from deepspeech_training.util.checkpoints import load_graph_for_evaluation
+    from deepspeech_training.util.config import Config
+    from deepspeech_training.util.feeding import create_dataset
+    from deepspeech_training.util.flags import FLAGS
+
+    tfv1.reset_default_graph()
+
+    test_set = create_dataset([test_csv], batch_size=FLAGS.test_batch_size, train_phase=False, reverse=FLAGS.reverse_test, limit=FLAGS.limit_test)
+    iterator = tfv1.data.Iterator.from_structure(tfv1.data.get_output_types(test_set),
+                                                 tfv1.data.get_output_shapes(test_set),
+                                                 output_classes=tfv1.data.get_output_classes(test_set))
+    batch_wav_filename, (batch_x, batch_x_len), batch_y = iterator.get_next()
+
+    no_dropout = [None] * 6
+    logits, _ = create_model(batch_x=batch_x, seq_length=batch_x_len, dropout=no_dropout)
+    transposed = tf.nn.softmax(tf.transpose(a=logits, perm=[1, 0, 2]))
+
+    probs = dict()
+    with tfv1.Session(config=Config.session_config) as session:
+        load_graph_for_evaluation(session)
+        session.run(iterator.make_initializer(test_set))
+        while True:
+            try:
+                batch_probs, batch_lengths, batch_filenames = session.run([transposed, batch_x_len, batch_wav_filename])
+            except tf.errors.OutOfRangeError:
+                break
+
+            for wav_filename, clip_probs, length in zip(batch_filenames, batch_probs, batch_lengths):
+                probs[wav_filename.decode('utf-8')] = clip_probs[:length]
+
+    return probs
+
+
+class logits_cache(object):
+    """
+    On disk store of the acoustic model's outputs, one compressed .npz per
+    clip, under a directory for the checkpoint that computed them and named
+    by the sha1 of the clip's audio. Moving or renaming clips, or listing
+    them in another test csv, does not invalidate them, and clips shared by
+    several test sets are only run through the model once.
+
+    clips.json remembers each clip file's hash for as long as its size and
+    mtime are unchanged, so clips are not read again just to look them up.
+    """
+
+    def __init__(self, checkpoint_dir, cache_dir=DEFAULT_CACHE_DIR):
+        self.checkpoint = checkpoint_hash(checkpoint_dir)
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.clips = import_manifest(os.path.join(cache_dir, "clips.json"))
+
+
+    def close(self):
+        self.clips.save()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def logits_file_path(self, wav_filename):
+        clip_hash = self.clips.file_hash(wav_filename)
+        return os.path.join(self.cache_dir, self.checkpoint[:12], clip_hash[0:2], clip_hash[2:4], clip_hash + ".npz")
+
+
+    def get(self, wav_filename):
+        try:
+            with np.load(self.logits_file_path(wav_filename)) as cached:
+                return cached['probs']
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+    def put(self, wav_filename, probs):
+        file_path = self.logits_file_path(wav_filename)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        temp_file_path = "%s.%s.tmp.npz" % (file_path[:-len(".npz")], os.getpid())
+        np.savez_compressed(temp_file_path, probs=probs.astype(np.float32))
+        os.replace(temp_file_path, file_path)
+
+
+    def load(self, test_csv):
+        """
+        The outputs for every clip of test_csv, with their transcripts. Only
+        the clips not already in the cache are run through the model, from
+        the DeepSpeech FLAGS as evaluate.py would. Returns (wav_filenames,
+        transcripts, probs).
+        """
+        df = read_test_csv(test_csv)
+
+        probs = dict()
+        for wav_filename in df['wav_filename']:
+            probs[wav_filename] = self.get(wav_filename)
+
+        missing = [f for f, p in probs.items() if p is None]
+        print ("%s of %s clips of %s have cached acoustic model outputs" % (len(probs) - len(missing), len(probs), test_csv))
+
+        if len(missing) > 0:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                missing_csv = os.path.join(temp_dir, "missing.csv")
+                df[df['wav_filename'].isin(missing)].to_csv(missing_csv, index=False, encoding='utf-8')
+                for wav_filename, clip_probs in compute_logits(missing_csv).items():
+                    self.put(wav_filename, clip_probs)
+                    probs[wav_filename] = clip_probs
+            self.clips.save()
+
+        # clips that DeepSpeech skipped, e.g. beyond --limit_test
+        computed = df[df['wav_filename'].map(lambda f: probs[f] is not None)]
+        wav_filenames = list(computed['wav_filename'])
+        return wav_filenames, list(computed['transcript']), [probs[f] for f in wav_filenames]
+
+
+def load_logits(test_csv, checkpoint_dir, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    The acoustic model's outputs for the clips of test_csv, with their
+    transcripts, from the logits cache. Returns (wav_filenames, transcripts,
+    probs).
+    """
+    with logits_cache(checkpoint_dir, cache_dir) as cache:
+        return cache.load(test_csv)
+
+
+def read_test_csv(test_csv):
+    # DeepSpeech resolves relative wav_filenames against the csv's directory
+    csv_dir = os.path.dirname(os.path.abspath(test_csv))
+    df = pd.read_csv(test_csv, encoding='utf-8', dtype={'transcript':str})
+    df['wav_filename'] = df['wav_filename'].map(lambda f: os.path.join(csv_dir, f))
+    df['transcript'] = df['transcript'].fillna('')
+    return df.drop_duplicates(subset='wav_filename')
+
+
+def decode(probs, scorer, beam_width, workers, cutoff_prob=1.0, cutoff_top_n=300, batch_size=256):
+    """
+    Beam search decodes each clip's softmax outputs with the scorer, in
+    batches across the ds_ctcdecoder's pool of workers.
+    """
+    from ds_ctcdecoder import ctc_beam_search_decoder_batch
+    from deepspeech_training.util.config import Config
+
+    predictions = []
+    for start in range(0, len(probs), batch_size):
+        batch = probs[start:start + batch_size]
+        lengths = np.array([len(p) for p in batch])
+        padded = np.zeros((len(batch), lengths.max(), batch[0].shape[1]), dtype=np.float32)
+        for i, p in enumerate(batch):
+            padded[i, :len(p)] = p
+
+        decoded = ctc_beam_search_decoder_batch(padded, lengths, Config.alphabet, beam_width,
+                                                num_processes=workers, scorer=scorer,
+                                                cutoff_prob=cutoff_prob, cutoff_top_n=cutoff_top_n)
+        predictions.extend(d[0][1] for d in decoded)
+
+    return predictions
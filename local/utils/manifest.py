@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import json
+import hashlib
+
+
+def sha1_file(file_path, block_size=1024*1024):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class import_manifest(object):
+    """
+    Records what an import has already done, so that a later run only
+    repeats the work whose inputs have changed.
+
+    'files' holds the sha1 of every file seen, which is only recomputed
+    when the file's size or mtime changes. 'sources' maps each imported
+    source to the hash of its inputs and the outputs derived from them.
+    'stages' maps each downstream step to the hashes of its inputs (and any
+    parameters it was run with) when it last ran, and 'joined' records the parts that files made by
+    concatenation were made from.
+    """
+
+    def __init__(self, manifest_file_path):
+        self.manifest_file_path = manifest_file_path
+        self.manifest = {'files':{}, 'sources':{}, 'stages':{}, 'joined':{}}
+        if os.path.isfile(manifest_file_path):
+            with open(manifest_file_path, 'r', encoding='utf-8') as manifest_file:
+                self.manifest.update(json.load(manifest_file))
+
+
+    def save(self):
+        temp_file_path = self.manifest_file_path + ".tmp"
+        with open(temp_file_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(temp_file_path, self.manifest_file_path)
+
+
+    def file_hash(self, file_path):
+        file_path = os.path.abspath(file_path)
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+
+        entry = self.manifest['files'].get(file_path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns, 'sha1':sha1_file(file_path)}
+            self.manifest['files'][file_path] = entry
+        return entry['sha1']
+
+
+    def inputs_hash(self, input_file_paths):
+        hashes = [self.file_hash(f) for f in input_file_paths]
+        if None in hashes:
+            return None
+        return hashlib.sha1(" ".join(hashes).encode('utf-8')).hexdigest()
+
+
+    def source_outputs(self, source, input_file_paths):
+        """
+        The outputs recorded for source, if its inputs are unchanged since and
+        the outputs still exist. Otherwise None.
+        """
+        entry = self.manifest['sources'].get(source)
+        if entry is None or entry['inputs'] != self.inputs_hash(input_file_paths):
+            return None
+        if not all(os.path.exists(f) for f in entry['outputs']):
+            return None
+        return entry['outputs']
+
+
+    def record_source(self, source, input_file_paths, output_file_paths):
+        self.manifest['sources'][source] = {'inputs':self.inputs_hash(input_file_paths), 'outputs':list(output_file_paths)}
+
+
+    def forget_sources(self, sources):
+        for source in list(self.manifest['sources']):
+            if source not in sources:
+                del self.manifest['sources'][source]
+
+
+    def stage_up_to_date(self, stage, input_file_paths, output_file_paths, parameters=None):
+        entry = self.manifest['stages'].get(stage)
+        if entry is None or entry['inputs'] != self.inputs_hash(input_file_paths):
+            return False
+        if entry.get('parameters') != parameters:
+            return False
+        return all(os.path.exists(f) for f in output_file_paths)
+
+
+    def record_stage(self, stage, input_file_paths, parameters=None):
+        self.manifest['stages'][stage] = {'inputs':self.inputs_hash(input_file_paths)}
+        if parameters is not None:
+            self.manifest['stages'][stage]['parameters'] = parameters
+        self.save()
+
+
+    def appendable_parts(self, joined_file_path, part_file_paths):
+        """
+        joined_file_path is the concatenation of part_file_paths. If it was
+        last made from a prefix of them, all unchanged, returns the parts
+        that remain to be appended. Otherwise None, i.e. rebuild it.
+        """
+        entry = self.manifest['joined'].get(os.path.abspath(joined_file_path))
+        if entry is None or entry['sha1'] != self.file_hash(joined_file_path):
+            return None
+
+        parts = [[os.path.abspath(f), self.file_hash(f)] for f in part_file_paths]
+        if parts[:len(entry['parts'])] != entry['parts']:
+            return None
+        return part_file_paths[len(entry['parts']):]
+
+
+    def record_joined(self, joined_file_path, part_file_paths):
+        self.manifest['joined'][os.path.abspath(joined_file_path)] = {
+            'sha1':self.file_hash(joined_file_path),
+            'parts':[[os.path.abspath(f), self.file_hash(f)] for f in part_file_paths]
+        }
+        self.save()
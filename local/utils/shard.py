@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import io
+import os
+
+
+def line_shards(file_path, num_shards):
+    """
+    Splits a text file into (up to) num_shards byte ranges (start, end) that
+    begin and end on line boundaries, so that each can be read independently.
+    """
+    file_size = os.path.getsize(file_path)
+    if file_size == 0:
+        return []
+
+    num_shards = max(1, min(num_shards, file_size))
+    shard_size = file_size // num_shards
+
+    boundaries = [0]
+    with open(file_path, 'rb') as in_file:
+        for i in range(1, num_shards):
+            position = max(i * shard_size, boundaries[-1])
+            if position >= file_size:
+                break
+            in_file.seek(position)
+            # move on to the start of the next line
+            in_file.readline()
+            position = in_file.tell()
+            if position >= file_size:
+                break
+            if position > boundaries[-1]:
+                boundaries.append(position)
+
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_shard_lines(file_path, start, end, encoding='utf-8'):
+    """
+    Yields the decoded lines of the byte range (start, end) from line_shards,
+    with the same newline handling as open(file_path, 'r')
+    """
+    with open(file_path, 'rb') as in_file:
+        in_file.seek(start)
+        data = in_file.read(end - start)
+
+    with io.TextIOWrapper(io.BytesIO(data), encoding=encoding) as text:
+        for line in text:
+            yield line
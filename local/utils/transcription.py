@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import csv
+import json
+import time
+import socket
+import threading
+import itertools
+import collections
+import concurrent.futures
+import socketserver
+import http.client
+import urllib.error
+import urllib.request
+
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from .audio import load_audio, load_audio_sox
+
+
+SAMPLE_RATE = 16000
+OUTPUT_FORMATS = ['tlog', 'textgrid', 'srt']
+
+
+class deepspeech_model(object):
+    """
+    Acoustic model and scorer that are loaded once and kept warm for
+    transcribing many files.
+    """
+
+    def __init__(self, model_file_path, scorer_file_path=None, vad_aggressiveness=0):
+        from deepspeech import Model
+
+        print ("Loading acoustic model %s" % model_file_path)
+        self.model = Model(model_file_path)
+        if scorer_file_path:
+            print ("Loading scorer %s" % scorer_file_path)
+            self.model.enableExternalScorer(scorer_file_path)
+        self.vad_aggressiveness = vad_aggressiveness
+
+
+    def transcribe(self, audio):
+        segments = []
+        for start, end in vad_segments(audio, self.vad_aggressiveness):
+            transcript = self.model.stt(audio[start:end])
+            segments.append({
+                'start' : int(start * 1000 / SAMPLE_RATE),
+                'end' : int(end * 1000 / SAMPLE_RATE),
+                'transcript' : transcript
+            })
+        return segments
+
+
+class stub_model(object):
+    """
+    Stands in for deepspeech_model, e.g. when testing the server. Returns a
+    single segment spanning the whole audio.
+    """
+
+    def __init__(self, transcript="prawf"):
+        self.transcript = transcript
+
+
+    def transcribe(self, audio):
+        return [{ 'start' : 0, 'end' : int(len(audio) * 1000 / SAMPLE_RATE), 'transcript' : self.transcript }]
+
+
+def vad_segments(audio, aggressiveness=0, frame_duration_ms=30, num_padding_frames=10, threshold=0.5):
+    """
+    Yields (start, end) sample offsets of voiced segments in 16kHz audio, in
+    the same way as DeepSpeech's transcribe.py splits audio with webrtcvad.
+    """
+    import webrtcvad
+
+    vad = webrtcvad.Vad(int(aggressiveness))
+    frame_size = int(SAMPLE_RATE * frame_duration_ms / 1000)
+    ring_buffer = collections.deque(maxlen=num_padding_frames)
+    triggered = False
+    segment_start = 0
+
+    for frame_start in range(0, len(audio) - frame_size + 1, frame_size):
+        is_speech = vad.is_speech(audio[frame_start:frame_start + frame_size].tobytes(), SAMPLE_RATE)
+        ring_buffer.append((frame_start, is_speech))
+        if not triggered:
+            if sum(1 for f, speech in ring_buffer if speech) > threshold * ring_buffer.maxlen:
+                triggered = True
+                segment_start = ring_buffer[0][0]
+                ring_buffer.clear()
+        else:
+            if sum(1 for f, speech in ring_buffer if not speech) > threshold * ring_buffer.maxlen:
+                triggered = False
+                yield segment_start, frame_start + frame_size
+                ring_buffer.clear()
+
+    if triggered:
+        yield segment_start, len(audio)
+
+
+def read_wavfile(wav_file_path):
+    # resampled in memory and handed straight to inference. The wav file
+    # itself is left as it is, even when only sox can read it.
+    try:
+        return load_audio(wav_file_path, SAMPLE_RATE)
+    except ValueError:
+        return load_audio_sox(wav_file_path, SAMPLE_RATE)
+
+
+def write_tlog(segments, tlog_file_path):
+    with open(tlog_file_path, 'w', encoding='utf-8') as tlog_file:
+        json.dump(segments, tlog_file, ensure_ascii=False)
+    return tlog_file_path
+
+
+def write_textgrid(wav_file_path, segments, textgrid_file_path):
+    from praatio import tgio
+
+    textgrid_entries_list = []
+    for segment in segments:
+        start_seconds = float(segment["start"] / 1000)
+        end_seconds = float(segment["end"] / 1000)
+        textgrid_entries_list.append((start_seconds, end_seconds, segment["transcript"]))
+
+    utterance_tier = tgio.IntervalTier('utterance', textgrid_entries_list, 0, pairedWav=wav_file_path)
+    tg = tgio.Textgrid()
+    tg.addTier(utterance_tier)
+    tg.save(textgrid_file_path, useShortForm=False, outputFormat='textgrid')
+    return textgrid_file_path
+
+
+def write_srt(segments, srt_file_path):
+    import srt
+
+    srt_segments = []
+    for i, segment in enumerate(segments, start=1):
+        start_delta = timedelta(seconds=float(segment["start"] / 1000))
+        end_delta = timedelta(seconds=float(segment["end"] / 1000))
+        srt_segments.append(srt.Subtitle(i, start=start_delta, end=end_delta, content=segment["transcript"]))
+
+    with open(srt_file_path, 'w', encoding='utf-8') as srt_file:
+        srt_file.write(srt.compose(srt_segments))
+    return srt_file_path
+
+
+def write_outputs(wav_file_path, segments, formats=OUTPUT_FORMATS):
+    outputs = {}
+    if 'tlog' in formats:
+        outputs['tlog'] = write_tlog(segments, wav_file_path.replace(".wav", ".tlog"))
+    if 'textgrid' in formats:
+        outputs['textgrid'] = write_textgrid(wav_file_path, segments, wav_file_path.replace(".wav", ".TextGrid"))
+    if 'srt' in formats:
+        outputs['srt'] = write_srt(segments, wav_file_path.replace(".wav", ".srt"))
+    return outputs
+
+
+class transcriber(object):
+    """
+    Transcribes wav files with a single model instance. Inference is
+    serialised, since the model is not safe to use from several threads.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.lock = threading.Lock()
+
+
+    def transcribe_audio(self, audio):
+        with self.lock:
+            return self.model.transcribe(audio)
+
+
+    def transcribe_file(self, wav_file_path, formats=OUTPUT_FORMATS):
+        audio = read_wavfile(wav_file_path)
+
+        start = time.perf_counter()
+        segments = self.transcribe_audio(audio)
+        inference_seconds = time.perf_counter() - start
+
+        return {
+            'wavfile' : wav_file_path,
+            'duration' : len(audio) / SAMPLE_RATE,
+            'inference_seconds' : inference_seconds,
+            'segments' : segments,
+            'outputs' : write_outputs(wav_file_path, segments, formats)
+        }
+
+
+def output_file_paths(wav_file_path, formats=OUTPUT_FORMATS):
+    extensions = { 'tlog' : '.tlog', 'textgrid' : '.TextGrid', 'srt' : '.srt' }
+    return [wav_file_path.replace(".wav", extensions[f]) for f in formats]
+
+
+def outputs_up_to_date(wav_file_path, formats=OUTPUT_FORMATS):
+    wav_mtime = os.path.getmtime(wav_file_path)
+    for output_file_path in output_file_paths(wav_file_path, formats):
+        if not os.path.isfile(output_file_path) or os.path.getmtime(output_file_path) < wav_mtime:
+            return False
+    return True
+
+
+def find_wavfiles(input_dir):
+    wav_file_paths = []
+    for root, dirs, files in os.walk(input_dir, followlinks=True):
+        for f in files:
+            if f.endswith(".wav") and not f.endswith("_48kHz.wav"):
+                wav_file_paths.append(os.path.join(root, f))
+    return sorted(wav_file_paths)
+
+
+def read_manifest(manifest_file_path):
+    """
+    A manifest is either a DeepSpeech style csv with a wav_filename column,
+    or a text file with one wav file path per line
+    """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file_path))
+    with open(manifest_file_path, 'r', encoding='utf-8') as manifest_file:
+        if manifest_file_path.endswith(".csv"):
+            wav_file_paths = [row['wav_filename'] for row in csv.DictReader(manifest_file)]
+        else:
+            wav_file_paths = [line.strip() for line in manifest_file if len(line.strip()) > 0 and not line.startswith("#")]
+
+    return [os.path.join(manifest_dir, p) for p in wav_file_paths]
+
+
+def transcribe_batch(transcriber, wav_file_paths, formats=OUTPUT_FORMATS, workers=4, force=False):
+    """
+    Transcribes many files with a single model. Files are read and resampled
+    in a pool of threads ahead of the model, which transcribes them one at a
+    time in this thread. Files with up to date outputs are skipped unless
+    force is set.
+    """
+    todo = [p for p in wav_file_paths if force or not outputs_up_to_date(p, formats)]
+    print ("Transcribing %s files (%s already up to date) with %s workers" % (len(todo), len(wav_file_paths) - len(todo), workers))
+
+    audio_seconds = 0.0
+    failed = []
+    start = time.perf_counter()
+
+    # only a few files per worker are read ahead, to bound memory use
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        todo_iter = iter(todo)
+        for wav_file_path in itertools.islice(todo_iter, workers * 2):
+            pending.append((wav_file_path, pool.submit(read_wavfile, wav_file_path)))
+
+        while pending:
+            wav_file_path, future = pending.popleft()
+            for next_wav_file_path in itertools.islice(todo_iter, 1):
+                pending.append((next_wav_file_path, pool.submit(read_wavfile, next_wav_file_path)))
+
+            try:
+                audio = future.result()
+                segments = transcriber.transcribe_audio(audio)
+                write_outputs(wav_file_path, segments, formats)
+            except Exception as e:
+                print ("Failed to transcribe %s: %s" % (wav_file_path, e))
+                failed.append(wav_file_path)
+                continue
+
+            audio_seconds += len(audio) / SAMPLE_RATE
+            print ("%s\t%.1f seconds of audio" % (wav_file_path, len(audio) / SAMPLE_RATE))
+
+    wall_seconds = time.perf_counter() - start
+    print ("Transcribed %.2f hours of audio in %.2f hours. %.1f audio hours per hour. %s failed" % (
+        audio_seconds / 3600, wall_seconds / 3600, audio_seconds / wall_seconds if wall_seconds > 0 else 0.0, len(failed)))
+
+    return failed
+
+
+class transcription_request_handler(BaseHTTPRequestHandler):
+    """
+    POST /transcribe  {"wavfile": "/path/to/file.wav", "formats": ["tlog", "textgrid", "srt"]}
+    GET  /health
+    """
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, { 'status' : 'ok' })
+        else:
+            self.send_json(404, { 'error' : 'not found' })
+
+
+    def do_POST(self):
+        if self.path != '/transcribe':
+            self.send_json(404, { 'error' : 'not found' })
+            return
+
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            wav_file_path = job['wavfile']
+            formats = job.get('formats', OUTPUT_FORMATS)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, { 'error' : 'invalid job: %s' % e })
+            return
+
+        if not os.path.isfile(wav_file_path):
+            self.send_json(404, { 'error' : 'no such file %s' % wav_file_path })
+            return
+
+        try:
+            self.send_json(200, self.server.transcriber.transcribe_file(wav_file_path, formats))
+        except Exception as e:
+            self.send_json(500, { 'error' : '%s: %s' % (type(e).__name__, e) })
+
+
+    def send_json(self, status, response):
+        body = json.dumps(response, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def address_string(self):
+        # unix sockets have no client address
+        if isinstance(self.client_address, tuple) and len(self.client_address) > 0:
+            return str(self.client_address[0])
+        return 'unix'
+
+
+# http.server.ThreadingHTTPServer is only in Python 3.7 onwards
+class http_server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class unix_http_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def create_server(model, host='127.0.0.1', port=5511, socket_file_path=None):
+    if socket_file_path:
+        server = unix_http_server(socket_file_path, transcription_request_handler)
+    else:
+        server = http_server((host, port), transcription_request_handler)
+    server.transcriber = transcriber(model)
+    return server
+
+
+def serve(model, host='127.0.0.1', port=5511, socket_file_path=None):
+    server = create_server(model, host, port, socket_file_path)
+    print ("Transcription server listening on %s" % (socket_file_path or "http://%s:%s" % (host, port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class unix_http_connection(http.client.HTTPConnection):
+
+    def __init__(self, socket_file_path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_file_path = socket_file_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_file_path)
+
+
+def request_transcription(server, wav_file_path, formats=OUTPUT_FORMATS):
+    """
+    Sends a job to a running server, given either as http://host:port or as
+    the path to its unix socket
+    """
+    body = json.dumps({ 'wavfile' : os.path.abspath(wav_file_path), 'formats' : formats }).encode('utf-8')
+    headers = { 'Content-Type' : 'application/json' }
+
+    if server.startswith('http://'):
+        request = urllib.request.Request(server.rstrip('/') + '/transcribe', data=body, headers=headers)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return json.loads(e.read())
+
+    connection = unix_http_connection(server)
+    try:
+        connection.request('POST', '/transcribe', body, headers)
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
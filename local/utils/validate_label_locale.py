@@ -5,10 +5,15 @@ from clean_transcript import clean_transcript
 
 ALPHABET_FILE_PATH = "/DeepSpeech/bin/bangor_welsh/alphabet.txt"
 
+# import_cv2.py calls validate_label for every clip. Load the alphabet once.
+clean = None
+
 def validate_label(label):
+    global clean
+    if clean is None:
+        clean = clean_transcript(ALPHABET_FILE_PATH)
 
-    clean = clean_transcript(ALPHABET_FILE_PATH)
-    cleaned, transcript = clean.clean(label)
+    cleaned, transcript = clean.normalise(label)
     if cleaned:
-        return transcript.lower()
+        return transcript
     return None
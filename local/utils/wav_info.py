@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import concurrent.futures
+
+import pandas as pd
+import numpy as np
+
+from .audio import read_wav_header
+
+
+COLUMNS = ['path', 'mtime_ns', 'size', 'sample_rate', 'channels', 'num_frames']
+
+# headers read to check that clips share one layout before their durations
+# are worked out from their sizes
+SAMPLE_SIZE = 100
+
+
+def read_wav_info(path):
+    """
+    (path, mtime_ns, size, sample_rate, channels, num_frames) for a wav file.
+    Files that are missing or unreadable have num_frames -1
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return (path, -1, -1, 0, 0, -1)
+
+    try:
+        header = read_wav_header(path)
+        return (path, stat.st_mtime_ns, stat.st_size, header.sample_rate, header.channels, header.num_frames)
+    except (ValueError, OSError):
+        return (path, stat.st_mtime_ns, stat.st_size, 0, 0, -1)
+
+
+class wav_info_cache(object):
+    """
+    Sample rates and lengths of wav files, read from their headers and kept
+    in a sqlite database keyed by path. Entries are used again for as long
+    as the file's mtime and size are unchanged.
+    """
+
+    def __init__(self, cache_file_path, workers=16):
+        self.cache_file_path = cache_file_path
+        self.workers = workers
+        self.db = sqlite3.connect(cache_file_path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS wav_info (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, sample_rate INTEGER, channels INTEGER, num_frames INTEGER)")
+
+
+    def close(self):
+        self.db.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def lookup(self, paths):
+        """
+        Returns a DataFrame with the COLUMNS plus 'duration' (seconds) for
+        each of paths, in the same order. Only files that are new or have
+        changed since they were cached have their headers read.
+        """
+        paths = pd.Series(paths, dtype=object).reset_index(drop=True)
+
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            stats = list(pool.map(stat_file, paths))
+        current = pd.DataFrame(stats, columns=['path', 'mtime_ns', 'size'])
+
+        cached = pd.read_sql_query("SELECT * FROM wav_info", self.db)
+        merged = current.merge(cached, on='path', how='left', suffixes=('', '_cached'))
+
+        stale = (merged['mtime_ns'] != merged['mtime_ns_cached']) | (merged['size'] != merged['size_cached']) | (merged['mtime_ns'] < 0)
+        stale_paths = merged.loc[stale, 'path'].unique()
+
+        if len(stale_paths) > 0:
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+                fresh = list(pool.map(read_wav_info, stale_paths))
+            self.db.executemany("INSERT OR REPLACE INTO wav_info VALUES (?, ?, ?, ?, ?, ?)", [f for f in fresh if f[1] >= 0])
+            self.db.commit()
+
+            fresh = pd.DataFrame(fresh, columns=COLUMNS).set_index('path')
+            for column in ['sample_rate', 'channels', 'num_frames']:
+                merged.loc[stale, column] = merged.loc[stale, 'path'].map(fresh[column]).values
+
+        info = merged[COLUMNS].copy()
+        for column in ['sample_rate', 'channels', 'num_frames']:
+            info[column] = info[column].astype(np.int64)
+
+        info['duration'] = np.where(info['sample_rate'] > 0, info['num_frames'] / info['sample_rate'].clip(lower=1), 0.0)
+        info.loc[info['num_frames'] < 0, 'duration'] = np.nan
+        return info
+
+
+def stat_file(path):
+    try:
+        stat = os.stat(path)
+        return (path, stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return (path, -1, -1)
+
+
+def sample_header(path):
+    try:
+        return read_wav_header(path)
+    except (ValueError, OSError):
+        return None
+
+
+def wav_durations(paths, sizes, cache, sample_size=SAMPLE_SIZE, seed=2):
+    """
+    Durations (seconds) of wav files, given their sizes as in a DeepSpeech
+    csv's wav_filesize column (or None). If the headers of a random sample of
+    them share one layout - sample rate, frame size and data offset, with
+    nothing after the audio data - every duration follows from the file size,
+    and all are worked out at once. Otherwise every header is read, through
+    the cache. Returns (durations, True if worked out from the sizes).
+    """
+    paths = pd.Series(paths, dtype=object).reset_index(drop=True)
+
+    if sizes is not None and len(paths) > 0:
+        sizes = pd.Series(sizes).reset_index(drop=True)
+        sample = paths.sample(min(sample_size, len(paths)), random_state=seed)
+        with concurrent.futures.ThreadPoolExecutor(cache.workers) as pool:
+            headers = list(pool.map(sample_header, sample))
+
+        layouts = set((h.sample_rate, h.block_align, h.data_offset) if h is not None else None for h in headers)
+        if len(layouts) == 1 and None not in layouts and sizes.notna().all():
+            sample_rate, block_align, data_offset = layouts.pop()
+            if sample_rate > 0 and block_align > 0 and \
+               all(h.data_offset + h.num_frames * h.block_align == sizes[i] for i, h in zip(sample.index, headers)):
+                num_frames = (sizes.values.astype(np.int64) - data_offset) // block_align
+                return num_frames.clip(min=0) / sample_rate, True
+
+    return cache.lookup(paths)['duration'].values, False
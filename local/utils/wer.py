@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import pathlib
+import itertools
+import argparse
+
+import numpy as np
+import pandas as pd
+
+
+BATCH_SIZE = 1024
+COUNT_COLUMNS = ['word_distance', 'word_length', 'char_distance', 'char_length']
+
+
+def char_tokens(texts):
+    """
+    Every character of texts as one flat array of code points, with the
+    length of each text
+    """
+    lengths = np.array([len(text) for text in texts], dtype=np.int64)
+    return np.frombuffer("".join(texts).encode('utf-32-le'), dtype=np.uint32).astype(np.int32), lengths
+
+
+def word_tokens(references, hypotheses):
+    """
+    The words of references and of hypotheses as flat arrays of ids, from a
+    shared vocabulary, with the number of words in each text
+    """
+    ref_words = [text.split() for text in references]
+    hyp_words = [text.split() for text in hypotheses]
+    ids, _ = pd.factorize(np.array(list(itertools.chain.from_iterable(ref_words + hyp_words)), dtype=object))
+    ref_lengths = np.array([len(w) for w in ref_words], dtype=np.int64)
+    hyp_lengths = np.array([len(w) for w in hyp_words], dtype=np.int64)
+    num_ref_words = ref_lengths.sum()
+    return (ids[:num_ref_words].astype(np.int32), ref_lengths), (ids[num_ref_words:].astype(np.int32), hyp_lengths)
+
+
+def padded(tokens, lengths, offsets, batch, pad):
+    width = max(lengths[batch].max(), 1)
+    positions = np.arange(width)
+    mask = positions < lengths[batch][:, None]
+    indexes = np.minimum(offsets[batch][:, None] + positions, max(len(tokens) - 1, 0))
+    taken = tokens[indexes] if len(tokens) > 0 else np.zeros(indexes.shape, dtype=np.int32)
+    return np.where(mask, taken, pad)
+
+
+def common_run_lengths(ref_tokens, ref_starts, hyp_tokens, hyp_starts, limits, step):
+    """
+    How many tokens each pair has in common, stepping from ref_starts and
+    hyp_starts by step, up to limits. Only pairs still matching are compared
+    at each step.
+    """
+    lengths = np.zeros(len(limits), dtype=np.int64)
+    active = np.flatnonzero(limits > 0)
+    while len(active) > 0:
+        k = lengths[active] * step
+        active = active[ref_tokens[ref_starts[active] + k] == hyp_tokens[hyp_starts[active] + k]]
+        lengths[active] += 1
+        active = active[lengths[active] < limits[active]]
+    return lengths
+
+
+def edit_distances(references, hypotheses, batch_size=BATCH_SIZE):
+    """
+    Levenshtein distance between each pair of reference and hypothesis
+    token sequences, each given as (flat token ids, lengths). A common
+    prefix or suffix doesn't change the distance, so it is cut off first,
+    which leaves little or nothing of most pairs from a decent model. The
+    rest are sorted by length and padded into batches, and the dynamic programming
+    table is filled a row (reference token) at a time for the whole batch at
+    once. Insertions within a row, which depend on the cell to their left,
+    are a running minimum:
+
+        d[j] = min(a[k] + j - k for k <= j) = minimum.accumulate(a - j) + j
+    """
+    ref_tokens, ref_lengths = references
+    hyp_tokens, hyp_lengths = hypotheses
+    ref_offsets = np.concatenate([[0], np.cumsum(ref_lengths)[:-1]]).astype(np.int64)
+    hyp_offsets = np.concatenate([[0], np.cumsum(hyp_lengths)[:-1]]).astype(np.int64)
+
+    limits = np.minimum(ref_lengths, hyp_lengths)
+    prefixes = common_run_lengths(ref_tokens, ref_offsets, hyp_tokens, hyp_offsets, limits, 1)
+    suffixes = common_run_lengths(ref_tokens, ref_offsets + ref_lengths - 1, hyp_tokens, hyp_offsets + hyp_lengths - 1, limits - prefixes, -1)
+    ref_offsets = ref_offsets + prefixes
+    hyp_offsets = hyp_offsets + prefixes
+    ref_lengths = ref_lengths - prefixes - suffixes
+    hyp_lengths = hyp_lengths - prefixes - suffixes
+    distances = np.zeros(len(ref_lengths), dtype=np.int64)
+
+    # distances can't exceed the longer of the pair
+    dtype = np.int16 if max(ref_lengths.max(initial=0), hyp_lengths.max(initial=0)) < 2**15 - 1 else np.int32
+
+    order = np.lexsort((hyp_lengths, ref_lengths))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        rl = ref_lengths[batch]
+        hl = hyp_lengths[batch]
+
+        # padding never matches, and cells beyond a pair's lengths are never read
+        ref = padded(ref_tokens, ref_lengths, ref_offsets, batch, -1)
+        hyp = padded(hyp_tokens, hyp_lengths, hyp_offsets, batch, -2)[:, :hl.max()]
+
+        cols = np.arange(hl.max() + 1, dtype=dtype)
+        d = np.tile(cols, (len(batch), 1))
+        a = np.empty_like(d)
+
+        done = rl == 0
+        distances[batch[done]] = hl[done]
+        for i in range(1, rl.max() + 1):
+            a[:, 0] = i
+            np.add(d[:, :-1], hyp != ref[:, i - 1:i], out=a[:, 1:])
+            np.minimum(a[:, 1:], d[:, 1:] + 1, out=a[:, 1:])
+            a -= cols
+            np.minimum.accumulate(a, axis=1, out=d)
+            d += cols
+
+            done = rl == i
+            if done.any():
+                distances[batch[done]] = d[done, hl[done]]
+
+    return distances
+
+
+def error_counts(references, hypotheses):
+    """
+    DataFrame of word_distance, word_length, char_distance and char_length
+    for each reference transcript and hypothesis
+    """
+    ref_words, hyp_words = word_tokens(references, hypotheses)
+    ref_chars = char_tokens(references)
+    return pd.DataFrame({
+        'word_distance':edit_distances(ref_words, hyp_words),
+        'word_length':ref_words[1],
+        'char_distance':edit_distances(ref_chars, char_tokens(hypotheses)),
+        'char_length':ref_chars[1]
+    })
+
+
+def word_error_rate(references, hypotheses):
+    ref_words, hyp_words = word_tokens(references, hypotheses)
+    return edit_distances(ref_words, hyp_words).sum() / max(ref_words[1].sum(), 1)
+
+
+def error_rates(counts):
+    counts = counts.copy()
+    counts['wer'] = counts['word_distance'] / counts['word_length'].clip(lower=1)
+    counts['cer'] = counts['char_distance'] / counts['char_length'].clip(lower=1)
+    return counts
+
+
+def breakdown(samples, column):
+    totals = samples.groupby(column)[COUNT_COLUMNS].sum()
+    totals.insert(0, 'clips', samples.groupby(column).size())
+    return error_rates(totals).sort_values('wer', ascending=False).reset_index()
+
+
+def report(samples, output_prefix):
+    """
+    Writes the per utterance errors of samples (wav_filename, src, res and
+    optionally fold and speaker columns) to <output_prefix>.utterances.csv,
+    totals per fold and per speaker to <output_prefix>.folds.csv and
+    <output_prefix>.speakers.csv, and all the totals to <output_prefix>.json
+    """
+    samples = error_rates(pd.concat([samples.reset_index(drop=True), error_counts(list(samples['src']), list(samples['res']))], axis=1))
+    samples.to_csv(output_prefix + ".utterances.csv", index=False, encoding='utf-8')
+
+    summary = breakdown(samples.assign(all='all'), 'all').set_index('all').to_dict(orient='index')
+    for column, name in [('fold', 'folds'), ('speaker', 'speakers')]:
+        if column in samples.columns:
+            totals = breakdown(samples, column)
+            totals.to_csv("%s.%s.csv" % (output_prefix, name), index=False, encoding='utf-8')
+            summary[name] = totals.set_index(column).to_dict(orient='index')
+
+    with open(output_prefix + ".json", 'w', encoding='utf-8') as summary_file:
+        json.dump(summary, summary_file, ensure_ascii=False, indent=2, default=int)
+
+    return summary
+
+
+def read_speakers(tsv_files):
+    # CommonVoice clips keep their name when converted from mp3 to wav
+    speakers = dict()
+    for tsv_file in tsv_files:
+        df = pd.read_csv(tsv_file, encoding='utf-8', sep='\t', usecols=['client_id', 'path'], dtype=str, quoting=3)
+        speakers.update(zip(df['path'].map(lambda p: pathlib.Path(p).stem), df['client_id']))
+    return speakers
+
+
+def fold_name(results_file):
+    name = os.path.basename(results_file)
+    for suffix in [".json", ".results"]:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+
+def main(results_files, speakers_files, output_prefix, **args):
+    samples = []
+    for results_file in results_files:
+        with open(results_file, 'r', encoding='utf-8') as f:
+            df = pd.DataFrame(json.load(f), columns=['wav_filename', 'src', 'res'])
+        df['fold'] = fold_name(results_file)
+        samples.append(df)
+    samples = pd.concat(samples, ignore_index=True)
+    samples[['src', 'res']] = samples[['src', 'res']].fillna('')
+
+    if speakers_files:
+        speakers = read_speakers(speakers_files)
+        samples['speaker'] = samples['wav_filename'].map(lambda f: speakers.get(pathlib.Path(f).stem, ''))
+
+    summary = report(samples, output_prefix)
+    print ("%s clips: WER %.4f, CER %.4f" % (summary['all']['clips'], summary['all']['wer'], summary['all']['cer']))
+    for fold, totals in summary.get('folds', {}).items():
+        print ("%s\t%s clips: WER %.4f, CER %.4f" % (fold, totals['clips'], totals['wer'], totals['cer']))
+    print ("Reports in %s.*" % output_prefix)
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Word and character error rates, per utterance, per fold (results file) and per speaker, of evaluate.py or evaluate_scorers.py results files')
+
+    parser.add_argument('--results',
+                        dest='results_files',
+                        nargs='+',
+                        required=True,
+                        help='results json files, e.g. one per k-fold')
+
+    parser.add_argument('--speakers',
+                        dest='speakers_files',
+                        nargs='*',
+                        help='CommonVoice tsv files, to break down results by client_id')
+
+    parser.add_argument('--output_prefix',
+                        dest='output_prefix',
+                        required=True,
+                        help='prefix of the report files')
+
+    parser.set_defaults(func=main)
+    args = parser.parse_args()
+    args.func(**vars(args))